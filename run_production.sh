@@ -2,5 +2,5 @@
 
 cd src
 
-gunicorn --bind 0.0.0.0:8080 wsgi
+gunicorn --config gunicorn.conf.py wsgi
 
@@ -1,15 +1,20 @@
 import datetime
-from typing import List, Dict, IO
+from typing import List, Dict, IO, Set, Tuple
 
-from sqlalchemy import func, desc
+from sqlalchemy import desc, case, func, and_, or_, tuple_
 from sqlalchemy.orm import Session
 
+import sync
+from alarm_rules import ChannelRules, RuleEngine, rows_to_arrays
 from contact import Contacter
-from models import Channel, ReadingData, Sensor, Site
+from models import Channel, ReadingData, Sensor, Site, AlarmedChannel
 
+from util.cache import VersionedCache, channel_config_version
+from util import metrics
 from util.db import session_scope
-from util.timer import RepeatingTimer
+from util.timer import AdaptiveTimer, PhaseTimer, TICK_IDLE, TICK_NORMAL, TICK_ACTIVE
 import logging
+import threading
 
 from pathlib import Path
 import pickle
@@ -36,12 +41,80 @@ def __init__(self, site_id, sensor_id, channel_id,
     def __repr__(self):
         return str(self.__dict__)
 
+    # A channel can only have one running alarm, so the channel id is enough to identify it
+    def __eq__(self, other):
+        return isinstance(other, AlarmedChannelData) and self.channel_id == other.channel_id
+
+    def __hash__(self):
+        return hash(self.channel_id)
+
+
+class AlarmStateStore:
+    """
+    Stores the running alarms in the config database (AlarmedChannel table).
+    Every alarm start and end only writes its own row in the session of the alarm tick,
+    so the state is updated incrementally and atomically and can be read by other processes.
+    """
+
+    def load(self, session: Session) -> Dict[AlarmedChannelData, datetime.datetime]:
+        rows = session.query(AlarmedChannel).all()
+        return {
+            AlarmedChannelData(
+                x.site_id, x.sensor_id, x.channel_id,
+                x.cnr_site_id, x.cnr_station_id, x.cnr_channel_id,
+                x.range_min, x.range_max
+            ): x.start_date for x in rows
+        }
+
+    def add(self, session: Session, channel_data: AlarmedChannelData, date):
+        session.merge(AlarmedChannel(
+            channel_id=channel_data.channel_id,
+            sensor_id=channel_data.sensor_id,
+            site_id=channel_data.site_id,
+            cnr_site_id=channel_data.cnr_site_id,
+            cnr_station_id=channel_data.cnr_station_id,
+            cnr_channel_id=channel_data.cnr_channel_id,
+            range_min=channel_data.range_min,
+            range_max=channel_data.range_max,
+            start_date=date,
+        ))
+
+    def remove(self, session: Session, channel_data: AlarmedChannelData):
+        session.query(AlarmedChannel)\
+            .filter(AlarmedChannel.channel_id == channel_data.channel_id)\
+            .delete(synchronize_session=False)
+
+    def import_legacy_file(self, path: Path):
+        """
+        Imports the alarms saved by older versions (a pickled dict) and renames the old file.
+        The file is renamed only once the import is committed, if it fails the import is retried on the next start.
+        """
+        if not path.is_file():
+            return
+
+        with path.open("rb") as inp:
+            alarmed_channels = pickle.load(inp)
+
+        with session_scope() as session:
+            for channel_data, date in alarmed_channels.items():
+                self.add(session, channel_data, date)
+
+        path.rename(path.with_name(path.name + ".imported"))
+        logging.info("alarm_manager imported %i running alarms from %s", len(alarmed_channels), path)
+
 
 # This class checks if there are any reading values out of min or max range of its own channel
 class AlarmFinder:
     def __init__(self):
         self.file_path = None  # type: Path
         self.last_time = None  # type: datetime.datetime
+        self.clock = datetime.datetime.now  # Replaced when replaying historical data
+        # Readings checked by a single control: after a long downtime the backlog is checked in chunks, one per tick
+        self.max_window = datetime.timedelta(hours=1)
+        self.catching_up = False  # The last control didn't reach the current time
+        self.rows_scanned = 0
+        self.channels_cache = VersionedCache(channel_config_version)
+        self.rules = RuleEngine()
 
     def load_config(self, file_path: Path):
         self.file_path = file_path
@@ -63,14 +136,46 @@ def ultimate_time(self, session):
         query = session.query(ReadingData.date).order_by(desc(ReadingData.date)).first().all()[0]
         return query
 
-    def control_data(self, session):
+    def has_new_data(self, session) -> bool:
         """
-        Returns two lists in which there is a record for each channel with its minimum and maximum value.
-        It is collected only records written after the last control and it is written this datetime values on a file.
+        Cheap probe that checks if any reading was written after the last control.
+        It only needs the date index so it can be run on every tick without scanning the readings.
+        """
+        row = session.query(ReadingData.date)\
+            .filter(ReadingData.date > self.last_time, ReadingData.date <= self.clock())\
+            .first()
+        return row is not None
+
+    # Channels read by a single query in control_data, every key takes 3 parameters (old sqlite allows 999)
+    KEYS_PER_QUERY = 300
+
+    def get_window(self, rules: ChannelRules) -> datetime.timedelta:
+        """How far back the first control looks: at least max_window and the longest min_duration"""
+        longest = float(rules.min_duration.max()) if len(rules) > 0 else 0
+        return max(self.max_window, datetime.timedelta(seconds=longest))
+
+    def control_data(self, session: Session, rules: ChannelRules):
         """
+        Returns the readings (site, station, channel, date and values) written after the last control, sorted by date,
+        and it is written this datetime values on a file.
 
+        At most max_window of readings is checked: after a long downtime the next controls go on from where this one
+        stopped (catching_up is set) until they reach the current time.
+        On the first start (no last control) only the readings of the last get_window are checked.
+
+        Channels with only range rules are reduced in SQL to their lowest minimum, highest maximum and last reading,
+        that's all the rules need. Only the channels with duration or rate rules read every row.
+        """
+
+        now = self.clock()
         check_time = self.last_time
-        self.last_time = datetime.datetime.now()
+        if check_time == datetime.datetime.min:
+            check_time = now - self.get_window(rules)
+        end = min(now, check_time + self.max_window)
+        self.catching_up = end < now
+        if self.catching_up:
+            logging.warning("Alarm control behind, checking the readings from %s to %s", check_time, end)
+        self.last_time = end
 
         time_string = str(self.last_time.year) + " " + str(self.last_time.month) + " " + str(self.last_time.day) + \
                       " " + str(self.last_time.hour) + " " + str(self.last_time.minute) + \
@@ -82,42 +187,59 @@ def control_data(self, session):
 
         logging.debug("Checking after %s", str(check_time))
 
-        query_min = session.query(
-            func.min(ReadingData.value_min), ReadingData.channel_id, ReadingData.station_id,
-            ReadingData.sensor_id, ReadingData.room_id, ReadingData.site_id, ReadingData.date). \
-            group_by(ReadingData.channel_id). \
-            group_by(ReadingData.station_id). \
-            group_by(ReadingData.sensor_id). \
-            group_by(ReadingData.room_id). \
-            group_by(ReadingData.site_id).\
-            filter(ReadingData.date > check_time).all()
-
-        query_max = session.query(
-            func.max(ReadingData.value_max), ReadingData.channel_id, ReadingData.station_id,
-            ReadingData.sensor_id, ReadingData.room_id, ReadingData.site_id, ReadingData.date). \
-            group_by(ReadingData.channel_id). \
-            group_by(ReadingData.station_id). \
-            group_by(ReadingData.sensor_id). \
-            group_by(ReadingData.room_id). \
-            group_by(ReadingData.site_id). \
-            filter(ReadingData.date > check_time).all()
-
-        return query_min, query_max
+        columns = (ReadingData.site_id, ReadingData.station_id, ReadingData.channel_id, ReadingData.date,
+                   ReadingData.value_min, ReadingData.value_avg, ReadingData.value_max)
+        keys = (ReadingData.site_id, ReadingData.station_id, ReadingData.channel_id)
+        window = (ReadingData.date > check_time, ReadingData.date <= end)
+
+        extremes = session.query(
+            *(key.label(key.key) for key in keys),
+            func.min(ReadingData.value_min).label("value_min"),
+            func.max(ReadingData.value_max).label("value_max"),
+            func.max(ReadingData.date).label("date")
+        ).filter(*window).group_by(*keys).subquery()
+
+        reduced = session.query(*columns).\
+            join(extremes, and_(
+                ReadingData.site_id == extremes.c.site_id,
+                ReadingData.station_id == extremes.c.station_id,
+                ReadingData.channel_id == extremes.c.channel_id,
+                or_(ReadingData.value_min == extremes.c.value_min,
+                    ReadingData.value_max == extremes.c.value_max,
+                    ReadingData.date == extremes.c.date)
+            )).\
+            filter(*window).\
+            all()
 
-    def compare_data(self, session: Session):
+        rows = []
+        for r in reduced:
+            pos = rules.index.get((r.site_id, r.station_id, r.channel_id))
+            if pos is not None and not rules.needs_rows[pos]:
+                rows.append(r)
+
+        full_keys = [key for key, pos in rules.index.items() if rules.needs_rows[pos]]
+        for i in range(0, len(full_keys), self.KEYS_PER_QUERY):
+            rows += session.query(*columns).\
+                filter(*window).\
+                filter(tuple_(*keys).in_(full_keys[i:i + self.KEYS_PER_QUERY])).\
+                all()
+
+        rows.sort(key=lambda r: r.date)
+        self.rows_scanned += len(rows)
+        return rows
+
+    def load_channels(self, session: Session) -> ChannelRules:
         """
-        Returns two dictionaries with the entire record of the channel, the value and the date
-        of every record containing an alarming measure.
-        It is defined as alarming value a reading value which is under its channel minimum range or over
-        its channel maximum range.
+        Returns the alarm configuration of every enabled channel.
+        The table is cached and reloaded only when a site, sensor or channel changes.
         """
+        return self.channels_cache.get(session, "channels", lambda key: self.query_channels(session))
 
-        alarm_max = {}
-        alarm_min = {}
-        query_min, query_max = self.control_data(session)
+    def query_channels(self, session: Session) -> ChannelRules:
         channels = session.\
             query(
                 Channel.id.label("channel_id"), Channel.id_cnr.label("channel_cnr_id"), Channel.range_min, Channel.range_max,
+                Channel.hysteresis, Channel.min_duration, Channel.rate_max,
                 Sensor.id.label("sensor_id"),  Sensor.id_cnr.label("station_cnr_id"),
                 Site.id.label("site_id"), Site.id_cnr.label("site_cnr_id")
         ).\
@@ -126,35 +248,39 @@ def compare_data(self, session: Session):
             filter(Sensor.enabled == True).\
             all()
 
-        for record in query_min:
-            for ch in channels:
-                if ch.channel_cnr_id == record.channel_id and ch.site_cnr_id == record.site_id:
-                    if record[0] <= ch.range_min:
-                        channel = AlarmedChannelData(
-                            ch.site_id, ch.sensor_id, ch.channel_id,
-                            ch.site_cnr_id, ch.station_cnr_id, ch.channel_cnr_id,
-                            ch.range_min, ch.range_max
-                        )
-                        alarm_min[channel] = [record[0], record.date]
-
-                    elif record[0] >= ch.range_max:
-                        channel = AlarmedChannelData(
-                            ch.site_id, ch.sensor_id, ch.channel_id,
-                            ch.site_cnr_id, ch.station_cnr_id, ch.channel_cnr_id,
-                            ch.range_min, ch.range_max
-                        )
-                        alarm_max[channel] = [record[0], record.date]
-
-        for record in query_max:
-            for ch in channels:
-                if ch.channel_cnr_id == record.channel_id and ch.site_cnr_id == record.site_id:
-                    if record[0] >= ch.range_max:
-                        channel = AlarmedChannelData(
-                            ch.site_id, ch.sensor_id, ch.channel_id,
-                            ch.site_cnr_id, ch.station_cnr_id, ch.channel_cnr_id,
-                            ch.range_min, ch.range_max
-                        )
-                        alarm_max[channel] = [record[0], record.date]
+        logging.debug("Loaded the alarm configuration of %i channels", len(channels))
+
+        return ChannelRules(
+            [
+                AlarmedChannelData(
+                    ch.site_id, ch.sensor_id, ch.channel_id,
+                    ch.site_cnr_id, ch.station_cnr_id, ch.channel_cnr_id,
+                    ch.range_min, ch.range_max
+                ) for ch in channels
+            ],
+            hysteresis=[ch.hysteresis for ch in channels],
+            min_duration=[ch.min_duration for ch in channels],
+            rate_max=[ch.rate_max for ch in channels],
+        )
+
+    def compare_data(self, session: Session):
+        """
+        Returns two dictionaries with the entire record of the channel, the value and the date
+        of every record containing an alarming measure.
+        It is defined as alarming value a reading value which is under its channel minimum range or over
+        its channel maximum range, or that changes faster than the channel maximum rate
+        (for at least the channel minimum duration, see alarm_rules).
+        """
+
+        rules = self.load_channels(session)
+        self.rules.set_rules(rules)
+        rows = self.control_data(session, rules)
+
+        positions, t, vmin, vavg, vmax, dates = rows_to_arrays(rules, rows)
+        found_min, found_max = self.rules.evaluate(positions, t, vmin, vavg, vmax, dates=dates)
+
+        alarm_min = {rules.channels[pos]: [value, date] for pos, (value, date) in found_min.items()}
+        alarm_max = {rules.channels[pos]: [value, date] for pos, (value, date) in found_max.items()}
 
         if alarm_min or alarm_max:
             logging.info("alarm_compare_data, found min: %s max: %s", alarm_min, alarm_max)
@@ -162,14 +288,27 @@ def compare_data(self, session: Session):
         return alarm_min, alarm_max
 
     def check_alarmed(self, session: Session, channel_data: List[AlarmedChannelData]):
+        """Returns, for every channel, True if its alarm is over (taking hysteresis into account)"""
         res = {}
+        rules = self.rules.rules
+        unknown = []
 
-        # Could we use less queries?
-        # answer: yes, with a custom table and with at least 3/4 complex queries, good luck doing that
-        # Doing this seems fine, the number of queries is the same as the number of concurrent fired alarms.
-        # This should be efficient, unless global warning burns every site at once
-
+        # Channels with readings in the current configuration are checked using the rule engine state
+        known = []
         for channel in channel_data:
+            pos = rules.positions.get(channel.channel_id) if rules is not None else None
+            if pos is not None and self.rules.has_observations(pos):
+                known.append((channel, pos))
+            else:
+                unknown.append(channel)
+
+        if known:
+            extinguished = self.rules.check_extinguished([pos for _, pos in known])
+            for (channel, _), ext in zip(known, extinguished):
+                res[channel] = bool(ext)
+
+        # The others (ex: after a restart) need to query their last reading
+        for channel in unknown:
             last_mes = session.query(ReadingData.date, ReadingData.value_min, ReadingData.value_max).\
                 filter(ReadingData.site_id == channel.cnr_site_id, ReadingData.station_id == channel.cnr_station_id, ReadingData.channel_id == channel.cnr_channel_id).\
                 order_by(ReadingData.date.desc()).\
@@ -179,7 +318,11 @@ def check_alarmed(self, session: Session, channel_data: List[AlarmedChannelData]
                 logging.warning("Error checking alarm %s, channel not found", channel)
                 continue
 
-            res[channel] = last_mes.value_min > channel.range_min and last_mes.value_max < channel.range_max
+            pos = rules.positions.get(channel.channel_id) if rules is not None else None
+            hysteresis = float(rules.hysteresis[pos]) if pos is not None else 0
+
+            res[channel] = (channel.range_min is None or last_mes.value_min > float(channel.range_min) + hysteresis) and \
+                           (channel.range_max is None or last_mes.value_max < float(channel.range_max) - hysteresis)
 
         return res
 
@@ -195,24 +338,41 @@ class AlarmManager:
     """
     def __init__(self, contacter: Contacter):
         self.alarm_finder = AlarmFinder()
-        self.timer = RepeatingTimer(1, self.on_timer_tick)
+        self.timer = AdaptiveTimer(1, self.on_timer_tick)
         self.contacter = contacter
+        self.tick_lock = threading.Lock()
 
-        self.alarmed_channels_save_file = None # type: Path
+        self.alarm_store = AlarmStateStore()
+        self.legacy_save_file = None  # type: Path
         self.alarmed_channels = {}  # type: Dict[AlarmedChannelData, datetime]
         self.alarmed_channels_by_sensor = {}  # type: Dict[int, List[AlarmedChannelData]]
 
-    def load_config(self, vardata_path: Path, check_interval):
+        # Changes collected during a tick, they're applied all together once the tick is done
+        self.changed_sensors = set()  # type: Set[int]
+        self.pending_alarms = []  # type: List[Tuple[int, str]]
+
+        self.last_tick_phases = PhaseTimer()  # Time spent in every phase of the last tick
+
+    def load_config(self, vardata_path: Path, check_interval, min_interval=None, max_interval=None, idle_backoff=2.0,
+                    max_window=3600.0):
         self.timer.interval = check_interval
+        self.timer.min_interval = min_interval
+        self.timer.max_interval = max_interval
+        self.timer.backoff = idle_backoff
+        # The window should never be shorter than a tick, or the controls would fall behind
+        self.alarm_finder.max_window = datetime.timedelta(
+            seconds=max(max_window, check_interval, max_interval or 0))
         self.alarm_finder.load_config(vardata_path / "last_alarm_reading.txt")
-        self.alarmed_channels_save_file = vardata_path / "alarmed_channels.txt"
-        self.load_alarmed_channels()
+        self.legacy_save_file = vardata_path / "alarmed_channels.txt"
 
     def start(self):
-        self.timer.start_async()
+        if self.legacy_save_file is not None:
+            self.alarm_store.import_legacy_file(self.legacy_save_file)
 
         # Check alarm status
         with session_scope() as session:
+            self.load_alarmed_channels(session)
+
             alarmed_sensors = session.query(Sensor).filter(Sensor.status != "ok").all()
 
             for sensor in alarmed_sensors:
@@ -223,66 +383,127 @@ def start(self):
 
             session.commit()
 
+        self.timer.start_async()
+
     def on_timer_tick(self):
         # Oh, just look at the time!
 
+        # Ticks can't overlap, if another tick is still running this one gets merged into it
+        if not self.tick_lock.acquire(blocking=False):
+            logging.warning("Alarm tick already running, skipping")
+            return TICK_NORMAL
+
+        try:
+            return self.run_tick()
+        finally:
+            metrics.observe_tick(self.last_tick_phases.phases)
+            self.tick_lock.release()
+
+    def run_tick(self):
+        self.changed_sensors = set()
+        self.pending_alarms = []
+        timer = PhaseTimer()
+        self.last_tick_phases = timer
+
         # Check for alarming measures
         with session_scope() as session:
-            alarm_min, alarm_max = self.alarm_finder.compare_data(session)
+            with timer.phase("probe"):
+                new_data = self.alarm_finder.has_new_data(session)
 
-            for channel_data, (min_measure, date) in alarm_min.items():
-                if channel_data not in self.alarmed_channels:
-                    self.on_alarm_start(session, date, channel_data, min_measure, MIN_MEASURE)
-                else:
-                    self.on_alarm_continue(session, channel_data, min_measure, MIN_MEASURE)
+            if not new_data:
+                # No new readings, nothing can start or end (even if some alarms are running)
+                return self.tick_result(new_data, False)
 
-            for channel_data, (max_measure, date) in alarm_max.items():
-                if channel_data not in self.alarmed_channels:
-                    self.on_alarm_start(session, date, channel_data, max_measure, MAX_MEASURE)
-                else:
-                    self.on_alarm_continue(session, channel_data, max_measure, MAX_MEASURE)
+            with timer.phase("compare_data"):
+                alarm_min, alarm_max = self.alarm_finder.compare_data(session)
 
-            # Check the alarmed channels for updates
-            status = self.alarm_finder.check_alarmed(session, list(self.alarmed_channels.keys()))
+            with timer.phase("alarm_start"):
+                for channel_data, (min_measure, date) in alarm_min.items():
+                    if channel_data not in self.alarmed_channels:
+                        self.on_alarm_start(session, date, channel_data, min_measure, MIN_MEASURE)
+                    else:
+                        self.on_alarm_continue(session, channel_data, min_measure, MIN_MEASURE)
 
-            for channel, alarm_extinguished in status.items():
-                if not alarm_extinguished: continue
-                self.on_alarm_end(session, channel)
+                for channel_data, (max_measure, date) in alarm_max.items():
+                    if channel_data not in self.alarmed_channels:
+                        self.on_alarm_start(session, date, channel_data, max_measure, MAX_MEASURE)
+                    else:
+                        self.on_alarm_continue(session, channel_data, max_measure, MAX_MEASURE)
 
-    def update_sensor_status(self, session: Session, sensor_id):
-        sites = self.alarmed_channels_by_sensor.get(sensor_id)
+            with timer.phase("check_alarmed"):
+                # Check the alarmed channels for updates
+                status = self.alarm_finder.check_alarmed(session, list(self.alarmed_channels.keys()))
 
-        if sites is None:
-            sites = []
+                for channel, alarm_extinguished in status.items():
+                    if not alarm_extinguished: continue
+                    self.on_alarm_end(session, channel)
 
-        channel_ids = [s.channel_id for s in sites]
+            with timer.phase("commit"):
+                state_changed = bool(self.changed_sensors)
+                self.update_sensor_status(session)
+                session.commit()
 
-        sensor = session.query(Sensor).filter(Sensor.id == sensor_id).first()
-        if sensor is None:
-            logging.warning("Unable to update sensor %s, sensor not found", sensor_id)
-            return
+        # Notifications are sent only once the tick has been committed
+        with timer.phase("notify"):
+            self.send_pending_alarms()
+
+        logging.debug("Alarm tick phases: %s", timer)
+
+        return self.tick_result(new_data, state_changed)
+
+    def tick_result(self, new_data: bool, state_changed: bool) -> str:
+        """
+        Tells the timer how busy the tick was: without new readings it can slow down,
+        while alarms start, end or have new readings to be checked (or a backlog is being checked) it should check often.
+        """
+        if not new_data:
+            return TICK_IDLE
+        if state_changed or self.alarmed_channels or self.alarm_finder.catching_up:
+            return TICK_ACTIVE
+        return TICK_NORMAL
+
+    def get_sensor_status(self, sensor_id) -> str:
+        channels = self.alarmed_channels_by_sensor.get(sensor_id, [])
+        channel_ids = [c.channel_id for c in channels]
 
         if len(channel_ids) > 0:
-            status = "{} fired".format(channel_ids)
-        else:
-            status = "ok"
+            return "{} fired".format(channel_ids)
+        return "ok"
+
+    def update_sensor_status(self, session: Session):
+        """Writes the status of every sensor changed in this tick using a single UPDATE"""
+        if not self.changed_sensors:
+            return
+
+        statuses = {sensor_id: self.get_sensor_status(sensor_id) for sensor_id in self.changed_sensors}
+
+        updated = session.query(Sensor)\
+            .filter(Sensor.id.in_(list(statuses)))\
+            .update({Sensor.status: case(statuses, value=Sensor.id), **sync.stamp(session, Sensor)},
+                    synchronize_session=False)
 
-        sensor.status = status
-        session.commit()
+        if updated != len(statuses):
+            logging.warning("Unable to update %i sensors, sensors not found", len(statuses) - updated)
+
+        self.changed_sensors = set()
+
+    def send_pending_alarms(self):
+        # Every alarm of the tick is sent together, so that the recipients get a single summary notification
+        self.contacter.send_alarms(self.pending_alarms)
+        self.pending_alarms = []
 
     def on_alarm_start(self, session: Session, date, channel_data: AlarmedChannelData, measure, measure_type):
         logging.warning("on_alarm_started!, %s %s %s %s", date, channel_data, measure, measure_type)
         self.alarmed_channels[channel_data] = date
-        self.save_alarmed_channels()
+        self.alarm_store.add(session, channel_data, date)
 
         if channel_data.sensor_id in self.alarmed_channels_by_sensor:
             self.alarmed_channels_by_sensor[channel_data.sensor_id].append(channel_data)
         else:
             self.alarmed_channels_by_sensor[channel_data.sensor_id] = [channel_data]
 
-        self.update_sensor_status(session, channel_data.sensor_id)
-
-        self.contacter.send_alarm(channel_data.channel_id, str(measure))
+        self.changed_sensors.add(channel_data.sensor_id)
+        self.pending_alarms.append((channel_data.channel_id, str(measure)))
 
     def on_alarm_continue(self, session: Session, channel_data, measure, measure_type):
         logging.warning("on_alarm_continue!, %s %s %s", channel_data, measure, measure_type)
@@ -292,31 +513,20 @@ def on_alarm_end(self, session: Session, channel_data):
         logging.warning("on_alarm_end!, %s", channel_data)
 
         del self.alarmed_channels[channel_data]
-        self.save_alarmed_channels()
+        self.alarm_store.remove(session, channel_data)
 
         sensor_channels = self.alarmed_channels_by_sensor[channel_data.sensor_id]
         sensor_channels.remove(channel_data)
         if len(sensor_channels) == 0:
             del self.alarmed_channels_by_sensor[channel_data.sensor_id]
 
-        self.update_sensor_status(session, channel_data.sensor_id)
-
-    def save_alarmed_channels(self):
-        with self.alarmed_channels_save_file.open("wb") as out:
-            pickle.dump(self.alarmed_channels, out, pickle.DEFAULT_PROTOCOL)
+        self.changed_sensors.add(channel_data.sensor_id)
 
-    def load_alarmed_channels(self):
-        if self.alarmed_channels_save_file.is_file():
-            with self.alarmed_channels_save_file.open("rb") as inp:
-                self.alarmed_channels = pickle.load(inp)
-        else:
-            self.alarmed_channels = {}
+    def load_alarmed_channels(self, session: Session):
+        self.alarmed_channels = self.alarm_store.load(session)
 
-        self.alarmed_channels_by_sensor = dict.fromkeys([x.sensor_id for x in self.alarmed_channels.keys()], [])
+        self.alarmed_channels_by_sensor = {}
         for x in self.alarmed_channels.keys():
-            self.alarmed_channels_by_sensor[x.sensor_id].append(x)
+            self.alarmed_channels_by_sensor.setdefault(x.sensor_id, []).append(x)
 
         logging.info("alarm_manager loaded %i running alarms" % len(self.alarmed_channels))
-
-
-
@@ -0,0 +1,232 @@
+import math
+from operator import itemgetter
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+# Alarm rule engine
+# Every rule is evaluated for all the channels at once using numpy arrays built from the rows read in the tick.
+# The rules supported are:
+# - range: a value under range_min or over range_max fires the alarm
+# - hysteresis: once fired the alarm ends only when the value is back in the range by at least hysteresis
+# - minimum duration: the range or rate condition should hold for at least min_duration seconds before firing
+# - rate of change: the value should not change more than rate_max units per hour (ex: humidity +5%/h)
+# Rising values (over range_max or rising too fast) are reported as max alarms, falling values as min alarms.
+
+
+def _float_array(values) -> np.ndarray:
+    # None (and Decimal) values are converted, None becomes NaN
+    return np.array(values, dtype=np.float64)
+
+
+def _timestamps(dates) -> np.ndarray:
+    # The readings of a tick share a few dates (one per minute), every date is converted only once
+    stamps = dict.fromkeys(dates)
+    for date in stamps:
+        stamps[date] = date.timestamp()
+    return np.fromiter(map(stamps.__getitem__, dates), dtype=np.float64, count=len(dates))
+
+
+class ChannelRules:
+    """Alarm configuration of every enabled channel, compiled into arrays indexed by channel position"""
+    def __init__(self, channels: list, hysteresis: list, min_duration: list, rate_max: list):
+        self.channels = channels  # type: list
+        # The cnr channel ids are only unique inside a station (every station numbers its channels from 1)
+        self.index = {(c.cnr_site_id, c.cnr_station_id, c.cnr_channel_id): i for i, c in enumerate(channels)}
+        self.positions = {c.channel_id: i for i, c in enumerate(channels)}
+
+        self.channel_ids = np.array([c.channel_id for c in channels], dtype=np.int64)
+        self.range_min = _float_array([c.range_min for c in channels])
+        self.range_max = _float_array([c.range_max for c in channels])
+        self.hysteresis = np.nan_to_num(_float_array(hysteresis))
+        self.min_duration = np.nan_to_num(_float_array(min_duration))
+        self.rate_max = _float_array(rate_max)
+        # Channels whose rules depend on the single readings (and not only on the extremes of the tick)
+        self.needs_rows = (self.min_duration > 0) | ~np.isnan(self.rate_max)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def get(self, key: Tuple[str, str, str]):
+        """Returns the channel data using its cnr (site_id, station_id, channel_id)"""
+        i = self.index.get(key)
+        return self.channels[i] if i is not None else None
+
+
+def rows_to_arrays(rules: ChannelRules, rows: list) -> tuple:
+    """
+    Converts the readings (site, station, channel, date, value_min, value_avg, value_max) into the arrays
+    evaluated by RuleEngine: (channel positions, timestamps, value_min, value_avg, value_max, dates).
+    The readings of unknown channels are skipped.
+    """
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0), np.empty(0), []
+
+    # Every column is extracted with map/itemgetter, without a Python loop over the rows
+    positions = list(map(rules.index.get, map(itemgetter(0, 1, 2), rows)))
+    if None in positions:
+        return rows_to_arrays(rules, [r for r, p in zip(rows, positions) if p is not None])
+
+    dates = list(map(itemgetter(3), rows))
+    return (
+        np.array(positions, dtype=np.int64),
+        _timestamps(dates),
+        _float_array(list(map(itemgetter(4), rows))),
+        _float_array(list(map(itemgetter(5), rows))),
+        _float_array(list(map(itemgetter(6), rows))),
+        dates
+    )
+
+
+class RuleEngine:
+    """
+    Evaluates the alarm rules, keeping the per-channel state needed across ticks
+    (start of the running violation, last value seen for the rate of change...).
+    """
+    def __init__(self):
+        self.rules = None  # type: ChannelRules
+        self.violating_since = np.empty(0)
+        self.last_time = np.empty(0)
+        self.last_value = np.empty(0)
+        self.last_min = np.empty(0)
+        self.last_max = np.empty(0)
+        self.last_rate = np.empty(0)
+
+    def set_rules(self, rules: ChannelRules):
+        """Replaces the channel configuration, keeping the state of the channels that are still present"""
+        if rules is self.rules:
+            return
+
+        size = len(rules)
+        old_positions = self.rules.positions if self.rules is not None else {}
+        old_state = (self.violating_since, self.last_time, self.last_value, self.last_min, self.last_max, self.last_rate)
+        new_state = tuple(np.full(size, math.nan) for _ in old_state)
+
+        for channel_id, new_pos in rules.positions.items():
+            old_pos = old_positions.get(channel_id)
+            if old_pos is None:
+                continue
+            for old, new in zip(old_state, new_state):
+                new[new_pos] = old[old_pos]
+
+        self.violating_since, self.last_time, self.last_value, self.last_min, self.last_max, self.last_rate = new_state
+        self.rules = rules
+
+    def evaluate(self, idx: np.ndarray, t: np.ndarray, vmin: np.ndarray, vavg: np.ndarray, vmax: np.ndarray,
+                 dates: Optional[list] = None) -> Tuple[Dict[int, tuple], Dict[int, tuple]]:
+        """
+        Evaluates the rules over the rows read in this tick.
+        Every row is described by the channel position (idx), its timestamp in seconds (t) and its values,
+        the rows must be sorted by time.
+
+        Returns two dictionaries (min alarms and max alarms) that map the channel position to
+        the most extreme value that fired the alarm and the row index (or date, if dates is given).
+        """
+        rules = self.rules
+        if len(idx) == 0:
+            return {}, {}
+
+        # Sort the rows by channel and then by time (the rows are already sorted by time,
+        # sorting a single integer key is a lot faster than a lexsort)
+        n = len(idx)
+        order = np.argsort(idx * n + np.arange(n))
+        idx, t, vmin, vmax = idx[order], t[order], vmin[order], vmax[order]
+        vavg = vavg[order]
+        vavg = np.where(np.isnan(vavg), (vmin + vmax) / 2, vavg)
+
+        first = np.empty(n, dtype=bool)
+        first[0] = True
+        np.not_equal(idx[1:], idx[:-1], out=first[1:])
+        last = np.empty(n, dtype=bool)
+        last[-1] = True
+        last[:-1] = first[1:]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # Range rule (comparisons with NaN are always false, channels without a range never fire)
+            below = vmin <= rules.range_min[idx]
+            above = vmax >= rules.range_max[idx]
+
+            # Rate of change rule, the first row of every channel is compared with the last one of the previous tick
+            prev_value = np.empty(n)
+            prev_value[1:] = vavg[:-1]
+            prev_time = np.empty(n)
+            prev_time[1:] = t[:-1]
+            prev_value[first] = self.last_value[idx[first]]
+            prev_time[first] = self.last_time[idx[first]]
+
+            dt = t - prev_time
+            rate = np.where(dt > 0, (vavg - prev_value) / dt * 3600, math.nan)
+            rate_max = rules.rate_max[idx]
+            rising = rate > rate_max
+            falling = rate < -rate_max
+
+            violating = below | above | rising | falling
+
+            # Duration rule, find when the running violation of every row started
+            prev_violating = np.empty(n, dtype=bool)
+            prev_violating[0] = False
+            prev_violating[1:] = violating[:-1]
+            starts = violating & (first | ~prev_violating)
+
+            start_time = t.copy()
+            carried = first & violating & ~np.isnan(self.violating_since[idx])
+            start_time[carried] = self.violating_since[idx[carried]]
+
+            run_start = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+            run_start_time = start_time[run_start]
+            fired = violating & (t - run_start_time >= rules.min_duration[idx])
+
+        min_value = np.where(below, vmin, vavg)
+        max_value = np.where(above, vmax, vavg)
+        alarm_min = self._pick(idx, fired & (below | falling), min_value, order, dates, True)
+        alarm_max = self._pick(idx, fired & (above | rising), max_value, order, dates, False)
+
+        # Save the state of the last row of every channel
+        ch = idx[last]
+        self.violating_since[ch] = np.where(violating[last], run_start_time[last], math.nan)
+        self.last_time[ch] = t[last]
+        self.last_value[ch] = vavg[last]
+        self.last_min[ch] = vmin[last]
+        self.last_max[ch] = vmax[last]
+        self.last_rate[ch] = rate[last]
+
+        return alarm_min, alarm_max
+
+    @staticmethod
+    def _pick(idx, mask, values, order, dates, lowest: bool) -> Dict[int, tuple]:
+        # Select the most extreme value of every channel between the rows in mask
+        rows = np.nonzero(mask)[0]
+        if len(rows) == 0:
+            return {}
+
+        sel_values = values[rows]
+        sel_idx = idx[rows]
+        by_value = np.lexsort((sel_values if lowest else -sel_values, sel_idx))
+        channels, firsts = np.unique(sel_idx[by_value], return_index=True)
+        best = rows[by_value[firsts]]
+
+        best_values = values[best].tolist()
+        best_rows = order[best].tolist()
+        if dates is not None:
+            best_rows = [dates[r] for r in best_rows]
+        return dict(zip(channels.tolist(), zip(best_values, best_rows)))
+
+    def has_observations(self, position: int) -> bool:
+        return not math.isnan(self.last_time[position])
+
+    def check_extinguished(self, positions: List[int]) -> np.ndarray:
+        """
+        Checks, using the last values seen, if the alarms of the channels are over.
+        Hysteresis is applied: the value should be back in range by at least the channel's hysteresis.
+        """
+        rules = self.rules
+        pos = np.array(positions, dtype=np.int64)
+        h = rules.hysteresis[pos]
+        rmin, rmax = rules.range_min[pos], rules.range_max[pos]
+        rate, rate_max = self.last_rate[pos], rules.rate_max[pos]
+
+        with np.errstate(invalid="ignore"):
+            min_ok = np.isnan(rmin) | (self.last_min[pos] > rmin + h)
+            max_ok = np.isnan(rmax) | (self.last_max[pos] < rmax - h)
+            rate_ok = ~(np.abs(rate) > rate_max)
+        return min_ok & max_ok & rate_ok
@@ -0,0 +1,88 @@
+"""
+Alarm rule engine benchmark.
+
+Measures the time compare_data spends on the rows of a tick, without the database: the conversion of the rows
+(as returned by the query) into arrays (alarm_rules.rows_to_arrays) and their evaluation (RuleEngine.evaluate).
+The times are reported per 1000 channels, for every number of rows per channel.
+
+Run it from the src folder:
+    python3 -m benchmark.alarm_engine --channels 10000 --rows 1 3 10 --repeat 20
+"""
+import argparse
+import datetime
+import random
+import statistics
+import time
+from collections import namedtuple
+from typing import List
+
+from alarm import AlarmedChannelData
+from alarm_rules import ChannelRules, RuleEngine, rows_to_arrays
+
+Row = namedtuple("Row", ["site_id", "station_id", "channel_id", "date",
+                         "value_min", "value_avg", "value_max"])
+
+
+def make_rules(channels: int, firing=0.0, seed=0) -> ChannelRules:
+    """Channels with a range of 20-80, firing is the fraction with a range that every reading violates"""
+    rnd = random.Random(seed)
+    data = []
+    for i in range(channels):
+        low = 200 if rnd.random() < firing else 20
+        data.append(AlarmedChannelData(i // 10, i // 4, i, "site%i" % (i // 40), str(i // 4), str(i % 4 + 1),
+                                       low, 80 if low == 20 else 300))
+    return ChannelRules(data, [0.5] * channels, [None] * channels, [None] * channels)
+
+
+def make_rows(rules: ChannelRules, rows_per_channel: int, seed=0) -> List[Row]:
+    """Readings of every channel, one per minute, sorted by date like the query returns them"""
+    rnd = random.Random(seed)
+    start = datetime.datetime(2019, 5, 1)
+    rows = []
+    for r in range(rows_per_channel):
+        date = start + datetime.timedelta(minutes=r)
+        for c in rules.channels:
+            value = rnd.uniform(30, 70)
+            rows.append(Row(c.cnr_site_id, c.cnr_station_id, c.cnr_channel_id, date, value - 0.5, value, value + 0.5))
+    return rows
+
+
+def measure(fn, repeat: int) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench(channels: int, rows_per_channel: List[int], firing=0.0, repeat=10) -> str:
+    rules = make_rules(channels, firing)
+    lines = ["Time per 1000 channels (ms):   arrays  evaluate     total"]
+    for count in rows_per_channel:
+        rows = make_rows(rules, count)
+        engine = RuleEngine()
+        engine.set_rules(rules)
+        arrays = rows_to_arrays(rules, rows)
+
+        convert = statistics.median(measure(lambda: rows_to_arrays(rules, rows), repeat))
+        evaluate = statistics.median(measure(lambda: engine.evaluate(*arrays[:5], dates=arrays[5]), repeat))
+        scale = 1000 / channels * 1000
+        lines.append("  {:>3} rows per channel      {:8.3f}  {:8.3f}  {:8.3f}".format(
+            count, convert * scale, evaluate * scale, (convert + evaluate) * scale))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the alarm rule evaluation time of a tick")
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 3], help="Rows per channel in the tick")
+    parser.add_argument("--firing", type=float, default=0.0, help="Fraction of channels in alarm")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(bench(args.channels, args.rows, args.firing, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
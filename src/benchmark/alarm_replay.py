@@ -0,0 +1,215 @@
+"""
+Alarm engine replay/backtest harness.
+
+Runs the AlarmManager over a historical window of t_rilevamento_dati in simulated time, using a stub contacter,
+and reports the alarms fired, the ticks per second, the rows scanned and the latency of every tick phase.
+It should be used to size the alarm check interval and to catch performance regressions before deploying.
+
+Run it from the src folder:
+    python3 -m benchmark.alarm_replay --generate 1000 --start 2019-05-01T00:00:00 --end 2019-05-02T00:00:00
+    python3 -m benchmark.alarm_replay --config-db sqlite:///config.db --cnr-db sqlite:///cnr.db --start ... --end ...
+"""
+import argparse
+import datetime
+import random
+import statistics
+import time
+from typing import List, Dict
+
+import models
+from alarm import AlarmManager
+from util.db import session_scope
+
+
+class RecordingContacter:
+    """Contacter stub, it only records the alarms that would have been sent"""
+    def __init__(self):
+        self.sent = []
+
+    def send_alarms(self, alarms):
+        self.sent.extend(alarms)
+
+
+class ReplayReport:
+    def __init__(self):
+        self.ticks = 0
+        self.idle_ticks = 0
+        self.alarms_started = 0
+        self.alarms_ended = 0
+        self.still_running = 0  # Alarms started during the replay that didn't end before its end
+        self.rows_scanned = 0
+        self.wall_time = 0.0
+        self.simulated_time = datetime.timedelta()
+        self.phases = {}  # type: Dict[str, List[float]]
+
+    def add_phases(self, phases: Dict[str, float]):
+        for name, t in phases.items():
+            self.phases.setdefault(name, []).append(t)
+
+    def __str__(self):
+        lines = [
+            "Simulated {} in {:.2f}s".format(self.simulated_time, self.wall_time),
+            "Ticks: {} ({} idle), {:.1f} ticks/s".format(
+                self.ticks, self.idle_ticks, self.ticks / self.wall_time if self.wall_time > 0 else 0),
+            "Rows scanned: {}".format(self.rows_scanned),
+            "Alarms started: {}, ended: {}, still running: {}".format(
+                self.alarms_started, self.alarms_ended, self.still_running),
+            "Phase latency (ms):     mean      p95      max",
+        ]
+        for name, times in self.phases.items():
+            times = sorted(times)
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            lines.append("  {:<16} {:8.3f} {:8.3f} {:8.3f}".format(
+                name, statistics.mean(times) * 1000, p95 * 1000, times[-1] * 1000))
+        return "\n".join(lines)
+
+
+def replay(manager: AlarmManager, start: datetime.datetime, end: datetime.datetime,
+           interval: float, adaptive=False) -> ReplayReport:
+    """
+    Replays the readings between start and end, running an alarm tick every interval (simulated) seconds.
+    When adaptive is True the interval is chosen by the manager's AdaptiveTimer like it would be in production.
+    """
+    report = ReplayReport()
+    now = start
+
+    finder = manager.alarm_finder
+    finder.clock = lambda: now
+    finder.last_time = start
+    finder.rows_scanned = 0
+
+    with session_scope() as session:
+        manager.load_alarmed_channels(session)
+
+    sent_before = len(manager.contacter.sent)
+    alarmed_before = set(manager.alarmed_channels)
+    step = interval
+    manager.timer.interval = interval
+    manager.timer.current_interval = interval
+
+    wall_start = time.perf_counter()
+    while now < end:
+        now = min(now + datetime.timedelta(seconds=step), end)
+        alarmed = set(manager.alarmed_channels)
+
+        result = manager.on_timer_tick()
+
+        report.ticks += 1
+        report.add_phases(manager.last_tick_phases.phases)
+        if "compare_data" not in manager.last_tick_phases.phases:
+            report.idle_ticks += 1
+        report.alarms_ended += len(alarmed - set(manager.alarmed_channels))
+
+        if adaptive:
+            step = manager.timer.next_interval(result)
+            manager.timer.current_interval = step
+
+    report.wall_time = time.perf_counter() - wall_start
+    report.simulated_time = end - start
+    report.rows_scanned = finder.rows_scanned
+    report.alarms_started = len(manager.contacter.sent) - sent_before
+    report.still_running = len(set(manager.alarmed_channels) - alarmed_before)
+    finder.clock = datetime.datetime.now
+
+    return report
+
+
+def make_fixture(session, start: datetime.datetime, end: datetime.datetime, channels=100, channels_per_sensor=4,
+                 sensors_per_site=10, reading_interval=60.0, excursion_probability=0.001, seed=0) -> List[int]:
+    """
+    Fills the (empty) databases with a synthetic configuration and readings.
+    Every channel follows a random walk inside its range with some rare excursions outside of it.
+    Returns the ids of the created sites.
+    """
+    rnd = random.Random(seed)
+    site_ids = []
+    configs = []
+
+    sensor_count = (channels + channels_per_sensor - 1) // channels_per_sensor
+    site_count = (sensor_count + sensors_per_site - 1) // sensors_per_site
+
+    for s in range(site_count):
+        site = models.Site(name="replay site %i" % s, id_cnr="replay%i" % s)
+        session.add(site)
+        session.flush()
+        site_ids.append(site.id)
+
+        for st in range(min(sensors_per_site, sensor_count - s * sensors_per_site)):
+            sensor = models.Sensor(site_id=site.id, name="sensor %i" % st, id_cnr=str(st), enabled=True)
+            session.add(sensor)
+            session.flush()
+
+            for c in range(channels_per_sensor):
+                if len(configs) >= channels:
+                    break
+                cnr_channel = str(c + 1)  # Like the real stations, every one numbers its channels from 1
+                session.add(models.Channel(sensor_id=sensor.id, name="channel %i" % c, id_cnr=cnr_channel,
+                                           range_min=20, range_max=80))
+                configs.append((site.id_cnr, sensor.id_cnr, cnr_channel))
+    session.commit()
+
+    values = [50.0] * len(configs)
+    excursions = [0] * len(configs)
+    date = start
+    readings = []
+    while date < end:
+        for i, (site_cnr, station_cnr, channel_cnr) in enumerate(configs):
+            if excursions[i] > 0:
+                excursions[i] -= 1
+                value = 90.0
+            else:
+                if rnd.random() < excursion_probability:
+                    excursions[i] = rnd.randint(1, 10)
+                values[i] = min(75.0, max(25.0, values[i] + rnd.uniform(-1, 1)))
+                value = values[i]
+            readings.append(dict(site_id=site_cnr, room_id="1", station_id=station_cnr, sensor_id="1",
+                                 channel_id=channel_cnr, date=date,
+                                 value_min=value - 0.5, value_avg=value, value_max=value + 0.5))
+        if len(readings) > 10000:
+            session.bulk_insert_mappings(models.ReadingData, readings)
+            readings = []
+        date += datetime.timedelta(seconds=reading_interval)
+
+    session.bulk_insert_mappings(models.ReadingData, readings)
+    session.commit()
+    return site_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays historical readings through the alarm engine")
+    parser.add_argument("--config-db", default="sqlite://", help="Config database url (sqlite fixture)")
+    parser.add_argument("--cnr-db", default="sqlite://", help="CNR readings database url (sqlite fixture)")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, required=True)
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, required=True)
+    parser.add_argument("--interval", type=float, default=20.0, help="Simulated check interval (seconds)")
+    parser.add_argument("--adaptive", action="store_true", help="Use the adaptive scheduler intervals")
+    parser.add_argument("--generate", type=int, metavar="CHANNELS",
+                        help="Fill the databases with synthetic readings for this number of channels")
+    args = parser.parse_args()
+
+    from main import Main
+
+    server = Main()
+
+    def use_fixtures():
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = args.config_db
+        server.app.config['SQLALCHEMY_BINDS'] = {'cnr': args.cnr_db}
+
+    server.startup.register(use_fixtures, after="setup_flask")
+    server.setup()
+    models.db.create_all(bind="cnr")
+
+    if args.generate:
+        with session_scope() as session:
+            make_fixture(session, args.start, args.end, channels=args.generate)
+
+    manager = AlarmManager(RecordingContacter())
+    manager.timer.min_interval = server.alarm_manager.timer.min_interval
+    manager.timer.max_interval = server.alarm_manager.timer.max_interval
+    manager.timer.backoff = server.alarm_manager.timer.backoff
+
+    print(replay(manager, args.start, args.end, args.interval, adaptive=args.adaptive))
+
+
+if __name__ == '__main__':
+    main()
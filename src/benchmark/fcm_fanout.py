@@ -0,0 +1,253 @@
+"""
+Notification fan-out load benchmark.
+
+Starts a local HTTP server that emulates the FCM legacy endpoint (https://fcm.googleapis.com/fcm/send) used by
+pyfcm.FCMNotification.multiple_devices_data_message, seeds thousands of FCMUserContact rows and fires bursts of
+alarms through the Contacter, measuring the alarm-to-delivery throughput and latency.
+It should be used to size the contacter dispatch settings (workers, queue size) for the number of devices.
+
+Run it from the src folder:
+    python3 -m benchmark.fcm_fanout --devices 5000 --sites 20 --users 500 --bursts 10
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import List, Tuple
+
+import models
+from contact import Contacter
+from util.db import session_scope
+
+
+class StubFCMServer(ThreadingMixIn, HTTPServer):
+    """
+    FCM legacy endpoint stand-in, every request waits latency seconds (to emulate the network round trip)
+    and then accepts every registration id. The time and size of every request are recorded.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, port=0):
+        self.latency = latency
+        self.requests = []  # type: List[Tuple[float, int]]  # (delivery time, registration ids)
+        self.lock = threading.Lock()
+        self.delivered = threading.Condition(self.lock)
+        super().__init__(("127.0.0.1", port), StubFCMHandler)
+        threading.Thread(target=self.serve_forever, name="stub-fcm", daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/fcm/send".format(self.server_address[1])
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+    def devices_delivered(self) -> int:
+        with self.lock:
+            return sum(n for _, n in self.requests)
+
+    def wait_devices(self, count: int, timeout: float) -> bool:
+        """Waits until count devices have been notified since the last reset"""
+        deadline = time.perf_counter() + timeout
+        with self.lock:
+            while sum(n for _, n in self.requests) < count:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self.delivered.wait(remaining)
+        return True
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubFCMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real endpoint
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        ids = payload.get("registration_ids", [])
+
+        if len(ids) > 1000:
+            self.reply(400, {"error": "Too many registration ids ({})".format(len(ids))})
+            return
+
+        time.sleep(self.server.latency)
+        self.reply(200, {
+            "multicast_id": random.getrandbits(48),
+            "success": len(ids),
+            "failure": 0,
+            "canonical_ids": 0,
+            "results": [{"message_id": "0:%i" % i} for i in range(len(ids))],
+        })
+
+        with self.server.lock:
+            self.server.requests.append((time.perf_counter(), len(ids)))
+            self.server.delivered.notify_all()
+
+    def reply(self, status: int, content: dict):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FanoutReport:
+    def __init__(self):
+        self.bursts = 0
+        self.alarms = 0
+        self.devices = 0
+        self.requests = 0
+        self.max_batch = 0
+        self.timeouts = 0
+        self.wall_time = 0.0
+        self.latencies = []  # type: List[float]  # alarm to delivery of every request
+        self.burst_times = []  # type: List[float]  # alarm to delivery of the last request of every burst
+
+    def __str__(self):
+        lines = [
+            "Bursts: {} ({} alarms, {} timed out)".format(self.bursts, self.alarms, self.timeouts),
+            "Notified devices: {} in {} requests (max {} ids per request)".format(
+                self.devices, self.requests, self.max_batch),
+            "Throughput: {:.0f} devices/s".format(self.devices / self.wall_time if self.wall_time > 0 else 0),
+            "Latency (ms):           mean      p50      p95      max",
+        ]
+        for name, times in (("request", self.latencies), ("burst", self.burst_times)):
+            if not times:
+                continue
+            times = sorted(times)
+            p50 = times[len(times) // 2]
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            lines.append("  {:<16} {:8.1f} {:8.1f} {:8.1f} {:8.1f}".format(
+                name, statistics.mean(times) * 1000, p50 * 1000, p95 * 1000, times[-1] * 1000))
+        return "\n".join(lines)
+
+
+def run(contacter: Contacter, server: StubFCMServer, channels: List[Tuple[int, int]], bursts=10,
+        alarms_per_burst=5, timeout=60.0, seed=0) -> FanoutReport:
+    """
+    Fires bursts of alarms_per_burst alarms on random channels (channel_id, site_id) and waits for every device
+    to be notified before firing the next one.
+    The recipients are loaded before every burst, so the timings measure the delivery with warm caches.
+    """
+    rnd = random.Random(seed)
+    report = FanoutReport()
+
+    for _ in range(bursts):
+        burst = rnd.sample(channels, min(alarms_per_burst, len(channels)))
+        devices = set()
+        for _, site_id in burst:
+            devices.update(contacter.get_fcm_listeners(site_id))
+        contacter.get_alarm_info([channel_id for channel_id, _ in burst])
+
+        server.reset()
+        start = time.perf_counter()
+        contacter.send_alarms([(channel_id, "99.9") for channel_id, _ in burst])
+        if not server.wait_devices(len(devices), timeout):
+            report.timeouts += 1
+        end = time.perf_counter()
+
+        with server.lock:
+            requests = list(server.requests)
+        report.bursts += 1
+        report.alarms += len(burst)
+        report.devices += sum(n for _, n in requests)
+        report.requests += len(requests)
+        report.max_batch = max([report.max_batch] + [n for _, n in requests])
+        report.latencies.extend(t - start for t, _ in requests)
+        report.burst_times.append(end - start)
+        report.wall_time += end - start
+
+    return report
+
+
+def make_fixture(session, devices=5000, sites=20, users=500, sites_per_user=3, seed=0) -> Tuple[list, list]:
+    """
+    Fills the config database with sites (with a single channel each) and users that can see some random sites,
+    the devices are spread between the users.
+    Returns the created (channel_id, site_id) and the ids of the users.
+    """
+    rnd = random.Random(seed)
+    channels = []
+    for s in range(sites):
+        site = models.Site(name="fanout site %i" % s, id_cnr="fanout%i" % s)
+        session.add(site)
+        session.flush()
+        sensor = models.Sensor(site_id=site.id, name="sensor", id_cnr="1", enabled=True)
+        session.add(sensor)
+        session.flush()
+        channel = models.Channel(sensor_id=sensor.id, name="channel", id_cnr="1", measure_unit="C",
+                                 range_min=0, range_max=50)
+        session.add(channel)
+        session.flush()
+        channels.append((channel.id, site.id))
+
+    user_ids = []
+    for u in range(users):
+        user = models.User(username="fanout%i" % u, permission="U")
+        session.add(user)
+        session.flush()
+        user_ids.append(user.id)
+        for _, site_id in rnd.sample(channels, min(sites_per_user, sites)):
+            session.add(models.UserAccess(user_id=user.id, site_id=site_id))
+    session.flush()
+
+    session.bulk_insert_mappings(models.FCMUserContact, [
+        dict(registration_id="fanout-device-%i" % d, user_id=user_ids[d % users]) for d in range(devices)
+    ])
+    session.commit()
+    return channels, user_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the alarm notification fan-out to a local FCM stand-in")
+    parser.add_argument("--config-db", default="sqlite://", help="Config database url (sqlite fixture)")
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--sites-per-user", type=int, default=3)
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--alarms-per-burst", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="Contacter dispatch workers")
+    parser.add_argument("--latency", type=float, default=0.02, help="Stub FCM response time (seconds)")
+    args = parser.parse_args()
+
+    from main import Main
+
+    server = Main()
+
+    def use_fixtures():
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = args.config_db
+
+    server.startup.register(use_fixtures, after="setup_flask")
+    server.setup()
+
+    with session_scope() as session:
+        channels, _ = make_fixture(session, devices=args.devices, sites=args.sites, users=args.users,
+                                   sites_per_user=args.sites_per_user)
+
+    fcm_server = StubFCMServer(latency=args.latency)
+    contacter = server.contacter
+    contacter.load_config(fcm_api_key="benchmark", telegram_api_key=None, fcm_endpoint=fcm_server.url,
+                          dispatch={"workers": args.workers, "max_size": 100000})
+    contacter.start()
+    try:
+        print(run(contacter, fcm_server, channels, bursts=args.bursts, alarms_per_burst=args.alarms_per_burst))
+    finally:
+        contacter.stop()
+        fcm_server.stop()
+
+
+if __name__ == '__main__':
+    main()
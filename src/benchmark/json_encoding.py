@@ -0,0 +1,126 @@
+"""
+JSON serialization benchmark.
+
+Encodes a synthetic readings payload (like /api/channel/<cid>/readings returns) and a channel list with every
+available encoder, measuring the serialization time only (no database or HTTP involved):
+- stdlib-str: dates converted with strftime before json.dumps, like the API did before util.json_encoder
+- stdlib: json.dumps with util.json_encoder.encode_default (the fallback when orjson is not installed)
+- orjson: util.json_encoder.dumps with orjson (if installed)
+
+Run it from the src folder:
+    python3 -m benchmark.json_encoding --readings 100000 --repeat 10
+"""
+import argparse
+import datetime
+import json
+import random
+import statistics
+import time
+from decimal import Decimal
+from typing import Callable, Dict
+
+from util import clean_dict, date_format
+from util.json_encoder import dumps_std, orjson, dumps
+
+
+def make_readings(count: int, seed=0) -> list:
+    """Readings of a single channel, one per minute, in the format of the readings endpoint"""
+    rnd = random.Random(seed)
+    date = datetime.datetime(2019, 5, 1)
+    readings = []
+    value = 50.0
+    for _ in range(count):
+        value = min(75.0, max(25.0, value + rnd.uniform(-1, 1)))
+        readings.append(clean_dict({
+            "date": date,
+            "value_min": str(value - 0.5),
+            "value_avg": str(value),
+            "value_max": str(value + 0.5),
+            "deviation": str(rnd.random()),
+            "error": None,
+        }))
+        date += datetime.timedelta(minutes=1)
+    return readings
+
+
+def make_channels(count: int) -> list:
+    return [clean_dict({
+        "id": i,
+        "sensor_id": i // 4,
+        "id_cnr": str(i % 4),
+        "name": "channel %i" % i,
+        "measure_unit": "C",
+        "range_min": Decimal("10.0000000000"),
+        "range_max": Decimal("35.5000000000"),
+        "hysteresis": Decimal("0.5000000000"),
+        "min_duration": 60,
+        "rate_max": None,
+    }) for i in range(count)]
+
+
+def dumps_stdlib_str(obj) -> bytes:
+    # Old behaviour: every date/decimal converted to a string by hand before encoding
+    def convert(x):
+        if isinstance(x, list):
+            return [convert(y) for y in x]
+        if isinstance(x, dict):
+            return {k: convert(v) for k, v in x.items()}
+        if isinstance(x, datetime.datetime):
+            return x.strftime(date_format)
+        if isinstance(x, Decimal):
+            return str(x)
+        return x
+    return json.dumps(convert(obj)).encode()
+
+
+def get_encoders() -> Dict[str, Callable]:
+    encoders = {
+        "stdlib-str": dumps_stdlib_str,
+        "stdlib": dumps_std,
+    }
+    if orjson is not None:
+        encoders["orjson"] = dumps
+    return encoders
+
+
+def bench(payloads: Dict[str, object], repeat=10) -> str:
+    lines = ["Encoding time (ms):         mean      min     size (KB)"]
+    for payload_name, payload in payloads.items():
+        lines.append(payload_name)
+        reference = None
+        for name, encoder in get_encoders().items():
+            data = encoder(payload)
+            # Every encoder should produce the same document
+            if reference is None:
+                reference = json.loads(data.decode())
+            elif json.loads(data.decode()) != reference:
+                raise AssertionError("{} output differs from {}".format(name, "stdlib-str"))
+
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                encoder(payload)
+                times.append(time.perf_counter() - start)
+            lines.append("  {:<20} {:8.2f} {:8.2f} {:10.0f}".format(
+                name, statistics.mean(times) * 1000, min(times) * 1000, len(data) / 1024))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the JSON encoding time of big API payloads")
+    parser.add_argument("--readings", type=int, default=100000, help="Readings in the readings payload")
+    parser.add_argument("--channels", type=int, default=5000, help="Channels in the channel list payload")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed, only the stdlib encoders are measured")
+
+    print(bench({
+        "readings ({})".format(args.readings): make_readings(args.readings),
+        "channels ({})".format(args.channels): make_channels(args.channels),
+    }, repeat=args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
+import copy
+import json
 import sys
-from typing import List, Optional
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Dict
 
 import pyfcm
 from sqlalchemy.orm import Session
@@ -7,21 +11,72 @@
 import models
 import logging
 
+from telegram_sender import TelegramSender
+from util.cache import VersionedCache, channel_config_version, user_access_version, user_contact_version
+from util.dispatch import DispatchQueue
+
 session = models.db.session  # type: Session
 
+# FCM legacy API: a multicast message can have at most 1000 registration ids
+FCM_MAX_RECIPIENTS = 1000
+
 
 class Contacter:
     def __init__(self):
         self.fcm = None  # type: Optional[pyfcm.FCMNotification]
+        self.telegram = None  # type: Optional[TelegramSender]
+        self._fcm_local = threading.local()
+        # Notifications are sent in background, the alarm tick should never wait for the network
+        self.dispatcher = DispatchQueue("contacter", cleanup=session.remove)
+
+        # Caches used to send an alarm without any query
+        # ("fcm" | "telegram", site_id) -> listeners
+        self.recipients_cache = VersionedCache(user_access_version, user_contact_version)
+        self.channel_info_cache = VersionedCache(channel_config_version)  # channel_id -> names/unit
 
-    def load_config(self, fcm_api_key, telegram_api_key):
+    def load_config(self, fcm_api_key, telegram_api_key, dispatch=None, telegram=None, fcm_endpoint=None):
         if fcm_api_key is None or fcm_api_key == "":
             self.fcm = None
             logging.error("No FCM key found, disabling")
         else:
             self.fcm = pyfcm.FCMNotification(fcm_api_key)
+            if fcm_endpoint is not None:
+                # Used to send the notifications to a local stand-in (see benchmark.fcm_fanout)
+                self.fcm.FCM_END_POINT = fcm_endpoint
+
+        if self.telegram is not None:
+            self.telegram.close()
+        if telegram_api_key is None or telegram_api_key == "":
+            self.telegram = None
+            logging.error("No Telegram key found, disabling")
+        else:
+            # telegram: base_url, workers, global_rate, chat_rate, max_retries, timeout (see TelegramSender)
+            self.telegram = TelegramSender(telegram_api_key, **(telegram or {}))
+
+        if dispatch is not None:
+            self.dispatcher.configure(**dispatch)
+
+    def start(self):
+        self.dispatcher.start()
+
+    def stop(self):
+        """Sends the notifications still in the queue and stops the dispatcher"""
+        self.dispatcher.stop()
+        if self.telegram is not None:
+            self.telegram.close()
 
     def get_fcm_listeners(self, site_id) -> List[str]:
+        """Returns the FCM registration ids of the users that can see the site (cached)"""
+        return self.recipients_cache.get(session, ("fcm", site_id), lambda key: self.query_fcm_listeners(site_id))
+
+    def get_telegram_listeners(self, site_id) -> List[int]:
+        """Returns the Telegram chat ids of the users that can see the site (cached)"""
+        return self.recipients_cache.get(session, ("telegram", site_id),
+                                         lambda key: self.query_telegram_listeners(site_id))
+
+    @staticmethod
+    def query_site_users(site_id):
+        """Subquery (user_id) of the users that can see the site"""
         users = session.query(models.User.id)\
             .select_from(models.User)\
             .join(models.UserAccess, models.UserAccess.user_id == models.User.id)\
@@ -29,7 +84,10 @@ def get_fcm_listeners(self, site_id) -> List[str]:
 
         admins = session.query(models.User.id).select_from(models.User).filter(models.User.permission == "A")
 
-        users = users.union(admins).distinct().subquery()
+        return users.union(admins).distinct().subquery()
+
+    def query_fcm_listeners(self, site_id) -> List[str]:
+        users = self.query_site_users(site_id)
 
         receivers = session.query(models.FCMUserContact.registration_id)\
             .select_from(users)\
@@ -38,27 +96,151 @@ def get_fcm_listeners(self, site_id) -> List[str]:
 
         return [x[0] for x in receivers.all()]
 
-    def send_alarm(self, channel_id, unitvalue):
-        logging.warning("Sending alarm! %s %s", channel_id, unitvalue)
+    def query_telegram_listeners(self, site_id) -> List[int]:
+        users = self.query_site_users(site_id)
 
-        channel = session.query(models.Channel).filter(models.Channel.id == channel_id).one()  # type: models.Channel
-        sensor = session.query(models.Sensor).filter(models.Sensor.id == channel.sensor_id).one()  # type: models.Sensor
-        site = session.query(models.Site).filter(models.Site.id == sensor.site_id).one()  # type: models.Site
+        receivers = session.query(models.TelegramUserContact.telegram_id)\
+            .select_from(users)\
+            .join(models.TelegramUserContact, models.TelegramUserContact.user_id == users.c.user_id)\
+            .distinct()
 
-        # TODO: Add telegram
+        return [x[0] for x in receivers.all()]
+
+    def send_alarm(self, channel_id, unitvalue):
+        self.send_alarms([(channel_id, unitvalue)])
+
+    def send_alarms(self, alarms: List[Tuple[int, str]]):
+        """
+        Queues the notifications of the alarms (channel_id, value) fired in the same tick,
+        they will be delivered by the dispatcher.
+        """
+        if not alarms:
+            return
+        self.dispatcher.submit(self.deliver_alarms, alarms, description="alarms {}".format(alarms))
+
+    def get_alarm_info(self, channel_ids: List[int]) -> Dict[int, tuple]:
+        """Returns the site id, site name, sensor name, channel name and measure unit of every channel (cached)"""
+        return self.channel_info_cache.get_many(session, channel_ids, self.query_alarm_info)
+
+    def query_alarm_info(self, channel_ids: List[int]) -> Dict[int, tuple]:
+        rows = session.query(
+            models.Channel.id, models.Site.id, models.Site.name, models.Sensor.name,
+            models.Channel.name, models.Channel.measure_unit
+        )\
+            .select_from(models.Channel)\
+            .join(models.Sensor, models.Sensor.id == models.Channel.sensor_id)\
+            .join(models.Site, models.Site.id == models.Sensor.site_id)\
+            .filter(models.Channel.id.in_(channel_ids))\
+            .all()
+        return {x[0]: tuple(x[1:]) for x in rows}
+
+    def deliver_alarms(self, alarms: List[Tuple[int, str]]):
+        logging.warning("Sending alarms! %s", alarms)
+
+        if self.fcm is None and self.telegram is None:
+            logging.warning("FCM and Telegram disabled, skipping alarm notification")
+            return
+
+        info = self.get_alarm_info([channel_id for channel_id, _ in alarms])
+
+        # Group the alarms by site
+        site_alarms = OrderedDict()  # type: Dict[int, List[dict]]
+        for channel_id, unitvalue in alarms:
+            if channel_id not in info:
+                logging.warning("Cannot send alarm for channel %s, channel not found", channel_id)
+                continue
+            site_id, site_name, sensor_name, channel_name, measure_unit = info[channel_id]
+            site_alarms.setdefault(site_id, []).append({
+                "site_name": site_name,
+                "sensor_name": sensor_name,
+                "channel_name": channel_name,
+                "value": "{} {}".format(unitvalue, measure_unit),
+            })
 
         if self.fcm is not None:
-            listeners = self.get_fcm_listeners(site.id)
+            self.deliver_fcm(site_alarms)
+        if self.telegram is not None:
+            self.deliver_telegram(site_alarms)
+
+    @staticmethod
+    def group_listeners(site_ids, get_listeners) -> Dict[Tuple[int, ...], list]:
+        """
+        Every listener gets a single message with the alarms of all the sites it listens to,
+        listeners of the same sites share the same message. Returns sites -> listeners
+        """
+        listener_sites = OrderedDict()
+        for site_id in site_ids:
+            for listener in get_listeners(site_id):
+                listener_sites[listener] = listener_sites.get(listener, ()) + (site_id,)
+
+        messages = OrderedDict()  # type: Dict[Tuple[int, ...], list]
+        for listener, sites in listener_sites.items():
+            messages.setdefault(sites, []).append(listener)
+        return messages
+
+    def deliver_fcm(self, site_alarms: Dict[int, List[dict]]):
+        # Devices that listen to the same sites share the same FCM multicast,
+        # split in batches of FCM_MAX_RECIPIENTS: every batch is sent (and retried) on its own
+        for sites, listeners in self.group_listeners(site_alarms.keys(), self.get_fcm_listeners).items():
+            data_message = self.build_alarm_message([a for site_id in sites for a in site_alarms[site_id]])
             logging.info("Sending FCM alarm to %d devices", len(listeners))
-
-            data_message = {
-                "type": "sensor_range_alarm",
-                "site_name": site.name,
-                "sensor_name": sensor.name,
-                "channel_name": channel.name,
-                "value":  "{} {}".format(unitvalue, channel.measure_unit)
-            }
-
-            self.fcm.multiple_devices_data_message(registration_ids=listeners, data_message=data_message)
-        else:
-            logging.warning("FCM disabled, skipping alarm notification")
+            for i in range(0, len(listeners), FCM_MAX_RECIPIENTS):
+                batch = listeners[i:i + FCM_MAX_RECIPIENTS]
+                self.dispatcher.submit(self.send_fcm, batch, data_message,
+                                       description="fcm {} to {} devices".format(data_message, len(batch)))
+
+    def deliver_telegram(self, site_alarms: Dict[int, List[dict]]):
+        messages = []
+        for sites, chats in self.group_listeners(site_alarms.keys(), self.get_telegram_listeners).items():
+            text = self.build_alarm_text([a for site_id in sites for a in site_alarms[site_id]])
+            messages.extend((chat_id, text) for chat_id in chats)
+
+        if messages:
+            logging.info("Sending Telegram alarm to %d chats", len(messages))
+            # The whole burst is a single job, TelegramSender spreads it over its own workers
+            self.dispatcher.submit(self.send_telegram, messages,
+                                   description="telegram alarm to {} chats".format(len(messages)))
+
+    @staticmethod
+    def build_alarm_message(alarms: List[dict]) -> dict:
+        if len(alarms) == 1:
+            message = {"type": "sensor_range_alarm"}
+            message.update(alarms[0])
+            return message
+
+        # FCM data messages only support string values
+        return {
+            "type": "sensor_range_alarm_summary",
+            "count": str(len(alarms)),
+            "alarms": json.dumps(alarms),
+        }
+
+    @staticmethod
+    def build_alarm_text(alarms: List[dict]) -> str:
+        lines = ["Alarm!" if len(alarms) == 1 else "{} alarms!".format(len(alarms))]
+        for a in alarms:
+            lines.append("{site_name} - {sensor_name} - {channel_name}: {value}".format(**a))
+        return "\n".join(lines)
+
+    def get_fcm_client(self):
+        """
+        Returns the FCM client of the current thread.
+        FCMNotification keeps the responses of the last request in the instance, so the dispatcher workers can't
+        share it: every thread uses a shallow copy (sharing the connection pool of the original).
+        """
+        local = self._fcm_local
+        if getattr(local, "source", None) is not self.fcm:
+            local.source = self.fcm
+            local.client = copy.copy(self.fcm)
+        return local.client
+
+    def send_fcm(self, registration_ids: List[str], data_message: dict):
+        self.get_fcm_client().multiple_devices_data_message(registration_ids=registration_ids,
+                                                            data_message=data_message)
+
+    def send_telegram(self, messages: List[Tuple[int, str]]):
+        failed = self.telegram.send_messages(messages)
+        if failed:
+            # Only the failed messages are retried by the dispatcher (it calls the job again with the same list)
+            messages[:] = failed
+            raise IOError("Cannot send {} Telegram messages".format(len(failed)))
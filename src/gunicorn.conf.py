@@ -0,0 +1,6 @@
+# Gunicorn settings (run_production.sh)
+# The workers must be threaded: a login waits for the password hasher pool (see util.password) and with sync workers
+# it would block the whole process. auth.password_hashing.max_pending should stay lower than threads.
+bind = "0.0.0.0:8080"
+worker_class = "gthread"
+threads = 8
@@ -1,21 +1,38 @@
+import atexit
 import json
 import logging
 import logging.config
 from pathlib import Path
+from typing import List
 
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import util
 from alarm import AlarmManager
 from contact import Contacter
-from models import db, User
-from rest_controller import api, site_image
+from models import db, User, Site, UserAccess, Sensor, Channel
+from rest_controller import api, site_image, set_signing_keys, configure_tokens, configure_login, password_hasher
+from util.cache import user_credentials_version
+from util.compression import CompressionMiddleware
 from util.db import session_scope
+from util.signing import load_keys_file
 from util.dependency import DependencyManager
-from util.logging import fix_add_parent_mkdir_on_log_write
+from util.logging import fix_add_parent_mkdir_on_log_write, install_async_handlers, SlowQueryLog
+from util.metrics import instrument_app, instrument_engine
 
 import logging.handlers
 
+# Columns added to the tables of the first release, create_all doesn't add them to the existing databases
+ADDED_COLUMNS = [
+    (Site, ["version"]),
+    (UserAccess, ["version"]),
+    (Sensor, ["version"]),
+    (Channel, ["hysteresis", "min_duration", "rate_max", "version"]),
+]
+# Tables of the first release that gained indexes (ex: the site list filters)
+ADDED_INDEXES = [Site]
+
 CONFIG_PATHS = ["config.json", "../config.json", "~/.old_musa_server/config.json"]
 
 
@@ -26,15 +43,21 @@ def __init__(self):
         self.contacter = Contacter()
         self.alarm_manager = AlarmManager(self.contacter)
         self.app = None  # type: Flask
+        self.log_listeners = []  # type: List[logging.handlers.QueueListener]
         self.startup = DependencyManager()
         self.startup.register_all(
             self.load_config,
+            self.apply_config,
             self.setup_patch_fixes,
             self.setup_flask,
             self.setup_db,
+            self.setup_metrics,
+            self.setup_sql_log,
             self.setup_root_password,
             self.setup_flask_routes,
-            self.setup_flask_routes_api
+            self.setup_flask_routes_api,
+            self.setup_compression,
+            self.setup_proxy_fix
         )
 
     def find_config_file(self):
@@ -48,6 +71,8 @@ def load_logging(self):
         fix_add_parent_mkdir_on_log_write()
 
         logging.config.dictConfig(self.config["log_settings"])
+        # File I/O off the request threads
+        self.log_listeners = install_async_handlers(self.config.get("async_log_handlers", []))
 
     def load_config(self):
         config_path = self.find_config_file()
@@ -56,18 +81,33 @@ def load_config(self):
         with config_path.open("rt") as f:
             self.config = json.load(f)
 
-        # Apply config to who needs it
         self.load_logging()
         logging.info("LOGGING TEST")
 
+    def apply_config(self):
+        # Apply config to who needs it
         vardata_path = Path(self.config["vardata_folder"])
 
         site_image.set_storage_dir(vardata_path / "images")
         self.alarm_manager.load_config(
             vardata_path,
-            check_interval=self.config["alarm_check_interval"]
+            check_interval=self.config["alarm_check_interval"],
+            **self.config.get("alarm_scheduler", {})
         )
         self.contacter.load_config(**self.config["contacter"])
+        self.load_auth(vardata_path)
+
+    def load_auth(self, vardata_path: Path):
+        auth = self.config.get("auth", {})
+
+        # The keys are shared by every worker: from the config or from a file created on the first start
+        keys = auth.get("signing_keys")
+        if not keys:
+            keys = load_keys_file(Path(auth.get("signing_keys_file") or vardata_path / "signing_keys"))
+        set_signing_keys(keys)
+        configure_tokens(auth.get("stateless_tokens", False), auth.get("token_lifetime"))
+        configure_login(auth.get("username_attempts_per_minute"), auth.get("address_attempts_per_minute"),
+                        auth.get("password_hashing"))
 
     def setup_root_password(self):
         root_psw = self.config["root_password"]
@@ -83,6 +123,8 @@ def setup_root_password(self):
                 session.add(root)
 
             root.hash_password(root_psw)
+            # Tokens issued before the new password are rejected by the other processes too
+            user_credentials_version.bump(session)
 
     def setup_patch_fixes(self):
         util.install_sqlite3_foreign_fix()
@@ -107,6 +149,24 @@ def setup_flask_routes_api(self):
         api.app = self.app
         api.init_app(self.app)
 
+    def setup_compression(self):
+        compression = self.config.get("compression", {})
+        if not compression.get("enabled", False):
+            return
+        self.app.wsgi_app = CompressionMiddleware(
+            self.app.wsgi_app,
+            min_size=compression.get("min_size", 1024),
+            level=compression.get("level", 6)
+        )
+
+    def setup_proxy_fix(self):
+        # Reverse proxies in front of the server, their X-Forwarded-* headers are trusted (ex: for the login throttling)
+        proxy_fix = self.config.get("proxy_fix", {})
+        hops = {key: proxy_fix.get(key, 0) for key in ("x_for", "x_proto", "x_host", "x_port", "x_prefix")}
+        if not any(hops.values()):
+            return
+        self.app.wsgi_app = ProxyFix(self.app.wsgi_app, **hops)
+
     def setup_db(self):
         # Init db definitions
         db.app = self.app
@@ -118,6 +178,33 @@ def setup_db(self):
         # Create all tables
         db.create_all(bind=None)
 
+        # Upgrade the tables created by older versions
+        engine = db.get_engine(self.app)
+        for model, columns in ADDED_COLUMNS:
+            util.add_missing_columns(engine, model.__table__, columns)
+        for model in ADDED_INDEXES:
+            util.add_missing_indexes(engine, model.__table__)
+
+    def setup_metrics(self):
+        if not self.config.get("metrics", {}).get("enabled", True):
+            return
+        instrument_app(self.app)
+        instrument_engine(db.get_engine(self.app), "config")
+        instrument_engine(db.get_engine(self.app, "cnr"), "cnr")
+
+    def setup_sql_log(self):
+        sql_log = self.config.get("sql_log", {})
+        if not sql_log.get("enabled", False):
+            return
+        slow_log = SlowQueryLog(
+            threshold=sql_log.get("slow_threshold", 0.1),
+            sample_rate=sql_log.get("sample_rate", 0.0),
+            log_params=sql_log.get("log_params", True),
+            max_params_length=sql_log.get("max_params_length", 1000),
+        )
+        slow_log.install(db.get_engine(self.app), "config")
+        slow_log.install(db.get_engine(self.app, "cnr"), "cnr")
+
     def setup(self):
         if self.__setup_done:
             return
@@ -130,11 +217,23 @@ def setup(self):
     def start(self, run_app=True):
         self.setup()
 
+        self.contacter.start()
         self.alarm_manager.start()
+        atexit.register(self.stop)
 
         if run_app:
             self.app.run(host="0.0.0.0", port=8080, debug=True, use_reloader=False)
 
+    def stop(self):
+        self.alarm_manager.timer.stop()
+        # Drain the notifications still in the queue
+        self.contacter.stop()
+        password_hasher.stop()
+        # Write the log records still in the queues
+        for listener in self.log_listeners:
+            listener.stop()
+        self.log_listeners = []
+
 
 if __name__ == '__main__':
     main = Main()
@@ -23,7 +23,9 @@ class User(db.Model):
     sites = db.relationship("Site", secondary="user_access")
 
     def hash_password(self, password):
-        phash = pwd_context.hash(password)
+        self.set_password_hash(pwd_context.hash(password))
+
+    def set_password_hash(self, phash):
         if phash == self.last_password_change:
             return
         self.password_hash = phash
@@ -42,8 +44,9 @@ def to_dict(self):
 
 class Site(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(100))
-    id_cnr = db.Column(db.String(50))
+    name = db.Column(db.String(100), index=True)
+    id_cnr = db.Column(db.String(50), index=True)
+    version = db.Column(db.BIGINT, nullable=False, default=0, index=True)  # Last change (see sync)
 
     sensors = db.relationship("Sensor")
 
@@ -58,6 +61,7 @@ def to_dict(self):
 class UserAccess(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"), primary_key=True, index=True)
     site_id = db.Column(db.Integer, db.ForeignKey(Site.id, ondelete="CASCADE"), primary_key=True)
+    version = db.Column(db.BIGINT, nullable=False, default=0, index=True)
 
     def to_dict(self):
         return {
@@ -78,6 +82,7 @@ class Sensor(db.Model):
 
     enabled = db.Column(db.Boolean, nullable=False, default=False)
     status = db.Column(db.String(100), nullable=False, default="ok")
+    version = db.Column(db.BIGINT, nullable=False, default=0, index=True)
 
     channels = db.relationship("Channel")
 
@@ -105,6 +110,13 @@ class Channel(db.Model):
     range_min = db.Column(db.Numeric)
     range_max = db.Column(db.Numeric)
 
+    # Alarm rules (see alarm_rules)
+    hysteresis = db.Column(db.Numeric)
+    min_duration = db.Column(db.Integer)  # seconds
+    rate_max = db.Column(db.Numeric)  # measure units per hour
+
+    version = db.Column(db.BIGINT, nullable=False, default=0, index=True)
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -112,11 +124,31 @@ def to_dict(self):
             "id_cnr": self.id_cnr,
             "name": self.name,
             "measure_unit": self.measure_unit,
-            "range_min": str(self.range_min) if self.range_min is not None else None,
-            "range_max": str(self.range_max) if self.range_max is not None else None,
+            "range_min": self.range_min,
+            "range_max": self.range_max,
+            "hysteresis": self.hysteresis,
+            "min_duration": self.min_duration,
+            "rate_max": self.rate_max,
         }
 
 
+# Channels that are currently in alarm, kept up to date by the AlarmManager
+# Every alarm start/end inserts/deletes a single row (in the same transaction of the alarm tick)
+class AlarmedChannel(db.Model):
+    channel_id = db.Column(db.Integer, db.ForeignKey(Channel.id, ondelete="CASCADE"), primary_key=True)
+    sensor_id = db.Column(db.Integer, nullable=False, index=True)
+    site_id = db.Column(db.Integer, nullable=False)
+
+    cnr_site_id = db.Column(db.String(50))
+    cnr_station_id = db.Column(db.String(50))
+    cnr_channel_id = db.Column(db.String(50))
+
+    range_min = db.Column(db.Numeric)
+    range_max = db.Column(db.Numeric)
+
+    start_date = db.Column(db.DateTime)
+
+
 class FCMUserContact(db.Model):
     registration_id = db.Column(db.String(255, collation="utf8_binary"), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"), index=True)
@@ -127,6 +159,24 @@ class TelegramUserContact(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"), index=True)
 
 
+# Rows of the synced configuration (sites, sensors, channels and accesses) deleted, see sync
+# kind: site, sensor, channel or access (access of user_id to site_id)
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(10), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    site_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer)
+    version = db.Column(db.BIGINT, nullable=False, index=True)
+
+
+# Version counters shared by every process (see util.cache.SharedVersion)
+# They're bumped every time the data they describe changes, invalidating the in-memory caches
+class ConfigVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BIGINT, nullable=False, default=0)
+
+
 # CNR readings table
 # It stores all the channel readings
 # It's in a different database (hence the bind_key)
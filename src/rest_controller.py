@@ -1,29 +1,32 @@
+import hashlib
+import math
 from datetime import datetime
 from functools import wraps
-from typing import TypeVar, Type
+from typing import TypeVar, Type, FrozenSet, List, Callable, Any
 
-from flask import send_file, request, g
+from flask import send_file, request, g, make_response, current_app, Response
 from flask_restful import Api, Resource
 from flask_restful.reqparse import RequestParser
-from itsdangerous import SignatureExpired, BadSignature, JSONWebSignatureSerializer
-from sqlalchemy import Column, ForeignKey, Table
+from itsdangerous import SignatureExpired, BadSignature
+from sqlalchemy import Column, ForeignKey, Table, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
+from sqlalchemy.orm import Session, subqueryload
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import BadRequest, NotFound, Unauthorized, TooManyRequests, ServiceUnavailable, \
+    HTTPException
+from werkzeug.urls import url_encode
 
 import site_image as image
+import sync
 from models import Site, Channel, Sensor, db, User, UserAccess, ReadingData, FCMUserContact, TelegramUserContact
-from util import clean_dict, parse_date, date_format, get_unix_time
-
-# The secrets module was added only in python 3.6
-# If it isn't present we can use urandom from the os module
-try:
-    from secrets import token_hex
-except ImportError:
-    from os import urandom
-
-    def token_hex(nbytes=None):
-        return urandom(nbytes).hex()
+from util import clean_dict, parse_date, get_unix_time
+from util.cache import VersionedCache, channel_config_version, user_access_version, user_contact_version, \
+    user_credentials_version
+from util.json_encoder import dumps as json_dumps, dumps_std as json_dumps_std
+from util.metrics import registry as metrics_registry
+from util.password import PasswordHasher, HasherBusy
+from util.ratelimit import KeyedTokenBuckets
+from util.signing import KeyRingSerializer, token_hex
 
 # This is the rest controller, it controls every query/update done trough rest (everything in the /api/* site section)
 
@@ -35,11 +38,32 @@ def token_hex(nbytes=None):
 api.prefix = "/api"
 
 
-secret_key = token_hex(32)
-passw_serializer = JSONWebSignatureSerializer(secret_key)
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """Encodes the responses with the fastest encoder available (datetimes and decimals included, see json_encoder)"""
+    body = json_dumps_std(data, indent=4) if current_app.debug else json_dumps(data)
+    response = make_response(body + b"\n", code)
+    response.headers.extend(headers or {})
+    response.mimetype = "application/json"
+    return response
+
+
+# Until the configured keys are loaded (see set_signing_keys) tokens are signed with a random per-process key
+passw_serializer = KeyRingSerializer([token_hex(32)])
 
 site_image = image.ImageManager()
 
+# Shared versions that should be bumped every time a resource of the model is created, updated or deleted
+model_versions = {
+    Site: [channel_config_version, user_access_version],
+    Sensor: [channel_config_version],
+    Channel: [channel_config_version],
+    User: [user_access_version, user_contact_version, user_credentials_version],
+    UserAccess: [user_access_version],
+    FCMUserContact: [user_contact_version],
+    TelegramUserContact: [user_contact_version],
+}
+
 
 # ---------------- Utility methods ----------------
 # Utility methods used to automate the creation and query of resources
@@ -72,6 +96,47 @@ def rest_get(clazz: Type[T], res_id: int) -> T:
     return resource
 
 
+def rest_get_version(clazz: Type[T], res_id: int) -> int:
+    """
+    Like rest_get but it only returns the version of the resource (see sync),
+    used to answer the conditional requests without loading the resource.
+    """
+    columns = [clazz.version] + ([clazz.site_id] if hasattr(clazz, "site_id") else [])
+    row = session.query(*columns).filter(clazz.id == res_id).first()
+    if row is None or (len(row) > 1 and not check_site_visible(row[1])):
+        raise NotFound("Cannot find %s '%s'" % (clazz.__name__, str(res_id)))
+    return row[0]
+
+
+def list_state(clazz: Type[T], *criteria) -> tuple:
+    """
+    Returns the number of rows and the highest version between the rows that match the criteria:
+    every create, update or delete changes it, so it can be used to build the ETag of a list.
+    """
+    return tuple(session.query(func.count(clazz.id), func.max(clazz.version)).filter(*criteria).one())
+
+
+def rest_etag(*state) -> str:
+    """ETag of the current request, built from the state (ex: row versions) that its response depends on"""
+    return hashlib.sha1(repr((request.full_path,) + state).encode()).hexdigest()
+
+
+def conditional_response(etag: str, make_data: Callable[[], Any]):
+    """
+    Answers 304 Not Modified if the client already has this version of the resource (If-None-Match),
+    otherwise returns the data built by make_data.
+    The response depends on the user that sent the request, so the caches should also vary on the Token.
+    The comparison is weak since the compressed responses have a weak ETag (see util.compression).
+    """
+    headers = {"ETag": '"%s"' % etag, "Vary": "Token"}
+    if request.if_none_match.contains_weak(etag):
+        return None, 304, headers
+    data = make_data()
+    if g.get("next_page") is not None:
+        headers["Link"] = g.next_page
+    return data, 200, headers
+
+
 def rest_create(clazz: Type[T], args: dict) -> T:
     """
     Creates a resource using it's model definition and the arguments expressed as field: value.
@@ -96,6 +161,7 @@ def rest_create(clazz: Type[T], args: dict) -> T:
 
     obj = clazz(**args)
     session.add(obj)
+    bump_model_versions(clazz)
     session.commit()
     return obj
 
@@ -132,6 +198,7 @@ def rest_update(res_id, args: dict, res_class: Type[T], empty_throw=True, commit
     if not update and empty_throw:
         raise BadRequest('No data in update (did you forget to send a json?)')
     else:
+        update.update(sync.stamp(session, res_class))
         res = session.query(res_class) \
             .filter(res_class.id == res_id) \
             .update(update)
@@ -139,14 +206,268 @@ def rest_update(res_id, args: dict, res_class: Type[T], empty_throw=True, commit
         if res == 0:
             raise NotFound("Cannot find {} with id {}".format(res_class.__tablename__, res_id))
 
+        bump_model_versions(res_class)
+
         if commit:
             session.commit()
 
     return rest_get(res_class, res_id)
 
 
+# Max number of resources created or updated in a single batch request
+MAX_BATCH_SIZE = 1000
+
+
+class ItemRequest:
+    """Request stand-in used to validate a single item of a batch with a RequestParser"""
+    def __init__(self, item: dict):
+        self.json = item
+        self.values = MultiDict()
+        self.args = MultiDict()
+        self.headers = {}
+
+
+def batch_error(e: HTTPException) -> dict:
+    data = getattr(e, "data", None) or {}
+    return {"status": e.code, "message": data.get("message", e.description)}
+
+
+def rest_batch(clazz: Type[T], parser: RequestParser, parent: Column, items) -> list:
+    """
+    Creates (items without an id) or updates (items with an id) many resources in a single transaction.
+    Every item is validated using the parser, the foreign keys are checked using a single query per referenced table
+    and the rows are written using bulk inserts/updates.
+    The invalid items are skipped, the result of every item is returned in the same order:
+    {"status": 201 | 200, "data": resource} or {"status": 4XX, "message": error}
+
+    :param clazz: The resource model definition, it must be synced (see sync.SYNC_MODELS)
+    :param parser: The parser of the resource fields (the parent foreign key excluded)
+    :param parent: The parent foreign key, required to create a resource and immutable
+    :param items: The json items of the request
+    """
+    if not isinstance(items, list):
+        raise BadRequest("Expected a list of {}".format(clazz.__tablename__))
+    if len(items) > MAX_BATCH_SIZE:
+        raise BadRequest("Too many items, the max is {}".format(MAX_BATCH_SIZE))
+
+    results = [None] * len(items)
+    parsed = {}  # item index -> (id, args)
+
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"status": 400, "message": "Expected an object"}
+            continue
+
+        fields = {k: v for k, v in item.items() if k not in ("id", parent.key)}
+        try:
+            args = parser.parse_args(req=ItemRequest(fields), strict=True)
+        except HTTPException as e:
+            results[i] = batch_error(e)
+            continue
+
+        try:
+            res_id = None if item.get("id") is None else int(item["id"])
+            parent_id = None if item.get(parent.key) is None else int(item[parent.key])
+        except (TypeError, ValueError):
+            results[i] = {"status": 400, "message": "Invalid id"}
+            continue
+
+        if res_id is None:
+            if parent_id is None:
+                results[i] = {"status": 400, "message": "Missing {}".format(parent.key)}
+                continue
+            args[parent.key] = parent_id
+        else:
+            if parent.key in item:
+                results[i] = {"status": 400, "message": "{} cannot be changed".format(parent.key)}
+                continue
+            args = {k: v for k, v in args.items() if v is not None}
+            if not args:
+                results[i] = {"status": 400, "message": "No data in update"}
+                continue
+        parsed[i] = (res_id, args)
+
+    # Foreign keys: a single query for every referenced column
+    for key in {k for _, args in parsed.values() for k in args}:
+        for fk in getattr(clazz, key).foreign_keys:
+            values = {args[key] for _, args in parsed.values() if args.get(key) is not None}
+            found = {x[0] for x in session.query(fk.column).filter(fk.column.in_(values)).all()}
+            for i, (_, args) in list(parsed.items()):
+                if args.get(key) is not None and args[key] not in found:
+                    results[i] = {"status": 404, "message": "Cannot find %s: '%s'" % (fk.column.table.name, args[key])}
+                    del parsed[i]
+
+    update_ids = {res_id for res_id, _ in parsed.values() if res_id is not None}
+    existing = {x[0] for x in session.query(clazz.id).filter(clazz.id.in_(update_ids)).all()} if update_ids else set()
+
+    inserts, updates = [], []
+    for i, (res_id, args) in parsed.items():
+        if res_id is None:
+            inserts.append((i, args))
+        elif res_id in existing:
+            updates.append((i, dict(args, id=res_id)))
+        else:
+            results[i] = {"status": 404, "message": "Cannot find {} with id {}".format(clazz.__tablename__, res_id)}
+
+    if inserts or updates:
+        stamp = sync.stamp(session, clazz)
+        version = {column.key: value for column, value in stamp.items()}
+        for _, row in inserts + updates:
+            row.update(version)
+        # A single executemany, asking for the new ids (return_defaults) would insert the rows one by one
+        session.bulk_insert_mappings(clazz, [row for _, row in inserts])
+        session.bulk_update_mappings(clazz, [row for _, row in updates])
+        bump_model_versions(clazz)
+
+        # Every row written by the batch (and only them) has the new version, the inserted ones in insertion order
+        resources = session.query(clazz).filter(*[column == value for column, value in stamp.items()])\
+            .order_by(clazz.id).all()
+        updated = {row["id"] for _, row in updates}
+        inserted = [x for x in resources if x.id not in updated]
+        resources = {x.id: x for x in resources}
+        for (i, _), resource in zip(inserts, inserted):
+            results[i] = {"status": 201, "data": clean_dict(resource.to_dict())}
+        for i, row in updates:
+            results[i] = {"status": 200, "data": clean_dict(resources[row["id"]].to_dict())}
+        session.commit()
+
+    return results
+
+
+def bump_model_versions(clazz: Type[T]):
+    """Invalidates the caches that depend on the model (the change is seen by others once the session is committed)"""
+    for version in model_versions.get(clazz, []):
+        version.bump(session)
+
+
 # ---------------- Auth methods ----------------
 
+def set_signing_keys(keys: List[str]):
+    """
+    Sets the keys used to sign and verify the auth tokens, the first one signs the new tokens.
+    Every process (and node) should share the same keys, so the tokens are valid on all of them.
+    """
+    passw_serializer.set_keys(keys)
+
+
+# Stateless tokens carry the user's permission, name, credential version and expiry (see generate_auth_token)
+token_settings = {
+    "stateless": False,
+    "lifetime": 7 * 24 * 3600,  # seconds, only for stateless tokens
+}
+
+
+def configure_tokens(stateless_tokens=False, token_lifetime=None):
+    token_settings["stateless"] = stateless_tokens
+    if token_lifetime is not None:
+        token_settings["lifetime"] = token_lifetime
+
+
+# Password hashes are computed out of the request workers, in a bounded process pool
+password_hasher = PasswordHasher()
+
+# Login attempts allowed every minute for the same username and from the same address
+username_attempts = KeyedTokenBuckets(5 / 60, capacity=5)
+address_attempts = KeyedTokenBuckets(30 / 60, capacity=30)
+
+
+def configure_login(username_per_minute=None, address_per_minute=None, password_hashing=None):
+    global username_attempts, address_attempts
+    if username_per_minute is not None:
+        username_attempts = KeyedTokenBuckets(username_per_minute / 60, capacity=username_per_minute)
+    if address_per_minute is not None:
+        address_attempts = KeyedTokenBuckets(address_per_minute / 60, capacity=address_per_minute)
+    if password_hashing is not None:
+        # workers, max_pending, timeout (see PasswordHasher)
+        password_hasher.configure(**password_hashing)
+
+
+def throttle_login(username: str, address: str):
+    """
+    Throws TooManyRequests (429) if there have been too many login attempts from the address
+    or too many failed attempts for the username (see login_failed).
+    """
+    wait = max(address_attempts.try_acquire(address), username_attempts.wait_time(username))
+    if wait > 0:
+        raise TooManyRequests("Too many login attempts", retry_after=math.ceil(wait))
+
+
+def login_failed(username: str):
+    # Only the failures count for the username, or anyone could lock a user out by trying to log in as them
+    username_attempts.try_acquire(username)
+
+
+def hash_password(password: str) -> str:
+    try:
+        return password_hasher.hash(password)
+    except HasherBusy:
+        raise ServiceUnavailable("Server busy, retry later", retry_after=1)
+
+
+class AuthUser:
+    """
+    The authenticated user of a request (g.user), built from the cached credentials.
+    Only the fields needed to check the permissions are present, query the User if you need anything else.
+    """
+    __slots__ = ("id", "username", "permission", "last_password_change")
+
+    def __init__(self, id, username, permission, last_password_change):
+        self.id = id
+        self.username = username
+        self.permission = permission
+        self.last_password_change = last_password_change
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "permission": self.permission,
+        }
+
+
+# user id -> AuthUser (or None if the user does not exist), checked on every authenticated request
+credentials_cache = VersionedCache(user_credentials_version)
+
+
+def query_credentials(user_id):
+    row = session.query(User.id, User.username, User.permission, User.last_password_change)\
+        .filter(User.id == user_id)\
+        .first()
+    return AuthUser(*row) if row is not None else None
+
+
+# Every user id -> (credential version, permission, username), used to revoke stateless tokens.
+# The credential version is the last password change, the whole map is reloaded when user_credentials is bumped
+# (that is checked at most every few seconds, see SharedVersion)
+credential_versions_cache = VersionedCache(user_credentials_version)
+
+
+def query_credential_versions(key) -> dict:
+    rows = session.query(User.id, User.last_password_change, User.permission, User.username).all()
+    return {x[0]: tuple(x[1:]) for x in rows}
+
+
+def check_stateless_token(data: dict):
+    """Checks the claims of a stateless token, the User table is never queried for a single token"""
+    try:
+        user_id = int(data["id"])
+        expiry = int(data["exp"])
+        credential_version = int(data["cv"])
+        permission = data["perm"]
+    except (KeyError, ValueError, TypeError):
+        return None
+
+    if expiry < get_unix_time():
+        return None  # Token expired
+
+    current = credential_versions_cache.get(session, "users", query_credential_versions).get(user_id)
+    # The user was deleted, changed password or permission after the token was generated
+    if current is None or current[0] != credential_version or current[1] != permission:
+        return None
+
+    return AuthUser(user_id, current[2], permission, credential_version)
+
+
 def check_auth_token(token):
     """Check whether the token is valid"""
 
@@ -162,6 +483,12 @@ def check_auth_token(token):
     # is required to encode and decode the token) so we can confirm the authentication
     # We should also check that the token is generated after the last password change (using the timestamp)
 
+    if not isinstance(data, dict):
+        return None
+
+    if "exp" in data:
+        return check_stateless_token(data)
+
     if 'date' not in data:
         return None  # No date found in token
 
@@ -170,7 +497,13 @@ def check_auth_token(token):
     except ValueError:
         return None  # Invalid timestamp
 
-    user = session.query(User).filter(User.id == data["id"]).first()
+    try:
+        user_id = int(data["id"])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+    # Password changes, user updates and deletions bump user_credentials invalidating the cache
+    user = credentials_cache.get(session, user_id, query_credentials)
 
     # If the user is deleted return None
     if user is None: return None
@@ -198,9 +531,20 @@ def verify_password(req=None):
 
 
 def generate_auth_token(user: User) -> bytes:
+    now = get_unix_time()
+    if not token_settings["stateless"]:
+        return passw_serializer.dumps({
+            "id": user.id,
+            "date": now,
+        })
+
     return passw_serializer.dumps({
         "id": user.id,
-        "date": get_unix_time(),
+        "date": now,
+        "name": user.username,
+        "perm": user.permission,
+        "cv": user.last_password_change,
+        "exp": now + token_settings["lifetime"],
     })
 
 
@@ -225,14 +569,29 @@ def decorator(*args, **kwargs):
     return login_required(decorator)
 
 
+# user id -> ids of the sites that the user can see (not used for admins, they can see every site)
+visible_sites_cache = VersionedCache(user_access_version)
+
+
+def query_visible_sites(user_id) -> FrozenSet[int]:
+    return frozenset(x[0] for x in session.query(UserAccess.site_id).filter(UserAccess.user_id == user_id).all())
+
+
+def get_visible_sites() -> FrozenSet[int]:
+    """Returns the ids of the sites visible to the current (non-admin) user, computed once per request"""
+    if "visible_sites" not in g:
+        g.visible_sites = visible_sites_cache.get(session, g.user.id, query_visible_sites)
+    return g.visible_sites
+
+
 def check_site_visible(site_id) -> bool:
     """Check if the user can view the site"""
     if g.user.permission == "A":
         return True  # User has admin access
-    count = session.query(UserAccess)\
-                   .filter(UserAccess.user_id == g.user.id, UserAccess.site_id == site_id)\
-                   .count()
-    return count != 0
+    try:
+        return int(site_id) in get_visible_sites()
+    except (TypeError, ValueError):
+        return False  # Not a valid site id
 
 
 def verify_site_visible(site_id):
@@ -256,6 +615,48 @@ def verify_user_personal_access(content_user_id):
         raise Unauthorized()
 
 
+def is_expanded() -> bool:
+    """Checks if the client asked for the full objects (?expand=full) instead of their ids"""
+    return expand_parser.parse_args()["expand"] == "full"
+
+
+# Max number of items in a page of a list
+MAX_PAGE_SIZE = 1000
+
+
+def list_page(query, id_column: Column, filter_parser: RequestParser = None) -> list:
+    """
+    Applies the filters (exact match, ex: ?name=...) and the keyset pagination (?limit=N&after=id) to a list query.
+    The items are always sorted by id, a page contains the first limit items with an id greater than after,
+    so the pages stay consistent even when items are added or deleted in the meantime.
+    When there could be more items the url of the next page is set in the Link header (see conditional_response).
+    Without a limit every item is returned.
+    """
+    if filter_parser is not None:
+        for key, value in filter_parser.parse_args().items():
+            if value is not None:
+                query = query.filter(getattr(id_column.class_, key) == value)
+
+    args = page_parser.parse_args()
+    limit, after = args["limit"], args["after"]
+    if after is not None:
+        query = query.filter(id_column > after)
+    query = query.order_by(id_column)
+
+    if limit is None:
+        return query.all()
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise BadRequest("The limit should be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_args = request.args.copy()
+        next_args["after"] = rows[-1].id
+        g.next_page = '<{}?{}>; rel="next"'.format(request.base_url, url_encode(next_args))
+    return rows
+
+
 # ---------------- Parsers initialization ----------------
 # Parser are used to filter parameters passed to the rest links
 # A request is valid only if every argument passed exists in the parser
@@ -268,6 +669,27 @@ def verify_user_personal_access(content_user_id):
 id_parser.add_argument("id", type=int, required=True)
 
 
+# List endpoints, ?expand=full returns the objects instead of the ids
+expand_parser = RequestParser()
+expand_parser.add_argument("expand", choices=["full"], location="args")
+
+# Keyset pagination of the lists (see list_page)
+page_parser = RequestParser()
+page_parser.add_argument("limit", type=int, location="args")
+page_parser.add_argument("after", type=int, location="args")
+
+# List filters
+config_filter_parser = RequestParser()
+config_filter_parser.add_argument("name", type=str, location="args")
+config_filter_parser.add_argument("id_cnr", type=str, location="args")
+
+user_filter_parser = RequestParser()
+user_filter_parser.add_argument("username", type=str, location="args")
+
+# Sync, the version returned by the last sync (0 for everything)
+sync_parser = RequestParser()
+sync_parser.add_argument("since", type=int, default=0, location="args")
+
 # Login
 login_parser = RequestParser()
 login_parser.add_argument("username", type=str, required=True)
@@ -303,6 +725,9 @@ def verify_user_personal_access(content_user_id):
 channel_parser.add_argument("measure_unit", type=str)
 channel_parser.add_argument("range_min", type=int)
 channel_parser.add_argument("range_max", type=int)
+channel_parser.add_argument("hysteresis", type=float)
+channel_parser.add_argument("min_duration", type=int)
+channel_parser.add_argument("rate_max", type=float)
 
 # Map upload
 
@@ -335,11 +760,28 @@ def post(self):
 
         # Try to authenticate with user and password
 
+        throttle_login(data["username"], request.remote_addr)
+
         user = session.query(User).filter(User.username == data["username"]).first()
 
-        if user is None or not user.verify_password(data["password"]):
+        if user is None:
+            login_failed(data["username"])
+            raise NotFound("Wrong username or password")
+
+        try:
+            valid, new_hash = password_hasher.verify_and_update(data["password"], user.password_hash)
+        except HasherBusy:
+            raise ServiceUnavailable("Server busy, retry later", retry_after=1)
+
+        if not valid:
+            login_failed(data["username"])
             raise NotFound("Wrong username or password")
 
+        if new_hash is not None:
+            # The hash parameters are outdated, this is not a password change (the old tokens are still valid)
+            user.password_hash = new_hash
+            session.commit()
+
         g.user = user
         token = generate_auth_token(user)
         return {
@@ -358,7 +800,12 @@ def get(self):
 class RUserList(Resource):
     @admin_required
     def get(self):
-        return [x.id for x in db.session.query(User).all()]
+        # Users have no version column, every change to them bumps user_credentials
+        def make_data():
+            if is_expanded():
+                return [clean_dict(x.to_dict()) for x in list_page(session.query(User), User.id, user_filter_parser)]
+            return [x[0] for x in list_page(session.query(User.id), User.id, user_filter_parser)]
+        return conditional_response(rest_etag(user_credentials_version.current(session)), make_data)
 
     @admin_required
     def post(self):
@@ -376,9 +823,11 @@ def post(self):
         if session.query(User).filter(User.username == args["username"]).count() == 1:
             raise NotFound("Username already in use")
 
+        phash = hash_password(passw)
         user = rest_create(User, args)
 
-        user.hash_password(passw)
+        user.set_password_hash(phash)
+        user_credentials_version.bump(session)
 
         session.commit()
         return clean_dict(user.to_dict()), 201
@@ -413,7 +862,8 @@ def put(self, uid):
                 user = rest_update(uid, args, User, empty_throw=passw is not None, commit=False)  # type: User
 
         if passw is not None:
-            user.hash_password(passw)
+            user.set_password_hash(hash_password(passw))
+            user_credentials_version.bump(session)
 
         session.commit()
         return clean_dict(user.to_dict())
@@ -423,6 +873,7 @@ def delete(self, uid):
         deleted = session.query(User).filter(User.id == uid).delete()
         if deleted == 0:
             raise BadRequest('Cannot find user ' + str(uid))
+        bump_model_versions(User)
         session.commit()
         return None, 202
 
@@ -438,6 +889,7 @@ def post(self, uid):
         args = id_parser.parse_args(strict=True)
 
         session.add(UserAccess(user_id=uid, site_id=args["id"]))
+        bump_model_versions(UserAccess)
         try:
             session.commit()
         except IntegrityError:
@@ -451,6 +903,8 @@ def delete(self, uid, sid):
         deleted = session.query(UserAccess).filter(UserAccess.user_id == uid, UserAccess.site_id == sid).delete()
         if deleted == 0:
             raise NotFound('Cannot find entry ' + str((uid, sid)))
+        sync.record_access_deletes(session, [(int(uid), int(sid))])
+        bump_model_versions(UserAccess)
         session.commit()
         return None, 202
 
@@ -461,12 +915,14 @@ class RUserContactFCM(Resource):
     def put(self, uid, fcmid):
         verify_user_personal_access(uid)
         session.merge(FCMUserContact(user_id=uid, registration_id=fcmid))
+        bump_model_versions(FCMUserContact)
         session.commit()
 
     @login_required
     def delete(self, uid, fcmid):
         verify_user_personal_access(uid)
         session.delete(FCMUserContact(user_id=uid, registration_id=fcmid))
+        bump_model_versions(FCMUserContact)
         session.commit()
 
 
@@ -476,12 +932,14 @@ class RUserContactTelegram(Resource):
     def put(self, uid, telid):
         verify_user_personal_access(uid)
         session.merge(TelegramUserContact(user_id=uid, telegram_id=telid))
+        bump_model_versions(TelegramUserContact)
         session.commit()
 
     @login_required
     def delete(self, uid, telid):
         verify_user_personal_access(uid)
         session.delete(TelegramUserContact(user_id=uid, telegram_id=telid))
+        bump_model_versions(TelegramUserContact)
         session.commit()
 
 
@@ -490,12 +948,27 @@ class RSiteList(Resource):
     @login_required
     def get(self):
         if g.user.permission == "A":
-            # Admins can see every site
-            sites = db.session.query(Site).all()
+            state = list_state(Site)
         else:
-            sites = g.user.sites
+            visible = get_visible_sites()
+            state = list_state(Site, Site.id.in_(visible)) + tuple(sorted(visible))
+        return conditional_response(rest_etag(*state), self.get_data)
+
+    @staticmethod
+    def get_data():
+        expanded = is_expanded()
+        if not expanded and g.user.permission != "A" and not request.args:
+            return sorted(get_visible_sites())
+
+        sites = session.query(Site if expanded else Site.id)
+        if g.user.permission != "A":
+            # Admins can see every site
+            sites = sites.filter(Site.id.in_(get_visible_sites()))
+        sites = list_page(sites, Site.id, config_filter_parser)
 
-        return [x.id for x in sites]
+        if expanded:
+            return [clean_dict(x.to_dict()) for x in sites]
+        return [x[0] for x in sites]
 
     @admin_required
     def post(self):
@@ -507,7 +980,9 @@ def post(self):
     def delete(self):
         args = id_parser.parse_args(strict=True)
 
+        sync.record_deletes(session, Site, [args["id"]])
         session.query(Site).filter(Site.id == args["id"]).delete()
+        bump_model_versions(Site)
         session.commit()
         return None, 202
 
@@ -517,7 +992,8 @@ class RSite(Resource):
     @login_required
     def get(self, mid):
         verify_site_visible(mid)
-        return clean_dict(rest_get(Site, mid).to_dict())
+        version = rest_get_version(Site, mid)
+        return conditional_response(rest_etag(version), lambda: clean_dict(rest_get(Site, mid).to_dict()))
 
     @admin_required
     def put(self, mid):
@@ -525,9 +1001,11 @@ def put(self, mid):
 
     @admin_required
     def delete(self, mid):
+        sync.record_deletes(session, Site, [mid])
         deleted = session.query(Site).filter(Site.id == mid).delete()
         if deleted == 0:
             raise BadRequest('Cannot find site' + str(mid))
+        bump_model_versions(Site)
         session.commit()
         RSiteMap.delete(None, mid)
         return None, 202
@@ -538,11 +1016,16 @@ class RSiteSensors(Resource):
     @login_required
     def get(self, mid):
         verify_site_visible(mid)
+        return conditional_response(rest_etag(*list_state(Sensor, Sensor.site_id == mid)),
+                                    lambda: self.get_data(mid))
 
-        ids = session.query(Sensor)\
-                     .filter(Sensor.site_id == mid)\
-                     .with_entities(Sensor.id)\
-                     .all()
+    @staticmethod
+    def get_data(mid):
+        if is_expanded():
+            sensors = list_page(session.query(Sensor).filter(Sensor.site_id == mid), Sensor.id, config_filter_parser)
+            return [clean_dict(x.to_dict()) for x in sensors]
+
+        ids = list_page(session.query(Sensor.id).filter(Sensor.site_id == mid), Sensor.id, config_filter_parser)
         return [x[0] for x in ids]
 
     @admin_required
@@ -551,6 +1034,39 @@ def post(self, mid):
         return clean_dict(sensor.to_dict()), 201
 
 
+@api.resource("/site/<mid>/tree")
+class RSiteTree(Resource):
+    @login_required
+    def get(self, mid):
+        """
+        Returns the site with all of its sensors and their channels, loaded with 3 queries whatever the size
+        (an up to date copy of the client is validated with 3 small aggregate queries instead)
+        """
+        verify_site_visible(mid)
+
+        sensor_ids = session.query(Sensor.id).filter(Sensor.site_id == mid)
+        state = (rest_get_version(Site, mid),) + list_state(Sensor, Sensor.site_id == mid) + \
+            list_state(Channel, Channel.sensor_id.in_(sensor_ids.subquery()))
+        return conditional_response(rest_etag(*state), lambda: self.get_data(mid))
+
+    @staticmethod
+    def get_data(mid):
+        site = session.query(Site)\
+            .options(subqueryload(Site.sensors).subqueryload(Sensor.channels))\
+            .filter(Site.id == mid)\
+            .first()
+        if site is None:
+            raise NotFound("Cannot find site %s" % mid)
+
+        tree = clean_dict(site.to_dict())
+        tree["sensors"] = []
+        for sensor in sorted(site.sensors, key=lambda x: x.id):
+            sensor_dict = clean_dict(sensor.to_dict())
+            sensor_dict["channels"] = [clean_dict(x.to_dict()) for x in sorted(sensor.channels, key=lambda x: x.id)]
+            tree["sensors"].append(sensor_dict)
+        return tree
+
+
 @api.resource("/site/<mid>/map")
 class RSiteMap(Resource):
     @login_required
@@ -591,6 +1107,7 @@ def put(self, mid):
                 .update({
                     Sensor.loc_x: Sensor.loc_x * mul_x,
                     Sensor.loc_y: Sensor.loc_y * mul_y,
+                    **sync.stamp(session, Sensor),
                 })
             session.commit()
 
@@ -603,10 +1120,18 @@ def delete(self, mid):
 class RSiteChannels(Resource):
     @login_required
     def get(self, sid):
-        ids = session.query(Channel)\
-                     .filter(Channel.sensor_id == sid)\
-                     .with_entities(Channel.id)\
-                     .all()
+        rest_get_version(Sensor, sid)  # Check if the site is visible
+        return conditional_response(rest_etag(*list_state(Channel, Channel.sensor_id == sid)),
+                                    lambda: self.get_data(sid))
+
+    @staticmethod
+    def get_data(sid):
+        if is_expanded():
+            channels = list_page(session.query(Channel).filter(Channel.sensor_id == sid), Channel.id,
+                                 config_filter_parser)
+            return [clean_dict(x.to_dict()) for x in channels]
+
+        ids = list_page(session.query(Channel.id).filter(Channel.sensor_id == sid), Channel.id, config_filter_parser)
         return [x[0] for x in ids]
 
     @admin_required
@@ -616,12 +1141,21 @@ def post(self, sid):
         return clean_dict(rest_create(Channel, args).to_dict()), 201
 
 
+@api.resource("/sensor/batch")
+class RSensorBatch(Resource):
+    @admin_required
+    def post(self):
+        """Creates or updates many sensors, every item should have a site_id (to create) or an id (to update)"""
+        return rest_batch(Sensor, sensor_parser, Sensor.site_id, request.get_json(silent=True))
+
+
 @api.resource("/sensor/<sid>")
 class RSensor(Resource):
     @login_required
     def get(self, sid):
-        # rest_get verifies that the site is visible from the user
-        return clean_dict(rest_get(Sensor, sid).to_dict())
+        # rest_get_version verifies that the site is visible from the user
+        version = rest_get_version(Sensor, sid)
+        return conditional_response(rest_etag(version), lambda: clean_dict(rest_get(Sensor, sid).to_dict()))
 
     @admin_required
     def put(self, sid):
@@ -629,9 +1163,11 @@ def put(self, sid):
 
     @admin_required
     def delete(self, sid):
+        sync.record_deletes(session, Sensor, [sid])
         deleted = session.query(Sensor).filter(Sensor.id == sid).delete()
         if deleted == 0:
             raise NotFound('Cannot find sensor' + str(sid))
+        bump_model_versions(Sensor)
         session.commit()
         return None, 202
 
@@ -642,14 +1178,26 @@ def create_from_req(site_id, req=None):
         return rest_create(Sensor, args)
 
 
+@api.resource("/channel/batch")
+class RChannelBatch(Resource):
+    @admin_required
+    def post(self):
+        """Creates or updates many channels, every item should have a sensor_id (to create) or an id (to update)"""
+        return rest_batch(Channel, channel_parser, Channel.sensor_id, request.get_json(silent=True))
+
+
 @api.resource("/channel/<cid>")
 class RChannel(Resource):
     @login_required
     def get(self, cid):
-        channel = rest_get(Channel, cid)
-        rest_get(Sensor, channel.sensor_id)  # Check if museum visible (performed automatically when site_id is present)
+        row = session.query(Channel.version, Sensor.site_id)\
+            .join(Sensor, Sensor.id == Channel.sensor_id)\
+            .filter(Channel.id == cid)\
+            .first()
+        if row is None or not check_site_visible(row.site_id):  # Check if museum visible
+            raise NotFound("Cannot find Channel '%s'" % cid)
 
-        return clean_dict(channel.to_dict())
+        return conditional_response(rest_etag(row.version), lambda: clean_dict(rest_get(Channel, cid).to_dict()))
 
     @admin_required
     def put(self, cid):
@@ -658,6 +1206,7 @@ def put(self, cid):
     @admin_required
     def delete(self, cid):
         session.delete(rest_get(Channel, cid))
+        bump_model_versions(Channel)
         session.commit()
         return None, 202
 
@@ -668,6 +1217,24 @@ def create_from_req(self, sensor_id, req=None):
         return rest_create(Channel, args)
 
 
+@api.resource("/sync")
+class RSync(Resource):
+    @login_required
+    def get(self):
+        """Returns the sites, sensors and channels changed (or deleted) after the since version"""
+        since = max(sync_parser.parse_args()["since"] or 0, 0)
+        visible_sites = None if g.user.permission == "A" else get_visible_sites()
+        return sync.changes_since(session, since, g.user.id, visible_sites)
+
+
+@api.resource("/metrics")
+class RMetrics(Resource):
+    @admin_required
+    def get(self):
+        """Request, SQL and alarm tick metrics of this process in the Prometheus text format"""
+        return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @api.resource("/channel/<cid>/readings")
 class RChannelData(Resource):
     def __init__(self):
@@ -685,9 +1252,10 @@ def get_atomic(self, site_id: int, station_id: int, channel_id: int, start: date
             ReadingData.date <= end
         ).all()
 
+        # The values are floats (REAL), the encoder would send them as numbers: the clients expect strings
         return [
             clean_dict({
-                "date": x.date.strftime(date_format),
+                "date": x.date,
                 "value_min": str(x.value_min),
                 "value_avg": str(x.value_avg),
                 "value_max": str(x.value_max),
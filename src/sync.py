@@ -0,0 +1,185 @@
+from typing import Optional, Set, List, Type
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session
+
+from models import Site, Sensor, Channel, UserAccess, ConfigVersion, Tombstone
+from util import clean_dict
+
+# Delta sync of the site configuration
+# Every change to a site, sensor, channel or user access stamps the row with the next value of a global counter
+# (all the changes of a transaction share the same version), the deleted rows leave a tombstone with the version.
+# A client that remembers the version of its last sync can download only what changed since then.
+# The counter row is locked by the UPDATE until the transaction ends, so the versions are committed in order.
+
+SYNC_MODELS = (Site, Sensor, Channel, UserAccess)
+SYNC_COUNTER = "sync"
+
+
+def next_version(session: Session) -> int:
+    """Returns the version of the changes made in the current transaction"""
+    version = session.info.get("sync_version")
+    if version is not None:
+        return version
+
+    counter = ConfigVersion.__table__
+    res = session.execute(
+        counter.update()
+        .where(counter.c.name == SYNC_COUNTER)
+        .values(version=counter.c.version + 1)
+    )
+    if res.rowcount == 0:
+        session.execute(counter.insert().values(name=SYNC_COUNTER, version=1))
+
+    version = current_version(session)
+    session.info["sync_version"] = version
+    return version
+
+
+def current_version(session: Session) -> int:
+    counter = ConfigVersion.__table__
+    version = session.execute(counter.select().with_only_columns([counter.c.version])
+                              .where(counter.c.name == SYNC_COUNTER)).scalar()
+    return version or 0
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _end_transaction(session):
+    session.info.pop("sync_version", None)
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_versions(session: Session, flush_context, instances):
+    # Rows added or changed through the ORM (bulk updates and deletes should call stamp/record_deletes)
+    changed = [x for x in list(session.new) + list(session.dirty) if isinstance(x, SYNC_MODELS)]
+    deleted = [x for x in session.deleted if isinstance(x, SYNC_MODELS)]
+    if not changed and not deleted:
+        return
+
+    version = next_version(session)
+    for obj in changed:
+        obj.version = version
+
+    for clazz in SYNC_MODELS:
+        objs = [x for x in deleted if isinstance(x, clazz)]
+        if clazz is UserAccess:
+            record_access_deletes(session, [(x.user_id, x.site_id) for x in objs])
+        elif objs:
+            record_deletes(session, clazz, [x.id for x in objs])
+
+
+def stamp(session: Session, clazz: Type) -> dict:
+    """Values to add to a bulk update (query.update) of a synced model"""
+    return {clazz.version: next_version(session)} if clazz in SYNC_MODELS else {}
+
+
+def record_deletes(session: Session, clazz: Type, ids: list):
+    """
+    Adds the tombstones of the rows that are about to be deleted, including the ones deleted by the cascade.
+    It must be called before the delete.
+    """
+    if not ids:
+        return
+
+    tombstones = []
+    sensors = []
+    if clazz is Site:
+        site_ids = [x[0] for x in session.query(Site.id).filter(Site.id.in_(ids)).all()]
+        tombstones += [dict(kind="site", object_id=i, site_id=i) for i in site_ids]
+        sensors = session.query(Sensor.id, Sensor.site_id).filter(Sensor.site_id.in_(site_ids)).all()
+        access = session.query(UserAccess.user_id, UserAccess.site_id).filter(UserAccess.site_id.in_(site_ids)).all()
+        tombstones += [dict(kind="access", object_id=s, site_id=s, user_id=u) for u, s in access]
+    elif clazz is Sensor:
+        sensors = session.query(Sensor.id, Sensor.site_id).filter(Sensor.id.in_(ids)).all()
+    elif clazz is Channel:
+        channels = session.query(Channel.id, Sensor.site_id)\
+            .join(Sensor, Sensor.id == Channel.sensor_id)\
+            .filter(Channel.id.in_(ids))\
+            .all()
+        tombstones += [dict(kind="channel", object_id=c, site_id=s) for c, s in channels]
+    else:
+        raise ValueError("{} is not synced".format(clazz.__name__))
+
+    if sensors:
+        sensor_sites = dict(sensors)
+        tombstones += [dict(kind="sensor", object_id=i, site_id=s) for i, s in sensors]
+        channels = session.query(Channel.id, Channel.sensor_id).filter(Channel.sensor_id.in_(list(sensor_sites))).all()
+        tombstones += [dict(kind="channel", object_id=c, site_id=sensor_sites[s]) for c, s in channels]
+
+    _add_tombstones(session, tombstones)
+
+
+def record_access_deletes(session: Session, accesses: List[tuple]):
+    """Adds the tombstones of the (user_id, site_id) accesses that are about to be deleted"""
+    _add_tombstones(session, [dict(kind="access", object_id=s, site_id=s, user_id=u) for u, s in accesses])
+
+
+def _add_tombstones(session: Session, tombstones: List[dict]):
+    if not tombstones:
+        return
+    version = next_version(session)
+    for t in tombstones:
+        t["version"] = version
+    session.execute(Tombstone.__table__.insert(), tombstones)
+
+
+def changes_since(session: Session, since: int, user_id: int, visible_sites: Optional[Set[int]]) -> dict:
+    """
+    Returns the configuration changed after the since version and visible to the user
+    (visible_sites is None for the admins, they can see every site).
+    With since = 0 the whole configuration is returned.
+    """
+    version = current_version(session)
+
+    def visible(query, site_column):
+        return query if visible_sites is None else query.filter(site_column.in_(visible_sites))
+
+    # The sites the user has been given access to since the last sync are sent whole
+    new_sites = set()
+    if visible_sites is not None and since > 0:
+        granted = session.query(UserAccess.site_id).filter(UserAccess.user_id == user_id, UserAccess.version > since)
+        new_sites = {x[0] for x in granted.all()} & visible_sites
+
+    sites = visible(session.query(Site), Site.id)\
+        .filter(or_(Site.version > since, Site.id.in_(new_sites)))\
+        .order_by(Site.id)\
+        .all()
+    sensors = visible(session.query(Sensor), Sensor.site_id)\
+        .filter(or_(Sensor.version > since, Sensor.site_id.in_(new_sites)))\
+        .order_by(Sensor.id)\
+        .all()
+    channels = visible(session.query(Channel).join(Sensor, Sensor.id == Channel.sensor_id), Sensor.site_id)\
+        .filter(or_(Channel.version > since, Sensor.site_id.in_(new_sites)))\
+        .order_by(Channel.id)\
+        .all()
+
+    deleted = {"site": set(), "sensor": set(), "channel": set()}
+    if since > 0:
+        tombstones = session.query(Tombstone.kind, Tombstone.object_id, Tombstone.site_id, Tombstone.user_id)\
+            .filter(Tombstone.version > since)\
+            .all()
+        for kind, object_id, site_id, tomb_user_id in tombstones:
+            if kind == "access":
+                # Access revoked (or site deleted): for the user the whole site is gone
+                if visible_sites is not None and tomb_user_id == user_id:
+                    deleted["site"].add(site_id)
+            elif visible_sites is None or site_id in visible_sites:
+                deleted[kind].add(object_id)
+
+    # A row could be deleted and then be visible again (ex: access revoked and granted again)
+    deleted["site"] -= {x.id for x in sites} | (visible_sites or set())
+    deleted["sensor"] -= {x.id for x in sensors}
+    deleted["channel"] -= {x.id for x in channels}
+
+    return {
+        "version": version,
+        "sites": [clean_dict(x.to_dict()) for x in sites],
+        "sensors": [clean_dict(x.to_dict()) for x in sensors],
+        "channels": [clean_dict(x.to_dict()) for x in channels],
+        "deleted": {
+            "sites": sorted(deleted["site"]),
+            "sensors": sorted(deleted["sensor"]),
+            "channels": sorted(deleted["channel"]),
+        },
+    }
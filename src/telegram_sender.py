@@ -0,0 +1,107 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from util.ratelimit import TokenBucket, KeyedTokenBuckets
+
+# Bot API limits: about 30 messages per second overall and 1 message per second in the same chat
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+
+class TelegramSender:
+    """
+    Sends Telegram messages through the Bot API.
+
+    Messages are sent concurrently (one worker per chat, over a pooled HTTP session) while respecting
+    the global and the per-chat rate limits with token buckets, so a burst goes out as fast as the limits allow.
+    When the server answers 429 anyway its retry_after is respected before sending again.
+    """
+    def __init__(self, api_key: str, base_url=TELEGRAM_API_URL, workers=8, global_rate=30.0, chat_rate=1.0,
+                 max_retries=3, timeout=10.0):
+        self.url = "{}/bot{}/sendMessage".format(base_url.rstrip("/"), api_key)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = KeyedTokenBuckets(chat_rate)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="telegram")
+        self._stop_event = threading.Event()
+
+    def send_messages(self, messages: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+        """
+        Sends the messages (chat_id, text) and waits for them to be delivered.
+        The messages of the same chat are sent in order, returns the messages that could not be sent.
+        """
+        chats = OrderedDict()  # type: Dict[int, List[str]]
+        for chat_id, text in messages:
+            chats.setdefault(chat_id, []).append(text)
+
+        futures = [self.executor.submit(self._send_chat, chat_id, texts) for chat_id, texts in chats.items()]
+
+        failed = []
+        for future in futures:
+            failed.extend(future.result())
+        return failed
+
+    def _send_chat(self, chat_id: int, texts: List[str]) -> List[Tuple[int, str]]:
+        for i, text in enumerate(texts):
+            if not self.send_message(chat_id, text):
+                # Keep the order: the following messages of the chat are not sent either
+                return [(chat_id, t) for t in texts[i:]]
+        return []
+
+    def send_message(self, chat_id: int, text: str) -> bool:
+        """Sends a single message waiting for the rate limits, returns False if it could not be delivered"""
+        chat_bucket = self.chat_buckets.get(chat_id)
+
+        for _ in range(self.max_retries + 1):
+            if not chat_bucket.acquire(stop_event=self._stop_event) or \
+                    not self.global_bucket.acquire(stop_event=self._stop_event):
+                return False
+
+            try:
+                res = self.http.post(self.url, json={"chat_id": chat_id, "text": text}, timeout=self.timeout)
+            except requests.RequestException as e:
+                logging.warning("Telegram: cannot send message to %s: %s", chat_id, e)
+                return False
+
+            if res.status_code == 429:
+                retry_after = self._retry_after(res)
+                logging.warning("Telegram: rate limited sending to %s, retrying in %ss", chat_id, retry_after)
+                # The limit hit could be the global one, stop every worker and not only this chat
+                self.global_bucket.pause(retry_after)
+                chat_bucket.pause(retry_after)
+                continue
+
+            if res.status_code != 200:
+                logging.error("Telegram: error sending message to %s: %s %s", chat_id, res.status_code, res.text)
+                return False
+            return True
+
+        logging.error("Telegram: giving up on message to %s, still rate limited", chat_id)
+        return False
+
+    @staticmethod
+    def _retry_after(res: requests.Response) -> float:
+        try:
+            return float(res.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return 1.0
+
+    def close(self):
+        self._stop_event.set()
+        self.executor.shutdown(wait=True)
+        self.http.close()
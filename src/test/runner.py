@@ -3,6 +3,8 @@
 
 # import your test modules
 import test.test_rest as rest
+import test.test_alarm_rules as alarm_rules
+import test.test_util as util_tests
 
 # initialize the test suite
 loader = unittest.TestLoader()
@@ -10,6 +12,8 @@
 
 # add tests to the test suite
 suite.addTests(loader.loadTestsFromModule(rest))
+suite.addTests(loader.loadTestsFromModule(alarm_rules))
+suite.addTests(loader.loadTestsFromModule(util_tests))
 
 # initialize a runner, pass it your suite and run it
 runner = unittest.TextTestRunner(verbosity=3)
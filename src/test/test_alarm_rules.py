@@ -0,0 +1,110 @@
+import datetime
+import unittest
+
+import numpy as np
+
+from alarm import AlarmedChannelData
+from alarm_rules import ChannelRules, RuleEngine, rows_to_arrays
+from benchmark import alarm_engine
+
+
+def make_rules(range_min=10, range_max=20, hysteresis=None, min_duration=None, rate_max=None):
+    channel = AlarmedChannelData(1, 1, 1, "site", "station", "ch", range_min, range_max)
+    return ChannelRules([channel], [hysteresis], [min_duration], [rate_max])
+
+
+def evaluate(engine, times, vmin, vmax):
+    n = len(times)
+    return engine.evaluate(
+        np.zeros(n, dtype=np.int64),
+        np.array(times, dtype=np.float64),
+        np.array(vmin, dtype=np.float64),
+        np.full(n, np.nan),
+        np.array(vmax, dtype=np.float64)
+    )
+
+
+class AlarmRulesTestCase(unittest.TestCase):
+    def test_range(self):
+        engine = RuleEngine()
+        engine.set_rules(make_rules())
+
+        amin, amax = evaluate(engine, [0, 60, 120], [15, 5, 12], [16, 18, 25])
+        self.assertEqual({0: (5.0, 1)}, amin)
+        self.assertEqual({0: (25.0, 2)}, amax)
+
+    def test_hysteresis(self):
+        engine = RuleEngine()
+        engine.set_rules(make_rules(hysteresis=2))
+
+        evaluate(engine, [0], [9], [15])
+        evaluate(engine, [60], [11], [15])
+        # Back in range but not by more than the hysteresis
+        self.assertFalse(engine.check_extinguished([0])[0])
+
+        evaluate(engine, [120], [13], [15])
+        self.assertTrue(engine.check_extinguished([0])[0])
+
+    def test_min_duration(self):
+        engine = RuleEngine()
+        engine.set_rules(make_rules(min_duration=300))
+
+        amin, _ = evaluate(engine, [0, 120], [5, 5], [15, 15])
+        self.assertEqual({}, amin)
+
+        # The violation continues in the next tick
+        amin, _ = evaluate(engine, [240, 360], [5, 4], [15, 15])
+        self.assertEqual({0: (4.0, 1)}, amin)
+
+        # Short violations never fire
+        amin, _ = evaluate(engine, [480, 540, 600, 660], [15, 5, 15, 5], [15, 15, 15, 15])
+        self.assertEqual({}, amin)
+
+    def test_rate(self):
+        engine = RuleEngine()
+        engine.set_rules(make_rules(range_min=0, range_max=100, rate_max=5))
+
+        # +4/h then +6/h
+        _, amax = evaluate(engine, [0, 3600], [50, 54], [50, 54])
+        self.assertEqual({}, amax)
+        _, amax = evaluate(engine, [7200], [60], [60])
+        self.assertEqual({0: (60.0, 0)}, amax)
+        self.assertFalse(engine.check_extinguished([0])[0])
+
+        amin, _ = evaluate(engine, [10800], [40], [40])
+        self.assertEqual({0: (40.0, 0)}, amin)
+
+        evaluate(engine, [14400], [41], [41])
+        self.assertTrue(engine.check_extinguished([0])[0])
+
+    def test_rules_reload(self):
+        engine = RuleEngine()
+        engine.set_rules(make_rules(min_duration=300))
+        evaluate(engine, [0], [5], [15])
+
+        # The state of the channel survives a configuration reload
+        engine.set_rules(make_rules(min_duration=300))
+        amin, _ = evaluate(engine, [300], [5], [15])
+        self.assertEqual({0: (5.0, 0)}, amin)
+
+    def test_rows_to_arrays(self):
+        rules = make_rules()
+        date = datetime.datetime(2019, 5, 1)
+        rows = [
+            ("site", "station", "ch", date, 5.0, None, 15.0),
+            ("site", "station", "other", date, 1.0, 1.0, 1.0),  # Unknown channel
+            ("site", "station", "ch", date + datetime.timedelta(minutes=1), 12.0, 13.0, 14.0),
+        ]
+        idx, t, vmin, vavg, vmax, dates = rows_to_arrays(rules, rows)
+        self.assertEqual([0, 0], idx.tolist())
+        self.assertEqual([date.timestamp(), date.timestamp() + 60], t.tolist())
+        self.assertEqual([5.0, 12.0], vmin.tolist())
+        self.assertTrue(np.isnan(vavg[0]))
+        self.assertEqual([15.0, 14.0], vmax.tolist())
+        self.assertEqual([date, date + datetime.timedelta(minutes=1)], dates)
+
+        self.assertEqual(0, len(rows_to_arrays(rules, [])[0]))
+
+    def test_benchmark(self):
+        report = alarm_engine.bench(100, [1, 3], firing=0.5, repeat=1)
+        self.assertIn("3 rows per channel", report)
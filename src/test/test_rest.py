@@ -1,14 +1,29 @@
 import datetime
+import pickle
+import gzip
 import json
+import re
+import tempfile
+import threading
 import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from socketserver import ThreadingMixIn
 
+import passlib.hash
+import sqlalchemy
 from flask import Response
 from flask.testing import FlaskClient
 from werkzeug.datastructures import MultiDict
 
 import main
+from main import ADDED_COLUMNS, ADDED_INDEXES
 import models
+import rest_controller
 import alarm
+from benchmark import alarm_replay, fcm_fanout
+from telegram_sender import TelegramSender
+import util
 from util import date_format, parse_date
 
 main = main.Main()  # type: main.Main
@@ -16,6 +31,62 @@
 root_password = ""  # type: str
 
 
+class StubContacter:
+    """Contacter that only records the alarms that would have been sent"""
+    def __init__(self):
+        self.sent = []
+
+    def send_alarms(self, alarms):
+        self.sent.extend(alarms)
+
+
+class FakeFCM:
+    """Records the FCM messages instead of sending them"""
+    def __init__(self):
+        self.sent = []
+
+    def multiple_devices_data_message(self, registration_ids, data_message):
+        self.sent.append((registration_ids, data_message))
+
+
+class StubTelegramServer(ThreadingMixIn, HTTPServer):
+    """Local Bot API stub: records the messages and rate limits the first rate_limited requests"""
+    daemon_threads = True
+
+    def __init__(self, rate_limited=0):
+        self.messages = []
+        self.rate_limited = rate_limited
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StubTelegramHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%i" % self.server_address[1]
+
+
+class StubTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            if self.server.rate_limited > 0:
+                self.server.rate_limited -= 1
+                status, res = 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 0.1}}
+            else:
+                self.server.messages.append((self.path, body["chat_id"], body["text"]))
+                status, res = 200, {"ok": True, "result": {}}
+
+        data = json.dumps(res).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
 class FlaskrTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -25,9 +96,21 @@ def __init__(self, *args, **kwargs):
 
     @classmethod
     def setUpClass(cls):
+        main.startup.register(cls.use_temp_vardata, after="load_config")
         main.startup.register(cls.inject_setup, after="setup_flask")
         main.setup()
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.vardata.cleanup()
+
+    @classmethod
+    def use_temp_vardata(cls):
+        # Keep the signing keys, images and alarm state out of the source tree
+        cls.vardata = tempfile.TemporaryDirectory()
+        main.config["vardata_folder"] = cls.vardata.name
+        main.config.setdefault("auth", {})["signing_keys_file"] = None
+
     @staticmethod
     def inject_setup():
         global app, root_password
@@ -39,6 +122,9 @@ def inject_setup():
         root_password = main.config.setdefault("root_password", "password")
         app = main.app.test_client()
 
+        # The tests login a lot
+        rest_controller.configure_login(username_per_minute=1000, address_per_minute=1000)
+
     def open(self, method, url, content=None, args=None, throw_error=True, raw_response=False, headers=None):
         """Utility method to send a query request to the server, only empty or json response is supported"""
 
@@ -130,6 +216,22 @@ def test_generic(self):
         response = self.open("GET", "sensor/%i/channel" % sensor_id)
         self.assertEqual(len(response), 1)
 
+        # Expanded lists return the objects instead of their ids
+        self.assertIn({"id": mid, "name": "testmuse"}, self.open("GET", "site", args={"expand": "full"}))
+        response = self.open("GET", "site/%i/sensor" % mid, args={"expand": "full"})
+        self.assertEqual([(sensor_id, "testsensor")], [(x["id"], x["name"]) for x in response])
+        response = self.open("GET", "sensor/%i/channel" % sensor_id, args={"expand": "full"})
+        self.assertEqual([(ch_id, "pioppo")], [(x["id"], x["name"]) for x in response])
+        self.assertIn("root", [x["username"] for x in self.open("GET", "user", args={"expand": "full"})])
+        response = self.open("GET", "site", args={"expand": "ids"}, raw_response=True)
+        self.assertEqual(400, response.status_code)
+
+        # The whole site in a single request
+        tree = self.open("GET", "site/%i/tree" % mid)
+        self.assertEqual("testmuse", tree["name"])
+        self.assertEqual([sensor_id], [x["id"] for x in tree["sensors"]])
+        self.assertEqual("nonno", tree["sensors"][0]["channels"][0]["measure_unit"])
+
         # Cleanup
         self.open("DELETE", "site/%i" % mid)
 
@@ -160,14 +262,325 @@ def test_permission_view(self):
         response = self.open("GET", "site/%i" % mus3, raw_response=True)
         self.assertEqual(404, response.status_code)
         self.assertIn("Cannot find site %i" % mus3, json.loads(response.data.decode())["message"])
+        self.assertEqual(404, self.open("GET", "site/%i/tree" % mus3, raw_response=True).status_code)
+        self.assertEqual([mus1, mus2], [x["id"] for x in self.open("GET", "site", args={"expand": "full"})])
+
+        # The visible sites are cached, revoking the access should invalidate them
+        paolo_headers = dict(self.headers)
+        self.login_root()
+        self.open("DELETE", "user/%i/access/%i" % (uid, mus2))
+        self.headers = paolo_headers
+        self.assertEqual(self.open("GET", "site"), [mus1])
+        self.assertEqual(404, self.open("GET", "site/%i/sensor" % mus2, raw_response=True).status_code)
 
         # Cleanup
+        self.headers = {}
         self.login_root()
         self.open("DELETE", "site/%i" % mus1)
         self.open("DELETE", "site/%i" % mus2)
         self.open("DELETE", "site/%i" % mus3)
         self.open("DELETE", "user/%i" % uid)
 
+    def test_etag(self):
+        self.login_root()
+        mid = self.open("POST", "site", content={"name": "etag"})["id"]
+        sid = self.open("POST", "site/%i/sensor" % mid, content={"name": "s"})["id"]
+        cid = self.open("POST", "sensor/%i/channel" % sid, content={"name": "c"})["id"]
+
+        for url in ["site/%i" % mid, "sensor/%i" % sid, "channel/%i" % cid, "site", "site/%i/sensor" % mid,
+                    "sensor/%i/channel" % sid, "site/%i/tree" % mid, "user"]:
+            response = self.open("GET", url, raw_response=True)
+            self.assertEqual(200, response.status_code, url)
+            self.assertIn("Token", response.headers["Vary"])
+            etag = response.headers["ETag"]
+
+            headers = dict(self.headers, **{"If-None-Match": etag})
+            response = self.open("GET", url, raw_response=True, headers=headers)
+            self.assertEqual(304, response.status_code, url)
+            self.assertEqual(b"", response.data)
+
+        # Any change to the resource changes its ETag
+        etags = {}
+        for url in ["channel/%i" % cid, "sensor/%i/channel" % sid, "site/%i/tree" % mid]:
+            etags[url] = self.open("GET", url, raw_response=True).headers["ETag"]
+        self.open("PUT", "channel/%i" % cid, content={"name": "c2"})
+        for url, etag in etags.items():
+            headers = dict(self.headers, **{"If-None-Match": etag})
+            response = self.open("GET", url, raw_response=True, headers=headers)
+            self.assertEqual(200, response.status_code, url)
+            self.assertNotEqual(etag, response.headers["ETag"])
+
+        # The expanded list is not the same resource
+        etag = self.open("GET", "site", raw_response=True).headers["ETag"]
+        headers = dict(self.headers, **{"If-None-Match": etag})
+        response = self.open("GET", "site", args={"expand": "full"}, raw_response=True, headers=headers)
+        self.assertEqual(200, response.status_code)
+
+        # The user list changes with every user change
+        etag = self.open("GET", "user", raw_response=True).headers["ETag"]
+        uid = self.open("POST", "user", content={"username": "etagger", "password": "123"})["id"]
+        headers = dict(self.headers, **{"If-None-Match": etag})
+        response = self.open("GET", "user", raw_response=True, headers=headers)
+        self.assertEqual(200, response.status_code)
+        self.assertIn(uid, json.loads(response.data.decode()))
+
+        self.open("DELETE", "user/%i" % uid)
+        self.open("DELETE", "site/%i" % mid)
+
+    def test_sync(self):
+        self.login_root()
+        site_a = self.open("POST", "site", content={"name": "A"})["id"]
+        sensor1 = self.open("POST", "site/%i/sensor" % site_a, content={"name": "s1"})["id"]
+        channel1 = self.open("POST", "sensor/%i/channel" % sensor1, content={"name": "c1"})["id"]
+        uid = self.open("POST", "user", content={"username": "tablet", "password": "123"})["id"]
+        self.open("POST", "user/%i/access" % uid, content={"id": site_a})
+        root_headers = dict(self.headers)
+
+        self.headers = {}
+        self.login("tablet", "123")
+        tablet_headers = dict(self.headers)
+        full = self.open("GET", "sync")
+        self.assertEqual([site_a], [x["id"] for x in full["sites"]])
+        self.assertEqual([sensor1], [x["id"] for x in full["sensors"]])
+        self.assertEqual([channel1], [x["id"] for x in full["channels"]])
+
+        # Only the changes are sent, the deleted rows are listed (including the ones deleted by the cascade)
+        self.headers = root_headers
+        site_b = self.open("POST", "site", content={"name": "B"})["id"]
+        sensor_b = self.open("POST", "site/%i/sensor" % site_b, content={"name": "sb"})["id"]
+        sensor2 = self.open("POST", "site/%i/sensor" % site_a, content={"name": "s2"})["id"]
+        self.open("PUT", "site/%i" % site_a, content={"name": "A2"})
+        self.open("DELETE", "sensor/%i" % sensor1)
+
+        self.headers = tablet_headers
+        delta = self.open("GET", "sync", args={"since": full["version"]})
+        self.assertGreater(delta["version"], full["version"])
+        self.assertEqual(["A2"], [x["name"] for x in delta["sites"]])
+        self.assertEqual([sensor2], [x["id"] for x in delta["sensors"]])
+        self.assertEqual([], delta["channels"])
+        self.assertEqual({"sites": [], "sensors": [sensor1], "channels": [channel1]}, delta["deleted"])
+        self.assertEqual([], self.open("GET", "sync", args={"since": delta["version"]})["sensors"])
+
+        # A new access sends the whole site, a revoked one deletes it
+        self.headers = root_headers
+        self.open("POST", "user/%i/access" % uid, content={"id": site_b})
+        self.open("DELETE", "user/%i/access/%i" % (uid, site_a))
+
+        self.headers = tablet_headers
+        delta2 = self.open("GET", "sync", args={"since": delta["version"]})
+        self.assertEqual([site_b], [x["id"] for x in delta2["sites"]])
+        self.assertEqual([sensor_b], [x["id"] for x in delta2["sensors"]])
+        self.assertEqual([site_a], delta2["deleted"]["sites"])
+
+        # Admins see every change
+        self.headers = root_headers
+        self.open("DELETE", "site/%i" % site_b)
+        delta3 = self.open("GET", "sync", args={"since": delta2["version"]})
+        self.assertEqual([site_b], delta3["deleted"]["sites"])
+        self.assertEqual([sensor_b], delta3["deleted"]["sensors"])
+
+        self.open("DELETE", "site/%i" % site_a)
+        self.open("DELETE", "user/%i" % uid)
+
+    def test_pagination(self):
+        self.login_root()
+        sites = [self.open("POST", "site", content={"name": "page %i" % (i % 3), "id_cnr": "p%i" % i})["id"]
+                 for i in range(7)]
+        all_sites = self.open("GET", "site")
+        self.assertEqual(sorted(all_sites), all_sites)
+
+        # Follow the next links until the last page
+        for expand in (None, "full"):
+            pages = []
+            args = {"limit": 3, "expand": expand} if expand else {"limit": 3}
+            url = self.prefix + "site?" + "&".join("%s=%s" % x for x in args.items())
+            while url is not None:
+                response = app.open(url, headers=self.headers)
+                self.assertEqual(200, response.status_code)
+                page = json.loads(response.data.decode())
+                pages.append([x["id"] for x in page] if expand else page)
+                link = response.headers.get("Link")
+                url = re.match(r'<http://localhost(.*)>; rel="next"', link).group(1) if link else None
+            self.assertEqual(all_sites, [x for page in pages for x in page])
+            self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+
+        # Filters
+        self.assertEqual(sites[0::3], self.open("GET", "site", args={"name": "page 0"}))
+        self.assertEqual([sites[4]], self.open("GET", "site", args={"id_cnr": "p4"}))
+        self.assertEqual(sites[2:3], self.open("GET", "site", args={"name": "page 2", "limit": 1}))
+        self.assertEqual(sites[5:6], self.open("GET", "site", args={"name": "page 2", "after": sites[2]}))
+        self.assertEqual([], self.open("GET", "site", args={"after": sites[-1]}))
+
+        response = self.open("GET", "site", args={"limit": 0}, raw_response=True)
+        self.assertEqual(400, response.status_code)
+
+        sid = self.open("POST", "site/%i/sensor" % sites[0], content={"name": "a", "id_cnr": "1"})["id"]
+        self.open("POST", "site/%i/sensor" % sites[0], content={"name": "b", "id_cnr": "1"})
+        self.assertEqual([sid], self.open("GET", "site/%i/sensor" % sites[0], args={"name": "a"}))
+        self.open("POST", "sensor/%i/channel" % sid, content={"name": "c", "id_cnr": "1"})
+        cid = self.open("POST", "sensor/%i/channel" % sid, content={"name": "c", "id_cnr": "2"})["id"]
+        channels = self.open("GET", "sensor/%i/channel" % sid, args={"id_cnr": "2", "expand": "full"})
+        self.assertEqual([cid], [x["id"] for x in channels])
+
+        uid = self.open("POST", "user", content={"username": "pager", "password": "123"})["id"]
+        self.assertEqual([uid], self.open("GET", "user", args={"username": "pager"}))
+        self.assertEqual(1, len(self.open("GET", "user", args={"limit": 1})))
+
+        # Users see only their sites
+        self.open("POST", "user/%i/access" % uid, content={"id": sites[1]})
+        self.open("POST", "user/%i/access" % uid, content={"id": sites[4]})
+        self.headers = {}
+        self.login("pager", "123")
+        self.assertEqual([sites[1], sites[4]], self.open("GET", "site"))
+        self.assertEqual([sites[4]], self.open("GET", "site", args={"id_cnr": "p4"}))
+        response = self.open("GET", "site", args={"limit": 1}, raw_response=True)
+        self.assertEqual([sites[1]], json.loads(response.data.decode()))
+        self.assertIn("after=%i" % sites[1], response.headers["Link"])
+
+        # Cleanup
+        self.headers = {}
+        self.login_root()
+        for site_id in sites:
+            self.open("DELETE", "site/%i" % site_id)
+        self.open("DELETE", "user/%i" % uid)
+
+    def test_batch(self):
+        self.login_root()
+        mid = self.open("POST", "site", content={"name": "batch"})["id"]
+        sid = self.open("POST", "site/%i/sensor" % mid, content={"name": "old"})["id"]
+        sync_version = self.open("GET", "sync")["version"]
+
+        res = self.open("POST", "sensor/batch", content=[
+            {"site_id": mid, "name": "s1", "loc_x": 10},
+            {"id": sid, "name": "renamed"},
+            {"site_id": 99999, "name": "missing site"},
+            {"name": "no site"},
+            {"id": sid, "site_id": mid},
+            {"site_id": mid, "unknown": 1},
+            {"id": 99999, "name": "missing"},
+            {"site_id": mid, "name": "s2", "enabled": True},
+        ])
+        self.assertEqual([201, 200, 404, 400, 400, 400, 404, 201], [x["status"] for x in res])
+        self.assertEqual("s1", res[0]["data"]["name"])
+        self.assertEqual(10, res[0]["data"]["loc_x"])
+        self.assertEqual("renamed", res[1]["data"]["name"])
+        self.assertEqual(mid, res[1]["data"]["site_id"])
+        sensors = [res[0]["data"]["id"], sid, res[7]["data"]["id"]]
+        self.assertEqual(sorted(sensors), sorted(self.open("GET", "site/%i/sensor" % mid)))
+
+        # Every valid item is written in a single transaction (and a single sync version)
+        changes = self.open("GET", "sync", args={"since": sync_version})
+        self.assertEqual(sorted(sensors), [x["id"] for x in changes["sensors"]])
+        self.assertEqual(1, changes["version"] - sync_version)
+
+        inserts = []
+
+        def count_inserts(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO channel"):
+                inserts.append(statement)
+
+        engine = models.db.get_engine()
+        sqlalchemy.event.listen(engine, "before_cursor_execute", count_inserts)
+        try:
+            res = self.open("POST", "channel/batch", content=[
+                {"sensor_id": sid, "name": "c%i" % i, "range_min": 0, "range_max": i} for i in range(50)
+            ])
+        finally:
+            sqlalchemy.event.remove(engine, "before_cursor_execute", count_inserts)
+        self.assertEqual([201] * 50, [x["status"] for x in res])
+        self.assertEqual(["c%i" % i for i in range(50)], [x["data"]["name"] for x in res])
+        self.assertEqual(1, len(inserts))  # A single executemany
+        cid = res[0]["data"]["id"]
+        res = self.open("POST", "channel/batch", content=[{"id": cid, "range_max": 100}, {"id": cid}])
+        self.assertEqual([200, 400], [x["status"] for x in res])
+        self.assertEqual(100, float(self.open("GET", "channel/%i" % cid)["range_max"]))
+        self.assertEqual(50, len(self.open("GET", "sensor/%i/channel" % sid)))
+
+        response = self.open("POST", "channel/batch", content={"sensor_id": sid}, raw_response=True)
+        self.assertEqual(400, response.status_code)
+        response = self.open("POST", "channel/batch", content=[{}] * 1001, raw_response=True)
+        self.assertEqual(400, response.status_code)
+
+        # Admin only
+        uid = self.open("POST", "user", content={"username": "batcher", "password": "123"})["id"]
+        self.headers = {}
+        self.login("batcher", "123")
+        response = self.open("POST", "sensor/batch", content=[{"site_id": mid, "name": "x"}], raw_response=True)
+        self.assertEqual(401, response.status_code)
+
+        # Cleanup
+        self.headers = {}
+        self.login_root()
+        self.open("DELETE", "site/%i" % mid)
+        self.open("DELETE", "user/%i" % uid)
+
+    def test_compression(self):
+        self.login_root()
+        mid = self.open("POST", "site", content={"name": "compressed"})["id"]
+        for i in range(30):
+            self.open("POST", "site/%i/sensor" % mid, content={"name": "sensor %i" % i, "id_cnr": str(i)})
+
+        url = self.prefix + "site/%i/sensor?expand=full" % mid
+        plain = app.get(url, headers=self.headers)
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        headers = dict(self.headers, **{"Accept-Encoding": "gzip, deflate"})
+        response = app.get(url, headers=headers)
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual("Token, Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(plain.data, gzip.decompress(response.data))
+        self.assertLess(len(response.data), len(plain.data) / 2)
+
+        # The weak ETag of the compressed response still matches
+        headers["If-None-Match"] = response.headers["ETag"]
+        self.assertTrue(response.headers["ETag"].startswith("W/"))
+        self.assertEqual(304, app.get(url, headers=headers).status_code)
+
+        # Images are already compressed
+        image = b"png" * 1000
+        app.put(self.prefix + "site/%i/map" % mid, data=image, content_type="image/png", headers=self.headers)
+        del headers["If-None-Match"]
+        response = app.get(self.prefix + "site/%i/map" % mid, headers=headers)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(image, response.data)
+
+        self.open("DELETE", "site/%i" % mid)
+
+    def test_metrics(self):
+        self.login_root()
+        mid = self.open("POST", "site", content={"name": "metrics"})["id"]
+        self.open("GET", "site/%i" % mid)
+        self.open("GET", "site/%i/sensor" % mid)
+        main.alarm_manager.on_timer_tick()
+
+        response = self.open("GET", "metrics", raw_response=True)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.data.decode()
+
+        self.assertRegex(text, r'oldmusa_http_requests_total{endpoint="/api/site/<mid>",method="GET",status="200"} \d+')
+        count = re.search(r'oldmusa_http_request_sql_statements_count{endpoint="/api/site/<mid>/sensor",'
+                          r'method="GET"} (\d+)', text)
+        total = re.search(r'oldmusa_http_request_sql_statements_sum{endpoint="/api/site/<mid>/sensor",'
+                          r'method="GET"} ([\d.]+)', text)
+        self.assertGreater(float(total.group(1)) / int(count.group(1)), 0)
+        self.assertRegex(text, r'oldmusa_sql_statements_total{bind="config"} \d+')
+        self.assertRegex(text, r'oldmusa_http_response_size_bytes_bucket{endpoint="/api/site/<mid>",'
+                               r'method="GET",le="\+Inf"} \d+')
+        self.assertRegex(text, r'oldmusa_alarm_tick_phase_seconds_count{phase="probe"} \d+')
+
+        # Admin only
+        uid = self.open("POST", "user", content={"username": "scraper", "password": "123"})["id"]
+        self.headers = {}
+        self.login("scraper", "123")
+        self.assertEqual(401, self.open("GET", "metrics", raw_response=True).status_code)
+
+        # Cleanup
+        self.headers = {}
+        self.login_root()
+        self.open("DELETE", "site/%i" % mid)
+        self.open("DELETE", "user/%i" % uid)
+
     def test_foreign_key(self):
         self.login_root()
 
@@ -248,6 +661,8 @@ def comp_data_list(a, b):
             "end": end_date.strftime(date_format),
         })
         comp_data_list(data, result)
+        # Sent as strings, like before the orjson encoder
+        self.assertEqual("1.0", result[0]["value_min"])
 
         result = self.open("GET", "channel/%i/readings" % channel, content={
             "start": start_date.strftime(date_format),
@@ -292,6 +707,47 @@ def test_contacter(self):
 
         self.assertEqual(["user1_fcm1", "user1_fcm2", "user3_fcm"], self.main.contacter.get_fcm_listeners(mus2))
 
+        # Alarms fired together are coalesced, every device gets a single message
+        sensor1 = self.open("POST", "site/%i/sensor" % mus1, content={"name": "sensor1"})["id"]
+        channel1 = self.open("POST", "sensor/%i/channel" % sensor1, content={"name": "ch1", "measure_unit": "C"})["id"]
+        sensor2 = self.open("POST", "site/%i/sensor" % mus2, content={"name": "sensor2"})["id"]
+        channel2 = self.open("POST", "sensor/%i/channel" % sensor2, content={"name": "ch2", "measure_unit": "%"})["id"]
+
+        fcm = FakeFCM()
+        self.main.contacter.fcm = fcm
+        try:
+            self.main.contacter.send_alarms([(channel1, "40"), (channel2, "90")])
+        finally:
+            self.main.contacter.fcm = None
+
+        sent = {tuple(sorted(ids)): message for ids, message in fcm.sent}
+        self.assertEqual(3, len(fcm.sent))
+        self.assertEqual("sensor_range_alarm_summary", sent[("user1_fcm1", "user1_fcm2")]["type"])
+        self.assertEqual(2, len(json.loads(sent[("user1_fcm1", "user1_fcm2")]["alarms"])))
+        self.assertEqual("40 C", sent[("user2_fcm",)]["value"])
+        self.assertEqual("90 %", sent[("user3_fcm",)]["value"])
+
+        # Telegram chats get the same coalesced alarms, a rate limited message is sent again
+        self.open("PUT", "user/%i/contact/telegram/%i" % (user1, 101))
+        self.open("PUT", "user/%i/contact/telegram/%i" % (user3, 103))
+        self.assertEqual([101, 103], self.main.contacter.get_telegram_listeners(mus2))
+
+        server = StubTelegramServer(rate_limited=1)
+        self.main.contacter.telegram = TelegramSender("bot-key", base_url=server.url, chat_rate=100)
+        try:
+            self.main.contacter.send_alarms([(channel1, "40"), (channel2, "90")])
+        finally:
+            self.main.contacter.telegram.close()
+            self.main.contacter.telegram = None
+            server.shutdown()
+            server.server_close()
+
+        sent = {chat_id: text for _, chat_id, text in server.messages}
+        self.assertEqual({"/botbot-key/sendMessage"}, {path for path, _, _ in server.messages})
+        self.assertEqual(2, len(server.messages))
+        self.assertTrue(sent[101].startswith("2 alarms!"))
+        self.assertIn("sensor2 - ch2: 90 %", sent[103])
+
         self.open("DELETE", "user/%i" % user1)
         self.open("DELETE", "user/%i" % user2)
         self.open("DELETE", "user/%i" % user3)
@@ -323,6 +779,16 @@ def test_user_password_misc(self):
         self.login("user2", "password22")
         self.open("GET", "user_me")
 
+        # The credentials are cached, authenticated requests don't query the users
+        queries = []
+        listener = lambda conn, cursor, statement, *args: queries.append(statement)
+        sqlalchemy.event.listen(models.db.engine, "before_cursor_execute", listener)
+        try:
+            self.assertEqual("user2", self.open("GET", "user_me")["username"])
+        finally:
+            sqlalchemy.event.remove(models.db.engine, "before_cursor_execute", listener)
+        self.assertEqual([], [q for q in queries if re.search(r"FROM user\b", q)])
+
         # The user should be able to change it's contacts
         self.open("PUT", "user/%i/contact/fcm/%s" % (user2, "fcm2"))
         # But it not be able to change other user's contacts
@@ -405,21 +871,382 @@ def test_alarm_controller(self):
         session.commit()
 
         finder = alarm.AlarmFinder()
+        finder.clock = lambda: datetime.datetime(2019, 5, 2, 11, 30)
+
+        # On the first start only the last max_window is checked, not the whole history
+        finder.last_time = datetime.datetime.min
+        mmin, mmax = finder.compare_data(session)
+        self.assertEqual({}, mmin)
+        self.assertEqual([[250.0, datetime.datetime(2019, 5, 2, 11)]], list(mmax.values()))
+
+        # After a downtime the backlog is checked one max_window at a time
+        finder = alarm.AlarmFinder()
+        finder.clock = lambda: datetime.datetime(2019, 5, 2, 11, 30)
+        finder.last_time = datetime.datetime(2019, 5, 2, 7, 30)
+        found = []
+        for _ in range(4):
+            mmin, mmax = finder.compare_data(session)
+            found.append(sorted([k.channel_id for k in mmin] + [-k.channel_id for k in mmax]))
+            self.assertEqual(finder.last_time < finder.clock(), finder.catching_up)
+        self.assertEqual([[channel2], [channel], [], [-channel]], found)
+        self.assertFalse(finder.catching_up)
+
+        finder = alarm.AlarmFinder()
+        finder.clock = lambda: datetime.datetime(2019, 5, 2, 12)
+        finder.max_window = datetime.timedelta(days=1)
         finder.last_time = datetime.datetime.min
+        self.assertTrue(finder.has_new_data(session))
         mmin, mmax = finder.compare_data(session)
+        self.assertFalse(finder.has_new_data(session))
+        # Range only channels: just the rows with the extremes (and the last one) are read
+        self.assertEqual(4, finder.rows_scanned)
         chmin = {k.channel_id: v for k, v in mmin.items()}
         chmax = {k.channel_id: v for k, v in mmax.items()}
-        self.assertEqual(50.0, chmin[channel][0])
+        self.assertEqual([50.0, datetime.datetime(2019, 5, 2, 9)], chmin[channel])
         self.assertEqual(51.0, chmin[channel2][0])
         self.assertEqual(250.0, chmax[channel][0])
         self.assertEqual(1, len(mmax))
         self.assertEqual(2, len(mmin))
 
+        # The cached channel configuration must be reloaded once the channel is updated
+        self.open("PUT", "channel/%i" % channel, content={"range_min": "40"})
+        finder.last_time = datetime.datetime.min
+        mmin, mmax = finder.compare_data(session)
+        self.assertEqual([channel2], [k.channel_id for k in mmin.keys()])
+
+        # With a rate rule every row of the channel is read
+        self.open("PUT", "channel/%i" % channel2, content={"rate_max": "1000"})
+        finder.last_time = datetime.datetime.min
+        finder.rows_scanned = 0
+        mmin, mmax = finder.compare_data(session)
+        self.assertEqual([channel2], [k.channel_id for k in mmin.keys()])
+        self.assertEqual(2 + 4, finder.rows_scanned)
+
         # Data cleanup
         for x in readings + readings2:
             session.delete(x)
         session.commit()
 
+    def test_alarm_shared_channel_id(self):
+        models.db.create_all(bind="cnr")
+        session = models.db.create_session({})()
+
+        if session.query(models.ReadingData).count() > 0:
+            raise unittest.SkipTest("Cnr database not empty, are you using a real database?")
+
+        self.login_root()
+
+        # Two stations of the same site, both with a channel "1" (with different ranges)
+        site = self.open("POST", "site", content={"name": "shared", "id_cnr": "S"})["id"]
+        channels = []
+        for station, (range_min, range_max) in (("A", ("10", "20")), ("B", ("100", "200"))):
+            sensor = self.open("POST", "site/%i/sensor" % site, content={"name": station, "enabled": True,
+                                                                         "id_cnr": station})["id"]
+            channels.append(self.open("POST", "sensor/%i/channel" % sensor, content={
+                "name": "c", "id_cnr": "1", "range_min": range_min, "range_max": range_max
+            })["id"])
+
+        now = datetime.datetime(2019, 5, 2, 12)
+        readings = []
+        for minute in range(5):
+            date = now - datetime.timedelta(minutes=5 - minute)
+            # In range for A, way under the range of B
+            readings.append(models.ReadingData(site_id="S", station_id="A", channel_id="1",
+                                               value_min=15, value_max=16, date=date))
+            readings.append(models.ReadingData(site_id="S", station_id="B", channel_id="1",
+                                               value_min=15, value_max=16, date=date))
+        session.add_all(readings)
+        session.commit()
+
+        finder = alarm.AlarmFinder()
+        finder.clock = lambda: now
+        finder.last_time = now - datetime.timedelta(hours=1)
+        rules = finder.load_channels(session)
+        self.assertEqual(channels, [rules.get(("S", station, "1")).channel_id for station in ("A", "B")])
+
+        mmin, mmax = finder.compare_data(session)
+        self.assertEqual({channels[1]: 15.0}, {k.channel_id: v[0] for k, v in mmin.items()})
+        self.assertEqual({}, mmax)
+
+        for x in readings:
+            session.delete(x)
+        session.commit()
+        self.open("DELETE", "site/%i" % site)
+
+    def test_upgrade_schema(self):
+        # A database created by the first release
+        engine = sqlalchemy.create_engine("sqlite://")
+        for ddl in [
+            "CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(32), password_hash VARCHAR(128), "
+            "last_password_change BIGINT NOT NULL, permission VARCHAR(1))",
+            "CREATE TABLE site (id INTEGER PRIMARY KEY, name VARCHAR(100), id_cnr VARCHAR(50))",
+            "CREATE TABLE user_access (user_id INTEGER, site_id INTEGER, PRIMARY KEY (user_id, site_id))",
+            "CREATE TABLE sensor (id INTEGER PRIMARY KEY, site_id INTEGER NOT NULL, id_cnr VARCHAR(50), "
+            "name VARCHAR(50), loc_x INTEGER, loc_y INTEGER, enabled BOOLEAN NOT NULL, status VARCHAR(100) NOT NULL)",
+            "CREATE TABLE channel (id INTEGER PRIMARY KEY, sensor_id INTEGER NOT NULL, id_cnr VARCHAR(50), "
+            "name VARCHAR(50), measure_unit VARCHAR(50), range_min NUMERIC, range_max NUMERIC)",
+            "INSERT INTO site (id, name) VALUES (1, 'old')",
+            "INSERT INTO user_access (user_id, site_id) VALUES (1, 1)",
+            "INSERT INTO sensor (id, site_id, enabled, status) VALUES (1, 1, 1, 'ok')",
+            "INSERT INTO channel (id, sensor_id, range_min) VALUES (1, 1, 10)",
+        ]:
+            engine.execute(ddl)
+
+        for model, columns in ADDED_COLUMNS:
+            self.assertEqual(columns, util.add_missing_columns(engine, model.__table__, columns))
+            self.assertEqual([], util.add_missing_columns(engine, model.__table__, columns))
+
+            # The existing rows can be read with the new model
+            row = engine.execute(model.__table__.select()).first()
+            self.assertEqual(0, row.version)
+            indexes = [x["column_names"] for x in sqlalchemy.inspect(engine).get_indexes(model.__tablename__)]
+            self.assertIn(["version"], indexes)
+
+        self.assertIsNone(engine.execute(models.Channel.__table__.select()).first().rate_max)
+
+        self.assertEqual([models.Site], ADDED_INDEXES)
+        self.assertEqual(["ix_site_id_cnr", "ix_site_name"], util.add_missing_indexes(engine, models.Site.__table__))
+        self.assertEqual([], util.add_missing_indexes(engine, models.Site.__table__))
+
+    def test_alarm_manager(self):
+        models.db.create_all(bind="cnr")
+        session = models.db.create_session({})()
+
+        if session.query(models.ReadingData).count() > 0:
+            raise unittest.SkipTest("Cnr database not empty, are you using a real database?")
+
+        self.login_root()
+
+        site = self.open("POST", "site", content={"name": "testsite", "id_cnr": "2000"})["id"]
+        sensor = self.open("POST", "site/%i/sensor" % site, content={"name": "s", "enabled": True, "id_cnr": "3333"})["id"]
+        channel = self.open("POST", "sensor/%i/channel" % sensor, content={
+            "name": "c", "id_cnr": "4444", "range_min": "10", "range_max": "20"
+        })["id"]
+
+        now = datetime.datetime.now()
+        readings = [
+            models.ReadingData(site_id="2000", station_id="3333", channel_id="4444",
+                               value_min=5, value_max=15, date=now - datetime.timedelta(minutes=2)),
+        ]
+        session.add_all(readings)
+        session.commit()
+
+        contacter = StubContacter()
+        manager = alarm.AlarmManager(contacter)
+        manager.alarm_finder.last_time = now - datetime.timedelta(minutes=10)
+        self.assertEqual(alarm.TICK_ACTIVE, manager.on_timer_tick())
+
+        self.assertEqual([(channel, "5.0")], contacter.sent)
+
+        # No new readings: the timer can slow down even if the alarm is still running
+        self.assertEqual(alarm.TICK_IDLE, manager.on_timer_tick())
+        self.assertEqual(alarm.TICK_NORMAL, alarm.AlarmManager(contacter).tick_result(True, False))
+        behind = alarm.AlarmManager(contacter)
+        behind.alarm_finder.catching_up = True
+        self.assertEqual(alarm.TICK_ACTIVE, behind.tick_result(True, False))
+        self.assertEqual(alarm.TICK_ACTIVE, manager.tick_result(True, False))
+        self.assertEqual([channel], [x.channel_id for x in session.query(models.AlarmedChannel).all()])
+        self.assertEqual("[%i] fired" % channel, self.open("GET", "sensor/%i" % sensor)["status"])
+
+        # The state is persisted, a new manager should find the running alarm
+        manager = alarm.AlarmManager(contacter)
+        with alarm.session_scope() as s:
+            manager.load_alarmed_channels(s)
+        self.assertEqual([channel], [x.channel_id for x in manager.alarmed_channels])
+
+        # Back in range
+        readings.append(models.ReadingData(site_id="2000", station_id="3333", channel_id="4444",
+                                           value_min=12, value_max=15, date=now - datetime.timedelta(minutes=1)))
+        session.add(readings[-1])
+        session.commit()
+
+        manager.alarm_finder.last_time = now - datetime.timedelta(minutes=2)
+        self.assertEqual(alarm.TICK_ACTIVE, manager.on_timer_tick())
+        self.assertEqual(alarm.TICK_IDLE, manager.on_timer_tick())
+
+        self.assertEqual(0, session.query(models.AlarmedChannel).count())
+        self.assertEqual("ok", self.open("GET", "sensor/%i" % sensor)["status"])
+        self.assertEqual(1, len(contacter.sent))
+
+        # Alarms saved by older versions, the file is renamed only if the import is committed
+        legacy = alarm.AlarmedChannelData(site, sensor, channel, "2000", "3333", "4444", 10, 20)
+        missing = alarm.AlarmedChannelData(site, sensor, 999999, "2000", "3333", "9999", 10, 20)
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "alarmed_channels.txt"
+            with path.open("wb") as f:
+                pickle.dump({missing: now}, f)
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                manager.alarm_store.import_legacy_file(path)
+            self.assertTrue(path.is_file())
+
+            with path.open("wb") as f:
+                pickle.dump({legacy: now}, f)
+            manager.alarm_store.import_legacy_file(path)
+            self.assertFalse(path.is_file())
+            self.assertTrue((Path(folder) / "alarmed_channels.txt.imported").is_file())
+        self.assertEqual([channel], [x.channel_id for x in session.query(models.AlarmedChannel).all()])
+
+        for x in readings:
+            session.delete(x)
+        session.commit()
+        self.open("DELETE", "site/%i" % site)
+
+    def test_alarm_replay(self):
+        models.db.create_all(bind="cnr")
+        session = models.db.create_session({})()
+
+        if session.query(models.ReadingData).count() > 0:
+            raise unittest.SkipTest("Cnr database not empty, are you using a real database?")
+
+        start = datetime.datetime(2019, 5, 1)
+        end = start + datetime.timedelta(hours=2)
+        sites = alarm_replay.make_fixture(session, start, end, channels=20, excursion_probability=0.01)
+
+        manager = alarm.AlarmManager(alarm_replay.RecordingContacter())
+        report = alarm_replay.replay(manager, start, end, interval=60)
+
+        self.assertEqual(120, report.ticks)
+        self.assertEqual(20 * 119, report.rows_scanned)  # The readings at start were already checked
+        self.assertGreater(report.alarms_started, 0)
+        self.assertIn("compare_data", report.phases)
+        self.assertEqual(report.alarms_started - report.alarms_ended, report.still_running)
+        self.assertIn("still running: %i" % report.still_running, str(report))
+
+        session.query(models.ReadingData).delete()
+        session.query(models.AlarmedChannel).delete()
+        session.query(models.Site).filter(models.Site.id.in_(sites)).delete(synchronize_session=False)
+        session.commit()
+
+    def test_login_throttle(self):
+        self.login_root()
+        uid = self.open("POST", "user", content={"username": "throttled", "password": "pass1"})["id"]
+
+        # Outdated hash parameters are upgraded on login, without invalidating the tokens
+        self.login("throttled", "pass1")
+        token = self.headers["Token"]
+        weak_hash = passlib.hash.sha256_crypt.using(rounds=1000).hash("pass1")
+        session = models.db.create_session({})()
+        session.query(models.User).filter(models.User.id == uid).update({models.User.password_hash: weak_hash})
+        session.commit()
+
+        self.login("throttled", "pass1")
+        user = session.query(models.User).filter(models.User.id == uid).one()
+        self.assertNotEqual(weak_hash, user.password_hash)
+        self.assertTrue(user.verify_password("pass1"))
+        self.headers["Token"] = token
+        self.open("GET", "user_me")
+        session.close()
+
+        rest_controller.configure_login(username_per_minute=2)
+        try:
+            # Only the failed attempts count for the username
+            for _ in range(3):
+                self.login("throttled", "pass1")
+
+            for _ in range(2):
+                response = self.open("POST", "token", content={"username": "throttled", "password": "x"},
+                                     raw_response=True)
+                self.assertEqual(404, response.status_code)
+
+            response = self.open("POST", "token", content={"username": "throttled", "password": "pass1"},
+                                 raw_response=True)
+            self.assertEqual(429, response.status_code)
+            self.assertGreater(int(response.headers["Retry-After"]), 0)
+
+            # Other users are not affected
+            self.login_root()
+        finally:
+            rest_controller.configure_login(username_per_minute=1000)
+
+        # Behind a trusted proxy the attempts are counted by the client address in X-Forwarded-For
+        wsgi_app, proxy_fix = main.app.wsgi_app, main.config.get("proxy_fix")
+        main.config["proxy_fix"] = {"x_for": 1}
+        main.setup_proxy_fix()
+        rest_controller.configure_login(address_per_minute=2)
+        try:
+            def attempt(address):
+                headers = dict(self.headers)
+                headers["X-Forwarded-For"] = address
+                return self.open("POST", "token", content={"username": "throttled", "password": "x"},
+                                 headers=headers, raw_response=True).status_code
+
+            self.assertEqual([404, 404, 429], [attempt("10.0.0.1") for _ in range(3)])
+            self.assertEqual(404, attempt("10.0.0.2"))
+        finally:
+            main.app.wsgi_app = wsgi_app
+            main.config["proxy_fix"] = proxy_fix
+            rest_controller.configure_login(address_per_minute=1000)
+
+        self.open("DELETE", "user/%i" % uid)
+
+    def test_stateless_tokens(self):
+        self.login_root()
+        uid = self.open("POST", "user", content={"username": "stateless", "password": "pass1"})["id"]
+
+        rest_controller.configure_tokens(stateless_tokens=True)
+        try:
+            self.login("stateless", "pass1")
+            self.assertEqual("U", self.open("GET", "user_me")["permission"])
+
+            # Authorized using the claims, the users are not queried anymore
+            queries = []
+            listener = lambda conn, cursor, statement, *args: queries.append(statement)
+            sqlalchemy.event.listen(models.db.engine, "before_cursor_execute", listener)
+            try:
+                self.open("GET", "user_me")
+                self.open("GET", "site")
+            finally:
+                sqlalchemy.event.remove(models.db.engine, "before_cursor_execute", listener)
+            self.assertEqual([], [q for q in queries if re.search(r"FROM user\b", q)])
+
+            # A permission change revokes the token
+            user_token = self.headers["Token"]
+            self.login_root()
+            self.open("PUT", "user/%i" % uid, content={"permission": "A"})
+            self.headers["Token"] = user_token
+            self.assertEqual(401, self.open("GET", "user_me", raw_response=True).status_code)
+
+            # And so does a password change
+            self.login("stateless", "pass1")
+            self.assertEqual("A", self.open("GET", "user_me")["permission"])
+            self.open("PUT", "user/%i" % uid, content={"password": "pass2"})
+            self.assertEqual(401, self.open("GET", "user_me", raw_response=True).status_code)
+
+            # Expired tokens are rejected
+            rest_controller.configure_tokens(stateless_tokens=True, token_lifetime=-1)
+            self.login("stateless", "pass2")
+            self.assertEqual(401, self.open("GET", "user_me", raw_response=True).status_code)
+        finally:
+            rest_controller.configure_tokens(stateless_tokens=False, token_lifetime=7 * 24 * 3600)
+
+        self.login_root()
+        self.open("DELETE", "user/%i" % uid)
+
+    def test_fcm_fanout(self):
+        session = models.db.create_session({})()
+        channels, users = fcm_fanout.make_fixture(session, devices=2500, sites=2, users=10, sites_per_user=2)
+
+        server = fcm_fanout.StubFCMServer(latency=0)
+        contacter = self.main.contacter
+        contacter.load_config(fcm_api_key="test", telegram_api_key=None, fcm_endpoint=server.url)
+        contacter.start()
+        try:
+            report = fcm_fanout.run(contacter, server, channels, bursts=1, alarms_per_burst=2, timeout=10)
+        finally:
+            contacter.stop()
+            contacter.fcm = None
+            server.stop()
+
+        # Every device listens to both sites: a single message, split in batches of 1000 devices
+        self.assertEqual(0, report.timeouts)
+        self.assertEqual(2500, report.devices)
+        self.assertEqual(3, report.requests)
+        self.assertEqual(1000, report.max_batch)
+
+        session.query(models.User).filter(models.User.id.in_(users)).delete(synchronize_session=False)
+        session.query(models.Site).filter(models.Site.id.in_([s for _, s in channels])).delete(synchronize_session=False)
+        session.commit()
+
     def test_image_resize(self):
         self.login_root()
 
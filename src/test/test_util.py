@@ -0,0 +1,411 @@
+import gzip
+import io
+import json
+import logging
+import random
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+
+from itsdangerous import BadSignature
+from sqlalchemy import create_engine
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from benchmark import json_encoding
+from util.compression import CompressionMiddleware
+from util.dispatch import DispatchQueue
+from util.json_encoder import dumps, dumps_std
+from util.logging import install_async_handlers, SlowQueryLog
+from util.metrics import Registry
+from util.password import PasswordHasher, HasherBusy
+from util.ratelimit import TokenBucket, KeyedTokenBuckets
+from util.signing import KeyRingSerializer, load_keys_file, rotate_keys_file
+from util.timer import AdaptiveTimer, TICK_IDLE, TICK_ACTIVE, TICK_NORMAL
+
+
+def wsgi_app(chunks, content_type="application/json", content_length=True, headers=()):
+    def app(environ, start_response):
+        response_headers = [("Content-Type", content_type), ("Vary", "Token")] + list(headers)
+        if content_length:
+            response_headers.append(("Content-Length", str(sum(len(x) for x in chunks))))
+        start_response("200 OK", response_headers)
+        return iter(chunks)
+    return app
+
+
+class CompressionTestCase(unittest.TestCase):
+    def get(self, app, encoding="gzip"):
+        client = Client(CompressionMiddleware(app, min_size=100), BaseResponse)
+        return client.get("/", headers={"Accept-Encoding": encoding} if encoding else {})
+
+    def test_compress(self):
+        body = [b'{"value": 1234}, ' * 20, b'{"value": 5678}' * 20]
+        for content_length in (True, False):
+            res = self.get(wsgi_app(body, content_length=content_length, headers=[("ETag", '"abc"')]))
+            self.assertEqual("gzip", res.headers["Content-Encoding"])
+            self.assertEqual("Token, Accept-Encoding", res.headers["Vary"])
+            self.assertEqual('W/"abc"', res.headers["ETag"])
+            self.assertNotIn("Content-Length", res.headers)
+            self.assertEqual(b"".join(body), gzip.decompress(res.data))
+
+        res = self.get(wsgi_app(body), encoding="deflate;q=1, gzip;q=0.5")
+        self.assertEqual("deflate", res.headers["Content-Encoding"])
+        self.assertEqual(b"".join(body), zlib.decompress(res.data))
+
+        # Streamed: compressed once the min size is reached
+        res = self.get(wsgi_app([b"x" * 30] * 100, content_length=False))
+        self.assertEqual(b"x" * 3000, gzip.decompress(res.data))
+
+    def test_close(self):
+        # The application iterable is closed even if the response is never iterated
+        closed = []
+
+        class Body:
+            def __iter__(self):
+                return iter([b"a" * 1000])
+
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return Body()
+
+        response = CompressionMiddleware(app)({"HTTP_ACCEPT_ENCODING": "gzip", "REQUEST_METHOD": "GET"},
+                                              lambda status, headers, exc_info=None: None)
+        response.close()
+        self.assertEqual([True], closed)
+
+    def test_skip(self):
+        big = [b"a" * 1000]
+        # app, Accept-Encoding, Content-Encoding sent, Vary on Accept-Encoding
+        cases = [
+            (wsgi_app([b"small"]), "gzip", None, True),
+            (wsgi_app([b"sm", b"all"], content_length=False), "gzip", None, True),
+            (wsgi_app(big, content_type="image/png"), "gzip", None, False),
+            (wsgi_app(big, headers=[("Content-Encoding", "br")]), "gzip", "br", False),
+            (wsgi_app(big, headers=[("Cache-Control", "no-transform")]), "gzip", None, False),
+            (wsgi_app(big), "identity", None, True),
+            (wsgi_app(big), "gzip;q=0", None, True),
+            (wsgi_app(big), None, None, True),
+        ]
+        for app, accept, encoding, vary in cases:
+            res = self.get(app, accept)
+            self.assertEqual(encoding, res.headers.get("Content-Encoding"))
+            self.assertEqual(vary, "Accept-Encoding" in res.headers["Vary"])
+            self.assertIn(res.data, (b"small", b"a" * 1000))
+
+
+class JSONEncoderTestCase(unittest.TestCase):
+    def test_encode(self):
+        data = {
+            "date": datetime(2019, 5, 1, 12, 30, 15, 120000),
+            "range_min": Decimal("10.5000000000"),
+            "values": [1, 2.5, None, True, "è"],
+            "big": 2 ** 70,
+        }
+        expected = {
+            "date": "2019-05-01T12:30:15.120000Z",
+            "range_min": "10.5000000000",
+            "values": [1, 2.5, None, True, "è"],
+            "big": 2 ** 70,
+        }
+        for encoder in (dumps, dumps_std):
+            self.assertEqual(expected, json.loads(encoder(data).decode()))
+
+        with self.assertRaises(TypeError):
+            dumps({"x": object()})
+
+    def test_benchmark(self):
+        report = json_encoding.bench({"readings": json_encoding.make_readings(100),
+                                      "channels": json_encoding.make_channels(10)}, repeat=1)
+        self.assertIn("stdlib", report)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((threading.current_thread(), record.getMessage()))
+
+
+class RecordingFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def format(self, record):
+        self.calls.append((threading.current_thread(), record.exc_info is not None))
+        return super().format(record)
+
+
+class LoggingTestCase(unittest.TestCase):
+    def test_async_handlers(self):
+        handler = RecordingHandler()
+        handler.name = "test_async"
+        loggers = [logging.getLogger("test.async.a"), logging.getLogger("test.async.b")]
+        for logger in loggers:
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+        listeners = install_async_handlers(["test_async", "missing"])
+        self.assertEqual(1, len(listeners))
+        self.assertIs(loggers[0].handlers[0], loggers[1].handlers[0])
+        loggers[0].info("first %i", 1)
+        loggers[1].info("second")
+        listeners[0].stop()
+
+        self.assertEqual(["first 1", "second"], [msg for _, msg in handler.records])
+        self.assertNotIn(threading.current_thread(), [thread for thread, _ in handler.records])
+
+        # The formatting (and the traceback) is left to the listener
+        formatter = RecordingFormatter()
+        stream_handler = logging.StreamHandler(io.StringIO())
+        stream_handler.name = "test_async_format"
+        stream_handler.setFormatter(formatter)
+        logger = logging.getLogger("test.async.c")
+        logger.addHandler(stream_handler)
+        logger.propagate = False
+
+        listeners = install_async_handlers(["test_async_format"])
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.error("failed %s", "here", exc_info=True)
+        listeners[0].stop()
+
+        self.assertEqual(1, len(formatter.calls))
+        thread, has_exc_info = formatter.calls[0]
+        self.assertIsNot(threading.current_thread(), thread)
+        self.assertTrue(has_exc_info)
+        output = stream_handler.stream.getvalue()
+        self.assertIn("failed here", output)
+        self.assertIn("ValueError: boom", output)
+
+    def test_slow_query_log(self):
+        engine = create_engine("sqlite://")
+        slow_log = SlowQueryLog(threshold=0.0, rnd=random.Random(0))
+        slow_log.install(engine, "test")
+
+        with self.assertLogs("sql.slow", level="INFO") as logs:
+            engine.execute("SELECT ? + 1", 41).scalar()
+        self.assertEqual(1, len(logs.records))
+        self.assertEqual(logging.WARNING, logs.records[0].levelno)
+        self.assertRegex(logs.output[0], r"slow test [\d.]+ms: SELECT \? \+ 1 \| params: \(41,\)")
+
+        # Fast statements: only the sampled ones
+        slow_log.threshold = 60
+        slow_log.sample_rate = 0.5
+        slow_log.log_params = False
+        with self.assertLogs("sql.slow", level="INFO") as logs:
+            for _ in range(100):
+                engine.execute("SELECT 1").scalar()
+        self.assertTrue(20 < len(logs.records) < 80)
+        self.assertTrue(all(x.levelno == logging.INFO for x in logs.records))
+        self.assertNotIn("params", logs.output[0])
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        requests = registry.counter("requests_total", "Requests", ["method"])
+        latency = registry.histogram("latency_seconds", "Latency", ["path"], buckets=[0.1, 1])
+        requests.inc("GET")
+        requests.inc("GET", amount=2)
+        requests.inc('P"O\\ST')
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value, "/a")
+
+        self.assertEqual(3, requests.get("GET"))
+        self.assertEqual(4, latency.get_count("/a"))
+        with self.assertRaises(ValueError):
+            requests.inc()
+        with self.assertRaises(ValueError):
+            registry.counter("requests_total", "Again")
+
+        self.assertEqual("\n".join([
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{method="GET"} 3',
+            'requests_total{method="P\\"O\\\\ST"} 1',
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{path="/a",le="0.1"} 2',
+            'latency_seconds_bucket{path="/a",le="1"} 3',
+            'latency_seconds_bucket{path="/a",le="+Inf"} 4',
+            'latency_seconds_sum{path="/a"} 3.65',
+            'latency_seconds_count{path="/a"} 4',
+        ]) + "\n", registry.render())
+
+
+class DispatchQueueTestCase(unittest.TestCase):
+    def test_retry(self):
+        attempts = []
+        done = threading.Event()
+
+        def flaky(x):
+            attempts.append(x)
+            if len(attempts) < 3:
+                raise IOError("Network down")
+            done.set()
+
+        dispatcher = DispatchQueue("test", workers=2, retry_backoff=0.01)
+        dispatcher.start()
+        self.assertTrue(dispatcher.submit(flaky, 42))
+        self.assertTrue(done.wait(5))
+        dispatcher.stop()
+
+        self.assertEqual([42, 42, 42], attempts)
+
+    def test_retry_releases_worker(self):
+        # While a job waits for its retry the only worker runs the other jobs
+        attempts = []
+        done = threading.Event()
+        retried = threading.Event()
+
+        def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise IOError("Network down")
+            retried.set()
+
+        dispatcher = DispatchQueue("test", workers=1, retry_backoff=0.5)
+        dispatcher.start()
+        dispatcher.submit(flaky)
+        dispatcher.submit(done.set)
+        self.assertTrue(done.wait(0.4))
+        self.assertFalse(retried.is_set())
+        self.assertTrue(retried.wait(5))
+        dispatcher.stop()
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.5)
+
+    def test_dead_letter(self):
+        dispatcher = DispatchQueue("test", workers=1, max_size=1, max_retries=1, retry_backoff=0.01)
+
+        def fail():
+            raise IOError("Network down")
+
+        with self.assertLogs("dead_letter", level="ERROR") as logs:
+            # Not started, the job is run synchronously
+            self.assertFalse(dispatcher.submit(fail, description="failing job"))
+        self.assertIn("failing job", logs.output[0])
+
+        blocker = threading.Event()
+        dispatcher.start()
+        with self.assertLogs("dead_letter", level="ERROR") as logs:
+            dispatcher.submit(blocker.wait)
+            # Fill the queue (the first job may still be in the queue or running)
+            results = [dispatcher.submit(fail) for _ in range(3)]
+            self.assertIn(False, results)
+            blocker.set()
+            dispatcher.stop()
+        self.assertTrue(any("queue full" in x for x in logs.output))
+
+    def test_drain(self):
+        done = []
+        dispatcher = DispatchQueue("test", workers=2)
+        dispatcher.start()
+        for i in range(50):
+            dispatcher.submit(done.append, i)
+        dispatcher.stop()
+        self.assertEqual(list(range(50)), sorted(done))
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def test_timeout(self):
+        hasher = PasswordHasher(workers=1, timeout=0.001)
+        try:
+            # Reported as busy, so the login answers 503 with Retry-After
+            with self.assertRaises(HasherBusy):
+                hasher.hash("password")
+
+            hasher.configure(timeout=30.0)
+            phash = hasher.hash("password")
+            self.assertEqual((True, None), hasher.verify_and_update("password", phash))
+        finally:
+            hasher.stop()
+
+
+class AdaptiveTimerTestCase(unittest.TestCase):
+    def test_intervals(self):
+        timer = AdaptiveTimer(10, None, min_interval=2, max_interval=35, backoff=2)
+
+        self.assertEqual(2, timer.next_interval(TICK_ACTIVE))
+        self.assertEqual(10, timer.next_interval(TICK_NORMAL))
+
+        intervals = []
+        for _ in range(4):
+            timer.current_interval = timer.next_interval(TICK_IDLE)
+            intervals.append(timer.current_interval)
+        self.assertEqual([20, 35, 35, 35], intervals)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        now = [0.0]
+        bucket = TokenBucket(2, capacity=3, clock=lambda: now[0])
+
+        # Bursts up to the capacity, then the tokens come back at rate per second
+        self.assertEqual([0, 0, 0], [bucket.try_acquire() for _ in range(3)])
+        self.assertAlmostEqual(0.5, bucket.try_acquire())
+        self.assertAlmostEqual(0.5, bucket.wait_time())
+        now[0] = 0.5
+        self.assertEqual(0, bucket.wait_time())
+        self.assertEqual(0, bucket.try_acquire())
+        now[0] = 100
+        self.assertTrue(bucket.is_full())
+
+        # Pausing the bucket blocks it for the given seconds
+        bucket.pause(2)
+        self.assertAlmostEqual(2.5, bucket.try_acquire())
+
+    def test_keyed(self):
+        now = [0.0]
+        buckets = KeyedTokenBuckets(1, max_keys=2, clock=lambda: now[0])
+
+        self.assertEqual(0, buckets.try_acquire("a"))
+        self.assertEqual(0, buckets.try_acquire("b"))
+        self.assertGreater(buckets.try_acquire("a"), 0)
+
+        # The least recently used bucket is discarded when there are too many keys
+        buckets.try_acquire("c")
+        self.assertEqual(["a", "c"], list(buckets.buckets.keys()))
+        for i in range(100):
+            buckets.try_acquire(i)
+        self.assertEqual(2, len(buckets.buckets))
+
+
+class SigningKeysTestCase(unittest.TestCase):
+    def test_keys_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "keys" / "signing_keys"
+
+            # Created on the first load, then every process reads the same key
+            keys = load_keys_file(path)
+            self.assertEqual(1, len(keys))
+            self.assertEqual(keys, load_keys_file(path))
+
+            rotated = rotate_keys_file(path)
+            self.assertEqual([rotated[0]] + keys, rotated)
+            self.assertEqual(rotated, load_keys_file(path))
+            self.assertEqual(2, len(rotate_keys_file(path, keep=2)))
+
+    def test_rotation(self):
+        old = KeyRingSerializer(["old key"])
+        token = old.dumps({"id": 1})
+
+        rotated = KeyRingSerializer(["new key", "old key"])
+        self.assertEqual({"id": 1}, rotated.loads(token))
+        self.assertEqual({"id": 2}, KeyRingSerializer(["new key"]).loads(rotated.dumps({"id": 2})))
+
+        with self.assertRaises(BadSignature):
+            KeyRingSerializer(["new key"]).loads(token)
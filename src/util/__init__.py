@@ -1,14 +1,18 @@
+import logging
 import sqlite3
 import time
 from datetime import datetime
 from typing import List
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event, Column, String
+from sqlalchemy import event, inspect, literal, Column, String, Table
 from sqlalchemy.engine import Engine
 
 date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
 
+# Bound now, util.logging replaces the logging name in this package once imported
+logger = logging.getLogger(__name__)
+
 
 def parse_date(s: str) -> datetime:
     """Parses the datetime following a simplified ISO-8601 standard"""
@@ -49,6 +53,52 @@ def fix_db_string_collation(db: SQLAlchemy):
             t.collation = get_actual_collation(t.collation, engine.name)
 
 
+def add_missing_columns(engine: Engine, table: Table, names: List[str]) -> List[str]:
+    """
+    Adds the columns that the table gained after it was created (create_all doesn't alter tables),
+    with their indexes. The NOT NULL columns need a scalar default, used to fill the existing rows.
+    Returns the names of the columns added.
+    """
+    existing = {c["name"] for c in inspect(engine).get_columns(table.name)}
+    preparer = engine.dialect.identifier_preparer
+
+    added = []
+    for name in names:
+        col = table.columns[name]
+        if col.name in existing:
+            continue
+
+        definition = "{} {}".format(preparer.format_column(col), col.type.compile(dialect=engine.dialect))
+        if not col.nullable:
+            if col.default is None or not col.default.is_scalar:
+                raise ValueError("Cannot add the NOT NULL column {}.{} without a default".format(table.name, col.name))
+            default = literal(col.default.arg, col.type).compile(dialect=engine.dialect,
+                                                                 compile_kwargs={"literal_binds": True})
+            definition += " NOT NULL DEFAULT {}".format(default)
+
+        engine.execute("ALTER TABLE {} ADD COLUMN {}".format(preparer.format_table(table), definition))
+        logger.warning("Added the missing column %s.%s", table.name, col.name)
+        added.append(col.name)
+
+    for index in table.indexes:
+        if any(c.name in added for c in index.columns):
+            index.create(engine)
+    return added
+
+
+def add_missing_indexes(engine: Engine, table: Table) -> List[str]:
+    """Creates the indexes of the table that are missing in the database (create_all skips the existing tables)"""
+    existing = {x["name"] for x in inspect(engine).get_indexes(table.name)}
+    added = []
+    for index in sorted(table.indexes, key=lambda x: x.name):
+        if index.name in existing:
+            continue
+        index.create(engine)
+        logger.warning("Added the missing index %s", index.name)
+        added.append(index.name)
+    return added
+
+
 def get_actual_collation(collation, engine):
     translation_table = {
         "mysql": {
@@ -0,0 +1,120 @@
+import time
+from typing import Callable, Dict, Any, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import ConfigVersion
+
+
+class SharedVersion:
+    """
+    Version counter stored in the config database, used to invalidate in-memory caches.
+
+    Bumping the version invalidates the caches of this process as soon as the transaction is committed,
+    the other processes notice the change the next time they refresh the counter
+    (the database is queried at most once every refresh_interval seconds).
+    """
+    def __init__(self, name: str, refresh_interval: float = 10.0):
+        self.name = name
+        self.refresh_interval = refresh_interval
+
+        self.db_version = None  # type: int
+        self.generation = 0  # Local changes, incremented by every commit that bumped the version
+        self._last_refresh = 0.0
+
+    def bump(self, session: Session):
+        """Increments the version, the change becomes visible once the session is committed"""
+        # Don't flush the pending changes here, their errors should be raised by the caller's commit
+        with session.no_autoflush:
+            updated = session.query(ConfigVersion)\
+                .filter(ConfigVersion.name == self.name)\
+                .update({ConfigVersion.version: ConfigVersion.version + 1}, synchronize_session=False)
+
+        bumped = session.info.setdefault("bumped_versions", set())
+        if updated == 0 and self not in bumped:
+            session.add(ConfigVersion(name=self.name, version=1))
+
+        bumped.add(self)
+        self.invalidate()
+
+    def invalidate(self):
+        self.generation += 1
+        self._last_refresh = 0.0
+
+    def refresh(self, session: Session):
+        version = session.query(ConfigVersion.version).filter(ConfigVersion.name == self.name).scalar()
+        self.db_version = version or 0
+        self._last_refresh = time.time()
+
+    def current(self, session: Session) -> int:
+        """Reads the version from the database, get can be refresh_interval old for the changes made by other processes"""
+        self.refresh(session)
+        return self.db_version
+
+    def get(self, session: Session) -> Tuple[int, int]:
+        """Returns an opaque value that changes every time the version is bumped"""
+        if time.time() - self._last_refresh > self.refresh_interval:
+            self.refresh(session)
+        return self.db_version, self.generation
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_bumped_versions(session):
+    # Readers could have seen the old data between the bump and the commit, invalidate again
+    for version in session.info.pop("bumped_versions", ()):
+        version.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_bumped_versions(session):
+    for version in session.info.pop("bumped_versions", ()):
+        version.invalidate()
+
+
+class VersionedCache:
+    """A dictionary that is emptied every time one of its versions changes"""
+    def __init__(self, *versions: SharedVersion):
+        self.versions = versions
+        self.data = {}  # type: Dict[Any, Any]
+        self._built_at = None
+
+    def validate(self, session: Session) -> Dict[Any, Any]:
+        current = tuple(v.get(session) for v in self.versions)
+        if current != self._built_at:
+            # Replace the dict instead of clearing it, other threads might still be using the old one
+            self.data = {}
+            self._built_at = current
+        return self.data
+
+    def get(self, session: Session, key, loader: Callable[[Any], Any]):
+        data = self.validate(session)
+        try:
+            return data[key]
+        except KeyError:
+            value = loader(key)
+            data[key] = value
+            return value
+
+    def get_many(self, session: Session, keys, loader: Callable[[list], Dict[Any, Any]]) -> Dict[Any, Any]:
+        """Returns the values of the keys, loading every missing key with a single call to loader"""
+        data = self.validate(session)
+        missing = [k for k in keys if k not in data]
+        if missing:
+            data.update(loader(missing))
+        return {k: data[k] for k in keys if k in data}
+
+    def clear(self):
+        self.data = {}
+        self._built_at = None
+
+
+# Versions shared by the whole server
+# channel_config: sites, sensors and channels (names, cnr ids, alarm thresholds...)
+channel_config_version = SharedVersion("channel_config")
+# user_access: users, their permission and the sites they can access
+user_access_version = SharedVersion("user_access")
+# user_credentials: usernames, permissions and password changes (used to verify the auth tokens)
+user_credentials_version = SharedVersion("user_credentials")
+# user_contact: FCM and telegram contacts of the users
+user_contact_version = SharedVersion("user_contact")
@@ -0,0 +1,160 @@
+import zlib
+from itertools import chain
+from typing import Optional, List, Tuple
+
+from werkzeug.http import parse_accept_header
+
+# Content that is already compressed (or that would not shrink), it is sent as it is
+SKIP_CONTENT_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "application/x-gzip",
+                      "application/octet-stream")
+
+# zlib wbits of the supported encodings: gzip has its own header, deflate is the zlib format (RFC 7230 4.2.2)
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def _get_header(headers: List[Tuple[str, str]], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _add_vary(headers: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    # Keep the Vary values set by the application (ex: Token)
+    vary = _get_header(headers, "Vary")
+    if vary is None:
+        return headers + [("Vary", "Accept-Encoding")]
+    if "accept-encoding" in vary.lower():
+        return headers
+    return [(k, v) for k, v in headers if k.lower() != "vary"] + [("Vary", vary + ", Accept-Encoding")]
+
+
+class _ClosingIterable:
+    """
+    The response of the middleware: closing it closes the body generator and the application iterable,
+    even if the server never started iterating it (ex: the client disconnected).
+    """
+    def __init__(self, body, app_iter):
+        self.body = body
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return self.body
+
+    def close(self):
+        try:
+            self.body.close()
+        finally:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+
+
+class CompressionMiddleware:
+    """
+    WSGI middleware that compresses the responses (gzip or deflate, as asked by the client with Accept-Encoding).
+
+    Only the responses of at least min_size bytes are compressed: when the Content-Length is not known the body is
+    buffered until min_size is reached, then the rest is compressed while it is streamed.
+    Responses already encoded, with a no-transform Cache-Control or with a SKIP_CONTENT_TYPES type are left alone.
+    The compressed responses have a weak ETag, since the bytes are not the same as the identity ones.
+    """
+    def __init__(self, app, min_size=1024, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def choose_encoding(self, environ) -> Optional[str]:
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        best = max(ENCODINGS, key=lambda x: accept.quality(x))  # gzip wins the ties
+        return best if accept.quality(best) > 0 else None
+
+    def is_compressible(self, status: str, headers: List[Tuple[str, str]]) -> bool:
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 304):
+            return False
+        if _get_header(headers, "Content-Encoding") is not None:
+            return False
+        if "no-transform" in (_get_header(headers, "Cache-Control") or "").lower():
+            return False
+        content_type = (_get_header(headers, "Content-Type") or "").lower()
+        return not content_type.startswith(SKIP_CONTENT_TYPES)
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            # Not compressed, but the caches should know that the response depends on Accept-Encoding
+            def add_vary(status, headers, exc_info=None):
+                if self.is_compressible(status, headers):
+                    headers = _add_vary(headers)
+                return start_response(status, headers, exc_info)
+            return self.app(environ, add_vary)
+
+        response = []  # (status, headers, exc_info)
+        written = []  # Data sent with the legacy write callable
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [(status, headers, exc_info)]
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        return _ClosingIterable(self._respond(app_iter, response, written, encoding, start_response), app_iter)
+
+    def _respond(self, app_iter, response, buffered, encoding, start_response):
+        # The app_iter is closed by _ClosingIterable
+        chunks = iter(app_iter)
+        complete = False
+        # Read until the headers are known and we know whether the body is big enough
+        while not complete and not self._can_decide(response, buffered):
+            try:
+                buffered.append(next(chunks))
+            except StopIteration:
+                complete = True
+
+        status, headers, exc_info = response[0]
+        rest = [] if complete else chunks
+
+        if not self.is_compressible(status, headers) or self._is_small(headers, buffered, complete):
+            if self.is_compressible(status, headers):
+                headers = _add_vary(headers)
+            start_response(status, headers, exc_info)
+            yield from chain(buffered, rest)
+            return
+
+        start_response(status, self._compressed_headers(headers, encoding), exc_info)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[encoding])
+        for chunk in chain(buffered, rest):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def _can_decide(self, response: list, buffered: List[bytes]) -> bool:
+        if not response:
+            return False
+        status, headers, _ = response[0]
+        return not self.is_compressible(status, headers) or \
+            _get_header(headers, "Content-Length") is not None or \
+            sum(len(x) for x in buffered) >= self.min_size
+
+    def _is_small(self, headers: List[Tuple[str, str]], buffered: List[bytes], complete: bool) -> bool:
+        length = _get_header(headers, "Content-Length")
+        if length is not None:
+            return int(length) < self.min_size
+        return complete and sum(len(x) for x in buffered) < self.min_size
+
+    @staticmethod
+    def _compressed_headers(headers: List[Tuple[str, str]], encoding: str) -> List[Tuple[str, str]]:
+        res = []
+        for key, value in headers:
+            name = key.lower()
+            if name == "content-length":
+                continue
+            if name == "etag" and not value.startswith("W/"):
+                value = "W/" + value
+            res.append((key, value))
+        return _add_vary(res + [("Content-Encoding", encoding)])
@@ -0,0 +1,178 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional, List
+
+# Jobs that cannot be run (queue full, too many failures) are logged here, so they can be inspected or resent by hand
+dead_letter_log = logging.getLogger("dead_letter")
+
+
+class _Job:
+    def __init__(self, fn: Callable, args: tuple, description: str):
+        self.fn = fn
+        self.args = args
+        self.description = description
+        self.attempts = 0
+
+    def __repr__(self):
+        return self.description or "{}{}".format(getattr(self.fn, "__name__", self.fn), self.args)
+
+
+_STOP = object()
+
+
+class DispatchQueue:
+    """
+    Bounded queue of jobs run in the background by a pool of worker threads.
+
+    submit never blocks: when the queue is full the job goes directly to the dead letter log.
+    Failing jobs are retried with exponential backoff (retry_backoff, 2 * retry_backoff, 4 * ... up to max_backoff)
+    and after max_retries they're written to the dead letter log.
+    While waiting for a retry the job doesn't hold a worker: it is put back in the queue once it's due.
+    When the queue is not started jobs are run synchronously (useful for tests and scripts).
+    """
+    def __init__(self, name: str, workers=4, max_size=1000, max_retries=5, retry_backoff=1.0, max_backoff=60.0,
+                 cleanup: Optional[Callable] = None):
+        self.name = name
+        self.workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.cleanup = cleanup  # Called by the worker thread after every job (ex: to release its db session)
+
+        self.is_running = False
+        self._queue = None  # type: queue.Queue
+        self._threads = []  # type: List[threading.Thread]
+        self._stop_event = threading.Event()
+
+        # Jobs waiting for their retry: heap of (due time, sequence, job), moved to the queue by the retry thread
+        self._delayed = []  # type: List[tuple]
+        self._delayed_cond = threading.Condition()
+        self._sequence = itertools.count()
+        self._retry_thread = None  # type: threading.Thread
+
+    def configure(self, workers=None, max_size=None, max_retries=None, retry_backoff=None, max_backoff=None):
+        if workers is not None: self.workers = workers
+        if max_size is not None: self.max_size = max_size
+        if max_retries is not None: self.max_retries = max_retries
+        if retry_backoff is not None: self.retry_backoff = retry_backoff
+        if max_backoff is not None: self.max_backoff = max_backoff
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._queue = queue.Queue(self.max_size)
+        self._threads = [
+            threading.Thread(target=self._worker, name="{}-{}".format(self.name, i), daemon=True)
+            for i in range(self.workers)
+        ]
+        self._retry_thread = threading.Thread(target=self._retry_worker, name="{}-retry".format(self.name), daemon=True)
+        self.is_running = True
+        for t in self._threads:
+            t.start()
+        self._retry_thread.start()
+
+    def submit(self, fn: Callable, *args, description: str = None) -> bool:
+        """Schedules fn(*args), returns False if the job was discarded"""
+        job = _Job(fn, args, description)
+
+        if not self.is_running:
+            if not self._run_once(job):
+                dead_letter_log.error("%s: job failed, discarding %s", self.name, job)
+                return False
+            return True
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            dead_letter_log.error("%s: queue full, discarding %s", self.name, job)
+            return False
+        return True
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stop(self, timeout: float = 10.0):
+        """Stops the workers after they have run every job still in the queue (failing jobs are not retried)"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._stop_event.set()
+
+        with self._delayed_cond:
+            self._delayed_cond.notify_all()
+        self._retry_thread.join(timeout)
+
+        try:
+            for _ in self._threads:
+                self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logging.error("%s: workers stuck, cannot drain the queue", self.name)
+
+        for t in self._threads:
+            t.join(timeout)
+
+        # Whatever is still in the queue could not be drained in time
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not _STOP:
+                dead_letter_log.error("%s: shutting down, discarding %s", self.name, job)
+
+        with self._delayed_cond:
+            for _, _, job in self._delayed:
+                dead_letter_log.error("%s: shutting down, discarding %s", self.name, job)
+            self._delayed = []
+
+    def _run_once(self, job: _Job) -> bool:
+        job.attempts += 1
+        try:
+            job.fn(*job.args)
+            return True
+        except Exception:
+            logging.exception("%s: job %s failed (attempt %i)", self.name, job, job.attempts)
+            return False
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+
+            try:
+                if not self._run_once(job):
+                    self._schedule_retry(job)
+            finally:
+                if self.cleanup is not None:
+                    self.cleanup()
+
+    def _schedule_retry(self, job: _Job):
+        if job.attempts > self.max_retries or self._stop_event.is_set():
+            dead_letter_log.error("%s: giving up on %s after %i attempts", self.name, job, job.attempts)
+            return
+
+        delay = min(self.retry_backoff * 2 ** (job.attempts - 1), self.max_backoff)
+        with self._delayed_cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), job))
+            self._delayed_cond.notify()
+
+    def _retry_worker(self):
+        with self._delayed_cond:
+            while not self._stop_event.is_set():
+                now = time.monotonic()
+                if not self._delayed or self._delayed[0][0] > now:
+                    self._delayed_cond.wait(self._delayed[0][0] - now if self._delayed else None)
+                    continue
+
+                _, _, job = heapq.heappop(self._delayed)
+                try:
+                    self._queue.put_nowait(job)
+                except queue.Full:
+                    dead_letter_log.error("%s: queue full, discarding %s", self.name, job)
@@ -0,0 +1,39 @@
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from util import date_format
+
+# orjson is a lot faster than the stdlib encoder on big payloads (ex: readings), the stdlib is used when it's missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(obj):
+    """Encodes the types that json doesn't support natively, with the representation the clients already expect"""
+    if isinstance(obj, datetime):
+        return obj.strftime(date_format)
+    if isinstance(obj, Decimal):
+        # Sent as a string to keep the precision (and the wire format)
+        return str(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def dumps_std(obj, indent=None) -> bytes:
+    return json.dumps(obj, default=encode_default, indent=indent).encode()
+
+
+if orjson is not None:
+    # Datetimes go through encode_default too, orjson would use its own ISO format
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, default=encode_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # Ex: integers bigger than 64 bits, the stdlib can handle them
+            return dumps_std(obj)
+else:
+    dumps = dumps_std
@@ -1,6 +1,15 @@
 import os.path
 import os
+import copy
 import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 
 def _decorated_open(fn):
@@ -14,3 +23,100 @@ def fix_add_parent_mkdir_on_log_write():
     """Makes every FileHandler create the parent directories before they start writing"""
     logging.FileHandler._open = _decorated_open(logging.FileHandler._open)
 
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the handler in the listener thread.
+    The stdlib prepare formats the record (traceback included) in the logging thread, this one only merges
+    the message arguments (they could change before the listener gets to them) and keeps exc_info.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def install_async_handlers(names: List[str]) -> List[QueueListener]:
+    """
+    Moves the named handlers (configured with dictConfig) to background threads: every logger that used them
+    gets a QueueHandler instead, a QueueListener thread does the formatting and the file I/O.
+    Returns the listeners, they should be stopped at exit to flush the queued records.
+    """
+    loggers = [logging.getLogger()] + [x for x in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(x, logging.Logger)]
+    listeners = []
+    for name in names:
+        users = [x for x in loggers if any(h.name == name for h in x.handlers)]
+        if not users:
+            continue
+        handler = next(h for h in users[0].handlers if h.name == name)
+
+        queue_handler = DeferredQueueHandler(queue.Queue(-1))
+        queue_handler.name = name
+        for logger in users:
+            logger.handlers = [queue_handler if h is handler else h for h in logger.handlers]
+
+        listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+        listener.start()
+        listeners.append(listener)
+    return listeners
+
+
+def executemany_like(parameters) -> bool:
+    return isinstance(parameters, (list, tuple)) and len(parameters) > 10 and \
+        isinstance(parameters[0], (list, tuple, dict))
+
+
+class SlowQueryLog:
+    """
+    Logs the SQL statements that take more than threshold seconds (WARNING) and a sample_rate fraction
+    of the others (INFO), with their execution time and (if log_params) their bound parameters.
+    It replaces the sqlalchemy DEBUG logging, that writes every statement and every result row.
+    """
+    def __init__(self, threshold=0.1, sample_rate=0.0, log_params=True, max_params_length=1000,
+                 logger="sql.slow", rnd: random.Random = None):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.log_params = log_params
+        self.max_params_length = max_params_length
+        self.log = logging.getLogger(logger)
+        self.random = rnd or random.Random()
+
+    def install(self, engine: Engine, bind: str):
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("slow_log_query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["slow_log_query_start"].pop()
+            self.on_statement(bind, statement, parameters, elapsed)
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(context):
+            starts = context.connection.info.get("slow_log_query_start") if context.connection is not None else None
+            if starts:
+                starts.pop()
+
+    def on_statement(self, bind: str, statement: str, parameters, elapsed: float):
+        if elapsed >= self.threshold:
+            level, kind = logging.WARNING, "slow"
+        elif self.sample_rate > 0 and self.random.random() < self.sample_rate:
+            level, kind = logging.INFO, "sampled"
+        else:
+            return
+
+        if not self.log.isEnabledFor(level):
+            return
+        if self.log_params:
+            if executemany_like(parameters):
+                # Don't build the repr of a huge executemany just to truncate it
+                params = "{!r} ({} rows)".format(parameters[:10], len(parameters))
+            else:
+                params = repr(parameters)
+            if len(params) > self.max_params_length:
+                params = params[:self.max_params_length] + "..."
+            self.log.log(level, "%s %s %.1fms: %s | params: %s", kind, bind, elapsed * 1000, statement, params)
+        else:
+            self.log.log(level, "%s %s %.1fms: %s", kind, bind, elapsed * 1000, statement)
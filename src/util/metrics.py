@@ -0,0 +1,227 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple, Sequence
+
+from flask import Flask, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# In-process metrics exposed in the Prometheus text format (see rest_controller RMetrics).
+# Every process has its own registry: with several gunicorn workers every scrape sees only one of them.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, _escape(str(v))) for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labels):
+            raise ValueError("{} expects the labels {}".format(self.name, self.labels))
+        return tuple(str(x) for x in labels)
+
+    def render(self) -> List[str]:
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values = {}  # type: Dict[Tuple[str, ...], float]
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *labels) -> float:
+        with self._lock:
+            return self.values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.values = {}  # type: Dict[Tuple[str, ...], list]  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)  # First bucket with le >= value
+        with self._lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def get_count(self, *labels) -> int:
+        with self._lock:
+            data = self.values.get(self._key(labels))
+            return data[2] if data else 0
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        le_names = self.labels + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for le, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append("{}_bucket{} {}".format(
+                        self.name, _format_labels(le_names, key + (_format_value(le),)), cumulative))
+                labels = _format_labels(self.labels, key)
+                lines.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+                lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []  # type: List[Metric]
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if any(m.name == metric.name for m in self.metrics):
+                raise ValueError("Metric {} already registered".format(metric.name))
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "oldmusa_http_requests_total", "HTTP requests handled", ["endpoint", "method", "status"])
+http_latency = registry.histogram(
+    "oldmusa_http_request_duration_seconds", "Time spent handling the request", ["endpoint", "method"])
+http_response_size = registry.histogram(
+    "oldmusa_http_response_size_bytes", "Size of the response body (before compression)", ["endpoint", "method"],
+    buckets=SIZE_BUCKETS)
+http_sql_statements = registry.histogram(
+    "oldmusa_http_request_sql_statements", "SQL statements executed by a request", ["endpoint", "method"],
+    buckets=COUNT_BUCKETS)
+http_sql_time = registry.histogram(
+    "oldmusa_http_request_sql_duration_seconds", "Time spent in the database by a request", ["endpoint", "method"])
+
+sql_statements = registry.counter("oldmusa_sql_statements_total", "SQL statements executed", ["bind"])
+sql_latency = registry.histogram("oldmusa_sql_duration_seconds", "SQL statement execution time", ["bind"])
+
+alarm_ticks = registry.counter("oldmusa_alarm_ticks_total", "Alarm ticks run")
+alarm_tick_phases = registry.histogram(
+    "oldmusa_alarm_tick_phase_seconds", "Time spent in every phase of the alarm tick", ["phase"])
+
+
+def _endpoint() -> str:
+    # The route rule (ex: /api/site/<mid>), not the path, to keep the number of series bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def instrument_app(app: Flask):
+    """Measures the latency, the response size and the SQL statements of every request"""
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_time = 0.0
+
+    @app.after_request
+    def end_request_metrics(response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+        endpoint, method = _endpoint(), request.method
+
+        http_latency.observe(time.perf_counter() - start, endpoint, method)
+        http_requests.inc(endpoint, method, response.status_code)
+        http_sql_statements.observe(g.sql_statements, endpoint, method)
+        http_sql_time.observe(g.sql_time, endpoint, method)
+
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = len(response.get_data())
+        if size is not None:
+            http_response_size.observe(size, endpoint, method)
+        return response
+
+
+def instrument_engine(engine: Engine, bind: str):
+    """Counts and times the statements executed on the engine (per bind, and per request when there's one)"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+        sql_statements.inc(bind)
+        sql_latency.observe(elapsed, bind)
+
+        if has_request_context() and "sql_statements" in g:
+            g.sql_statements += 1
+            g.sql_time += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # The statement failed, after_cursor_execute won't be called
+        starts = context.connection.info.get("metrics_query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def observe_tick(phases: Dict[str, float]):
+    alarm_ticks.inc()
+    for name, elapsed in phases.items():
+        alarm_tick_phases.observe(elapsed, name)
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from typing import Optional, Tuple
+
+from passlib.apps import custom_app_context as pwd_context
+
+
+class HasherBusy(Exception):
+    """Too many hashing operations are already waiting for the pool"""
+
+
+# Run in the pool processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, phash: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, phash)
+
+
+class PasswordHasher:
+    """
+    Runs the password hashing and verification (deliberately slow) in a bounded process pool,
+    so a burst of logins can't take every request worker and the CPU away from the rest of the API.
+
+    The calling thread waits for the result, so the app must run in threaded workers (see gunicorn.conf.py):
+    at most max_pending operations can wait for the pool, the others fail immediately with HasherBusy,
+    and the rest of the worker threads keep serving the API. max_pending should be lower than the threads.
+    Operations that don't complete within timeout seconds fail with HasherBusy too.
+    With workers = 0 the operations run in the calling thread.
+    """
+    def __init__(self, workers=2, max_pending=4, timeout=30.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        self._executor_pid = None
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def configure(self, workers=None, max_pending=None, timeout=None):
+        if workers is not None: self.workers = workers
+        if max_pending is not None:
+            self.max_pending = max_pending
+            self._pending = threading.BoundedSemaphore(max_pending)
+        if timeout is not None: self.timeout = timeout
+        self.stop()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # The pool is created lazily in the process that uses it (gunicorn forks the workers after loading the app)
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(self.workers)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+
+        if not self._pending.acquire(blocking=False):
+            logging.warning("Password hasher busy, %d operations pending", self.max_pending)
+            raise HasherBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                future.cancel()  # Only if it's still waiting for a pool process
+                logging.warning("Password hashing took longer than %s seconds", self.timeout)
+                raise HasherBusy()
+        finally:
+            self._pending.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password)
+
+    def verify_and_update(self, password: str, phash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verifies the password, returns (valid, new_hash).
+        new_hash is not None when the hash uses outdated parameters and should be replaced.
+        """
+        if not phash:
+            return False, None
+        return self._run(_verify_and_update, password, phash)
+
+    def stop(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+            self._executor_pid = None
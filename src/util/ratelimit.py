@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: on average rate tokens are available every second,
+    with bursts of at most capacity tokens.
+    """
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.clock = clock
+
+        self.tokens = self.capacity
+        self.last_update = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Takes the tokens if available and returns 0, otherwise returns how many seconds to wait for them"""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Seconds to wait for the tokens to be available (0 if they are), without taking them"""
+        with self._lock:
+            self._refill(self.clock())
+            return max(tokens - self.tokens, 0.0) / self.rate
+
+    def acquire(self, tokens: float = 1, stop_event: Optional[threading.Event] = None) -> bool:
+        """Waits until the tokens are available, returns False if stop_event is set in the meantime"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return True
+            if stop_event is not None:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Empties the bucket so that no token is available for the next seconds (ex: when the server asks to wait)"""
+        with self._lock:
+            self._refill(self.clock())
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill(self.clock())
+            return self.tokens >= self.capacity
+
+
+class KeyedTokenBuckets:
+    """
+    A token bucket for every key (ex: every chat or every username).
+    At most max_keys buckets are kept, the least recently used one is discarded to make room for a new key.
+    """
+    def __init__(self, rate: float, capacity: float = None, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()  # type: Dict[Hashable, TokenBucket]  # Least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                self.buckets.move_to_end(key)
+                return bucket
+            while len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            bucket = TokenBucket(self.rate, self.capacity, clock=self.clock)
+            self.buckets[key] = bucket
+            return bucket
+
+    def try_acquire(self, key: Hashable, tokens: float = 1) -> float:
+        return self.get(key).try_acquire(tokens)
+
+    def wait_time(self, key: Hashable, tokens: float = 1) -> float:
+        with self._lock:
+            bucket = self.buckets.get(key)
+        # Without a bucket the key has all its tokens, no need to create one
+        return bucket.wait_time(tokens) if bucket is not None else 0.0
+
+    def acquire(self, key: Hashable, tokens: float = 1, stop_event: Optional[threading.Event] = None) -> bool:
+        return self.get(key).acquire(tokens, stop_event)
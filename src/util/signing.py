@@ -0,0 +1,107 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import List
+
+from itsdangerous import BadSignature, JSONWebSignatureSerializer
+
+# The secrets module was added only in python 3.6
+# If it isn't present we can use urandom from the os module
+try:
+    from secrets import token_hex
+except ImportError:
+    from os import urandom
+
+    def token_hex(nbytes=None):
+        return urandom(nbytes).hex()
+
+
+class KeyRingSerializer:
+    """
+    JSONWebSignatureSerializer that supports several keys: the first one signs the new tokens,
+    every key can verify them. This lets us rotate the signing key without logging out every user.
+    """
+    def __init__(self, secret_keys: List[str]):
+        self.serializers = []  # type: List[JSONWebSignatureSerializer]
+        self.set_keys(secret_keys)
+
+    def set_keys(self, secret_keys: List[str]):
+        if not secret_keys:
+            raise ValueError("At least one signing key is required")
+        self.serializers = [JSONWebSignatureSerializer(key) for key in secret_keys]
+
+    def dumps(self, obj) -> bytes:
+        return self.serializers[0].dumps(obj)
+
+    def loads(self, token):
+        error = None
+        for serializer in self.serializers:
+            try:
+                return serializer.loads(token)
+            except BadSignature as e:
+                error = e
+        raise error
+
+
+def read_keys_file(path: Path) -> List[str]:
+    with path.open("rt") as f:
+        keys = [line.strip() for line in f]
+    return [k for k in keys if k and not k.startswith("#")]
+
+
+def _write_atomic(path: Path, keys: List[str], replace: bool) -> bool:
+    # Write everything in a temporary file, then move it in place: nobody can read a partially written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=path.name, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wt") as f:
+            f.write("\n".join(keys) + "\n")
+        os.chmod(tmp, 0o600)
+
+        if replace:
+            os.replace(tmp, str(path))
+            return True
+        try:
+            # Fails if another process created the file in the meantime, their key wins
+            os.link(tmp, str(path))
+            return True
+        except FileExistsError:
+            return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_keys_file(path: Path) -> List[str]:
+    """
+    Reads the signing keys (one hex key per line, the first one signs the tokens).
+    If the file does not exist it is created with a new random key, atomically, so that every worker
+    that starts at the same time ends up with the same key.
+    """
+    if not path.is_file():
+        _write_atomic(path, [token_hex(32)], replace=False)
+
+    keys = read_keys_file(path)
+    if not keys:
+        raise ValueError("No signing key found in {}".format(path))
+    return keys
+
+
+def rotate_keys_file(path: Path, keep: int = 2) -> List[str]:
+    """
+    Adds a new signing key, the previous keys (at most keep - 1) are kept to verify the tokens already issued.
+    Every process should be restarted to use the new key.
+    """
+    old_keys = read_keys_file(path) if path.is_file() else []
+    keys = [token_hex(32)] + old_keys[:max(keep - 1, 0)]
+    _write_atomic(path, keys, replace=True)
+    return keys
+
+
+if __name__ == '__main__':
+    # python3 -m util.signing vardata/signing_keys
+    if len(sys.argv) != 2:
+        print("Usage: python3 -m util.signing <keys file>")
+        sys.exit(1)
+    print("{} keys in use".format(len(rotate_keys_file(Path(sys.argv[1])))))
@@ -1,6 +1,8 @@
 import logging
 import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 
 class RepeatingTimer(object):
@@ -42,3 +44,91 @@ def start_async(self, *args, **kwargs):
     def stop(self):
         self._stop_event.set()
         self.is_running = False
+
+
+# Values that the AdaptiveTimer target can return to hint how busy it is
+TICK_IDLE = "idle"  # Nothing to do, the timer can slow down
+TICK_NORMAL = "normal"  # Keep the base interval
+TICK_ACTIVE = "active"  # Something is happening, the timer should speed up
+
+
+class AdaptiveTimer(RepeatingTimer):
+    """
+    A RepeatingTimer that changes its interval based on the value returned by the target.
+    When the target returns TICK_IDLE the interval is multiplied by backoff (up to max_interval),
+    when it returns TICK_ACTIVE the timer runs every min_interval seconds, otherwise the base interval is used.
+    Ticks are never run concurrently, if a tick takes longer than the interval the missed ticks are merged
+    into a single one instead of being run back to back.
+    """
+    def __init__(self, interval, target, *args, min_interval=None, max_interval=None, backoff=2.0, **kwargs):
+        super().__init__(interval, target, *args, **kwargs)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.current_interval = interval
+
+    def next_interval(self, result) -> float:
+        min_interval = self.min_interval if self.min_interval is not None else self.interval
+        max_interval = self.max_interval if self.max_interval is not None else self.interval
+
+        if result == TICK_ACTIVE:
+            return min_interval
+        if result == TICK_IDLE:
+            return min(max(self.current_interval, self.interval) * self.backoff, max_interval)
+        return self.interval
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self.is_running = True
+        self.current_interval = self.interval
+
+        next_time = time.time() + self.current_interval
+
+        while not self._stop_event.is_set():
+            delta = next_time - time.time()
+            if delta > 0:
+                self._stop_event.wait(delta)
+                if self._stop_event.is_set():
+                    return
+
+            tick_start = time.time()
+            result = None
+            try:
+                result = self.target(*self.args, **self.kwargs)
+            except:
+                logging.exception("Exception during the Timer tick")
+            tick_end = time.time()
+
+            self.current_interval = self.next_interval(result)
+
+            missed = int((tick_end - next_time) // self.current_interval)
+            if missed > 0:
+                logging.warning("Timer tick took %.3fs, merging %i missed ticks", tick_end - tick_start, missed)
+            else:
+                logging.debug("Timer tick took %.3fs (%s), next tick in %.1fs",
+                              tick_end - tick_start, result, self.current_interval)
+
+            # Never schedule ticks in the past, this would only make them pile up
+            next_time = max(next_time + self.current_interval, tick_end)
+
+
+class PhaseTimer:
+    """Measures the time spent in every phase of an operation (ex: an alarm tick)"""
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def __str__(self):
+        return ", ".join("{} {:.1f}ms".format(name, t * 1000) for name, t in self.phases.items())